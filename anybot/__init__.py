@@ -1,22 +1,30 @@
 import asyncio
 import logging
 import re
+from datetime import timedelta
 from typing import (Dict, Any, Optional, Callable, Union, List, Awaitable,
-                    Coroutine)
+                    Coroutine, Iterable, Set)
 
-try:
-    import ujson as json
-except ImportError:
-    import json
+from quart import Quart, Response, abort, request, websocket
 
-from quart import Quart, abort, websocket
-
-from .api_impl import AsyncApi, SyncApi, WebSocketReverseApi, ResultStore
+from .api import Action_T
+from .api_impl import (AsyncApi, SyncApi, WebSocketReverseApi, Connection,
+                       ActionCache)
 from .bus import EventBus
+from .dedup import Deduplicator
+from .codec import (Codec, negotiate_codec, default_codec,
+                    _records_from_wire)
+from .event_queue import EventQueue
+from .executor import HandlerExecutor
+from .heartbeat import Heartbeat
 from .exceptions import Error, TimingError
 from .event import Event
-from .message import Message, MessageSegment
-from .utils import ensure_async
+from .message import Message, MessageSegment, Audio
+from .metrics import Counter, Gauge, registry as metrics_registry
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .recorder import TrafficRecorder, KIND_IN, KIND_CLOSE
+from .tasks import TaskRegistry
+from .utils import ensure_async, to_seconds
 
 from . import exceptions
 from .exceptions import *  # noqa: F401, F403
@@ -26,11 +34,31 @@ __all__ = [
     'Event',
     'Message',
     'MessageSegment',
+    'Audio',
 ]
 __all__ += exceptions.__all__
 
 __pdoc__ = {}
 
+_connected_speakers = Gauge('anybot_connected_speakers',
+                            'Number of connected speakers.')
+_pending_api_calls = Gauge('anybot_pending_api_calls',
+                           'Number of API calls waiting for results.')
+_event_queue_depth = Gauge('anybot_event_queue_depth',
+                           'Number of events waiting to be handled.',
+                           ['self_id'])
+_background_tasks = Gauge('anybot_background_tasks',
+                          'Number of unfinished background tasks.',
+                          ['kind'])
+_events_received = Counter('anybot_events_received',
+                           'Number of events received from speakers.',
+                           ['type'])
+# event types are given by the clients, so don't create children for them
+_events_received_by_type = {
+    t: _events_received.labels(t)
+    for t in ('message', 'notice', 'request', 'meta_event', 'other')
+}
+
 
 def _deco_maker(type_: str) -> Callable:
     def deco_deco(self,
@@ -58,11 +86,57 @@ class AnyBot(AsyncApi):
                  access_token: Optional[str] = None,
                  message_class: Optional[type] = None,
                  server_app_kwargs: Optional[dict] = None,
+                 event_queue_size: int = 100,
+                 event_queue_overflow: str = 'drop_oldest',
+                 event_queue_workers: int = 4,
+                 event_priorities: Optional[Dict[str, int]] = None,
+                 event_lane_concurrency: Optional[Dict[int, int]] = None,
+                 event_max_age: Union[float, timedelta, None] = None,
+                 event_dedup_size: int = 0,
+                 event_dedup_window: Union[float, timedelta, None] = None,
+                 action_cache_size: int = 1024,
+                 action_cache_policies: Optional[Dict[str, dict]] = None,
+                 handler_executor_workers: Optional[int] = None,
+                 handler_executor_queue_size: int = 100,
+                 heartbeat_interval: Union[float, timedelta, None] = None,
+                 heartbeat_max_missed: int = 3,
+                 metrics_path: Optional[str] = '/metrics',
+                 traffic_record_path: Optional[str] = None,
+                 shutdown_drain_timeout: Union[float, timedelta] = 30,
                  **kwargs):
         self._wsr_api_clients = {}  # connected wsr api clients
-        self._api = WebSocketReverseApi(self._wsr_api_clients, 60)
+        self._wsr_handler_tasks: Set[asyncio.Task] = set()
+        self._event_queues: Dict[str, EventQueue] = {}  # key: self_id
+        self._event_queue_kwargs = {
+            'maxsize': event_queue_size,
+            'overflow': event_queue_overflow,
+            'workers': event_queue_workers,
+            'priorities': event_priorities,
+            'lane_concurrency': event_lane_concurrency,
+            'max_age': to_seconds(event_max_age),
+        }
+        self._dedup = Deduplicator(
+            event_dedup_size,
+            to_seconds(event_dedup_window)) if event_dedup_size > 0 else None
+        self._api = WebSocketReverseApi(self._wsr_api_clients,
+                                        60,
+                                        cache_size=action_cache_size)
+        for action, policy in (action_cache_policies or {}).items():
+            policy = dict(policy)
+            policy['ttl'] = to_seconds(policy['ttl'])
+            self._api.cache.set_policy(action, **policy)
         self._sync_api = None
 
+        # sync event handlers run here instead of the default executor,
+        # which is also used by httpx and dns resolution
+        self._handler_executor = HandlerExecutor(
+            handler_executor_workers, handler_executor_queue_size)
+
+        self._heartbeat_interval = to_seconds(heartbeat_interval)
+        self._heartbeat_max_missed = heartbeat_max_missed
+        self._drain_timeout = to_seconds(shutdown_drain_timeout)
+        self._draining = False
+
         self._access_token = access_token
         self._message_class = message_class
         self._bus = EventBus()
@@ -70,13 +144,41 @@ class AnyBot(AsyncApi):
 
         self._server_app = Quart(import_name, **(server_app_kwargs or {}))
         self._server_app.before_serving(self._before_serving)
+        self._server_app.after_serving(self._after_serving)
         self._server_app.add_websocket('/ws',
                                        strict_slashes=False,
                                        view_func=self._handle_wsr)
+        if metrics_path:
+            self._server_app.add_url_rule(metrics_path,
+                                          'metrics',
+                                          view_func=self._handle_metrics)
+
+        self._recorder = TrafficRecorder(
+            traffic_record_path,
+            logger=self.logger) if traffic_record_path else None
+        self._tasks = TaskRegistry(self.logger)
+
+        _connected_speakers.set_function(
+            lambda: len(self._wsr_api_clients))
+        _pending_api_calls.set_function(lambda: sum(
+            len(conn.results) for conn in self._wsr_api_clients.values()))
+        _event_queue_depth.set_function(
+            lambda: [((self_id, ), queue.depth)
+                     for self_id, queue in self._event_queues.items()])
+        _background_tasks.set_function(
+            lambda: [((kind, ), n) for kind, n in self._tasks.counts.items()])
 
     async def _before_serving(self):
         self._loop = asyncio.get_running_loop()
 
+    async def _after_serving(self):
+        # the websockets are still open here, so handlers can finish sending
+        await self.drain()
+        # don't wait for the sync handlers still running after a timeout
+        self._handler_executor.shutdown(wait=False)
+        if self._recorder:
+            self._recorder.close()
+
     @property
     def asgi(self) -> Callable[[dict, Callable, Callable], Awaitable]:
         return self._server_app
@@ -97,6 +199,68 @@ class AnyBot(AsyncApi):
     def api(self) -> AsyncApi:
         return self._api
 
+    @property
+    def event_queue_stats(self) -> Dict[str, Dict[str, Any]]:
+        """各智能音箱连接的事件队列统计，键为 ``self_id``。"""
+        return {
+            self_id: queue.stats
+            for self_id, queue in self._event_queues.items()
+        }
+
+    @property
+    def tasks(self) -> TaskRegistry:
+        """
+        后台任务登记表，不等待结果的协程（如发送消息）应通过其
+        `TaskRegistry.spawn` 创建，以便服务关闭时等待它们完成。
+        """
+        return self._tasks
+
+    @property
+    def task_stats(self) -> Dict[str, Any]:
+        """当前正在处理的事件数、排队的事件数和各种类后台任务数。"""
+        return {
+            'draining': self._draining,
+            'connections': len(self._wsr_handler_tasks),
+            'events_running': sum(
+                q.running for q in self._event_queues.values()),
+            'events_queued': sum(
+                q.depth for q in self._event_queues.values()),
+            'tasks': self._tasks.counts,
+        }
+
+    @property
+    def action_cache(self) -> ActionCache:
+        """API 调用结果缓存，可用于设置缓存策略、使缓存失效和查看统计。"""
+        return self._api.cache
+
+    @property
+    def handler_executor(self) -> HandlerExecutor:
+        """运行同步事件处理函数的线程池，可用于查看统计。"""
+        return self._handler_executor
+
+    @property
+    def event_dedup_stats(self) -> Optional[Dict[str, int]]:
+        """事件去重统计，未启用去重时为 `None`。"""
+        return self._dedup.stats if self._dedup is not None else None
+
+    @property
+    def speaker_rtt_stats(self) -> Dict[str, Dict[str, Optional[float]]]:
+        """
+        各智能音箱连接的心跳往返时延统计（单位为秒），键为 ``self_id``。
+        """
+        return {
+            self_id: conn.rtt.stats
+            for self_id, conn in self._wsr_api_clients.items()
+        }
+
+    def set_action_timeout(self, self_id: str,
+                           timeout: Union[float, timedelta, None]) -> None:
+        """
+        设置发往指定智能音箱的 API 调用超时时间，为 `None` 时恢复默认值，
+        可根据 `speaker_rtt_stats` 为较慢的智能音箱设置更长的超时。
+        """
+        self._api.set_timeout(self_id, to_seconds(timeout))
+
     @property
     def sync(self) -> SyncApi:
         if not self._sync_api:
@@ -111,6 +275,23 @@ class AnyBot(AsyncApi):
             kwargs['use_reloader'] = False
         self._server_app.run(host=host, port=port, *args, **kwargs)
 
+    def run_workers(self,
+                    workers: int,
+                    host: str = '127.0.0.1',
+                    port: int = 8080) -> None:
+        """
+        以多进程模式运行，启动 ``workers`` 个 worker 进程，
+        同一智能音箱的连接总是由同一 worker 处理。
+
+        应在所有插件和配置加载完成后调用，以便 worker 共享它们。
+        """
+        from .workers import Supervisor
+        Supervisor(self._server_app,
+                   host=host,
+                   port=port,
+                   workers=workers,
+                   logger=self.logger).run()
+
     def run_task(self,
                  host: str = None,
                  port: int = None,
@@ -120,9 +301,57 @@ class AnyBot(AsyncApi):
             kwargs['use_reloader'] = False
         return self._server_app.run_task(host=host, port=port, *args, **kwargs)
 
+    async def drain(self,
+                    timeout: Union[float, timedelta, None] = None) -> bool:
+        """
+        停止接受新的连接和事件，等待已接受的事件和后台任务完成，最多等待
+        ``timeout``（为 `None` 时使用 ``shutdown_drain_timeout``），
+        然后取消仍未完成的任务并关闭所有连接。
+
+        服务关闭时会自动调用。返回是否所有事件和任务都在限期内完成。
+        """
+        timeout = self._drain_timeout if timeout is None \
+            else to_seconds(timeout)
+        self._draining = True
+        self.logger.info(f'draining, {self.task_stats}')
+
+        async def wait_all():
+            await asyncio.gather(
+                *(q.drain() for q in list(self._event_queues.values())))
+            # handlers may have spawned sends before returning
+            await self._tasks.join()
+
+        try:
+            await asyncio.wait_for(wait_all(), timeout)
+            drained = True
+        except asyncio.TimeoutError:
+            drained = False
+            self.logger.warning(f'failed to drain in {timeout} seconds, '
+                                f'cancelling the rest: {self.task_stats}')
+            # closing a queue leaves the running handlers alone, and the
+            # queues are gone once the connection handlers exit
+            await asyncio.gather(*(q.cancel(timeout=5)
+                                   for q in list(self._event_queues.values())))
+        self._tasks.cancel_all()
+
+        handlers = list(self._wsr_handler_tasks)
+        for task in handlers:
+            task.cancel()
+        if handlers:
+            # let the handlers clean up and close the websockets
+            await asyncio.wait(handlers, timeout=5)
+        return drained
+
     async def call_action(self, action: str, **params) -> Any:
         return await self._api.call_action(action=action, **params)
 
+    async def call_actions(self,
+                           actions: Iterable[Action_T],
+                           *,
+                           return_exceptions: bool = False) -> List[Any]:
+        return await self._api.call_actions(
+            actions, return_exceptions=return_exceptions)
+
     async def send(self, event: Event, message: Union[str, Dict[str, Any],
                                                       List[Dict[str, Any]]],
                    **kwargs) -> Optional[Dict[str, Any]]:
@@ -137,7 +366,8 @@ class AnyBot(AsyncApi):
         return await self._api.call_action('send', **params)
 
     def subscribe(self, event_name: str, func: Callable) -> None:
-        self._bus.subscribe(event_name, ensure_async(func))
+        self._bus.subscribe(event_name,
+                            ensure_async(func, self._handler_executor))
 
     def unsubscribe(self, event_name: str, func: Callable) -> None:
         self._bus.unsubscribe(event_name, func)
@@ -155,9 +385,8 @@ class AnyBot(AsyncApi):
     on_request = _deco_maker('request')
     on_meta_event = _deco_maker('meta_event')
 
-    async def _handle_wsr(self) -> None:
+    def _check_access_token(self, auth: str) -> None:
         if self._access_token:
-            auth = websocket.headers.get('Authorization', '')
             m = re.fullmatch(r'(?:[Bb]earer) (?P<token>\S+)', auth)
             if not m:
                 self.logger.warning('authorization header is missing')
@@ -168,54 +397,148 @@ class AnyBot(AsyncApi):
                 self.logger.warning('authorization header is invalid')
                 abort(403)
 
-        self._add_wsr_api_client()
+    async def _handle_metrics(self) -> Response:
+        self._check_access_token(request.headers.get('Authorization', ''))
+        return Response(metrics_registry.exposition(),
+                        content_type=METRICS_CONTENT_TYPE)
+
+    async def _handle_wsr(self) -> None:
+        self._check_access_token(websocket.headers.get('Authorization', ''))
+        if self._draining:
+            # the speaker should reconnect to another instance
+            abort(503)
+
+        codec = negotiate_codec(websocket.requested_subprotocols)
+        if codec:
+            await websocket.accept(subprotocol=codec.name)
+        conn = self._add_wsr_api_client(codec or default_codec)
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.record_open(conn.self_id, conn.codec.name, conn.batch)
+        queue = EventQueue(self._handle_event,
+                           logger=self.logger,
+                           **self._event_queue_kwargs)
+        self._event_queues[conn.self_id] = queue
+
+        loop = asyncio.get_running_loop()
+        handler_task = asyncio.current_task()
+        self._wsr_handler_tasks.add(handler_task)
+        heartbeat = None
+        if self._heartbeat_interval:
+            heartbeat = Heartbeat(
+                conn,
+                self._heartbeat_interval,
+                max_missed=self._heartbeat_max_missed,
+                on_dead=lambda c: self._evict_wsr_api_client(c, handler_task),
+                logger=self.logger)
+            heartbeat.start()
         try:
             while True:
+                frame = await websocket.receive()
+                conn.last_received = loop.time()
+                if recorder is not None:
+                    recorder.record(KIND_IN, conn.self_id, frame)
                 try:
-                    payload = json.loads(await websocket.receive())
+                    payload = conn.codec.loads(frame)
                 except ValueError:
                     payload = None
 
+                if isinstance(payload, list):
+                    # is a batch of api results
+                    for result in payload:
+                        if isinstance(result, dict):
+                            conn.results.add(result)
+                    continue
+
                 if not isinstance(payload, dict):
                     # ignore invalid payload
                     continue
 
                 if 'type' in payload:
                     # is a event
-                    asyncio.create_task(self._handle_event(payload))
+                    _events_received_by_type.get(
+                        str(payload['type']),
+                        _events_received_by_type['other']).inc()
+                    await queue.put(payload)
                 elif payload:
                     # is a api result
-                    ResultStore.add(payload)
+                    conn.results.add(payload)
+        except asyncio.CancelledError:
+            if not self._draining and (heartbeat is None
+                                       or not heartbeat.dead):
+                raise
+            # evicted or drained, return normally to close the websocket
         finally:
-            self._remove_wsr_api_client()
+            self._wsr_handler_tasks.discard(handler_task)
+            if recorder is not None:
+                recorder.record(KIND_CLOSE, conn.self_id, '')
+            if heartbeat is not None:
+                heartbeat.stop()
+            queue.close()
+            if self._event_queues.get(conn.self_id) is queue:
+                del self._event_queues[conn.self_id]
+            self._remove_wsr_api_client(conn)
 
     def _current_self_id(self) -> str:
         return websocket.headers.get('X-Self-ID',
                                      websocket.args.get('self_id', '*'))
 
-    def _add_wsr_api_client(self) -> None:
+    def _add_wsr_api_client(self, codec: Codec) -> Connection:
         ws = websocket._get_current_object()
         self_id = self._current_self_id()
-        self._wsr_api_clients[self_id] = ws
-
-    def _remove_wsr_api_client(self) -> None:
-        self_id = self._current_self_id()
-        if self_id in self._wsr_api_clients:
-            # we must check the existence here,
+        batch = websocket.headers.get('X-Batch-Actions', '').lower() in \
+            ('1', 'true', 'yes')
+        conn = Connection(ws,
+                          self_id,
+                          self._api.timeouts,
+                          batch=batch,
+                          codec=codec,
+                          recorder=self._recorder)
+        self._wsr_api_clients[self_id] = conn
+        return conn
+
+    def _remove_wsr_api_client(self, conn: Connection) -> None:
+        # fail all pending api calls on this connection immediately
+        conn.close()
+        self._api.cache.invalidate(self_id=conn.self_id)
+        if self._wsr_api_clients.get(conn.self_id) is conn:
+            # we must check the identity here,
             # because we allow wildcard ws connections,
-            # that is, the self_id may be '*'
-            del self._wsr_api_clients[self_id]
+            # that is, the self_id may be '*', and a reconnected
+            # speaker may have already replaced this connection
+            del self._wsr_api_clients[conn.self_id]
+
+    def _evict_wsr_api_client(self, conn: Connection,
+                              handler_task: asyncio.Task) -> None:
+        self.logger.warning(f'speaker {conn.self_id} is not responding, '
+                            f'closing the connection')
+        # stop sending api calls into the dead connection right now,
+        # the handler may be blocked on receiving for a long time
+        self._remove_wsr_api_client(conn)
+        handler_task.cancel()
 
     async def _handle_event(self, payload: Dict[str, Any]) -> Any:
         ev = Event.from_payload(payload)
         if not ev:
             return
 
+        if self._dedup is not None and ev.message_id is not None and \
+                self._dedup.check((ev.self_id, ev.message_id)):
+            # speakers may replay events after reconnecting
+            self.logger.info(f'ignored duplicate event: {ev.name}, '
+                             f'message id: {ev.message_id}')
+            return
+
         event_name = ev.name
         self.logger.info(f'received event: {event_name}')
 
-        if self._message_class and 'message' in ev:
-            ev['message'] = self._message_class(ev['message'])
+        if 'message' in ev:
+            # Audio objects only for the message class, which knows them,
+            # the raw messages keep the record audio in data.base64
+            _records_from_wire(ev['message'],
+                               to_audio=bool(self._message_class))
+            if self._message_class:
+                ev['message'] = self._message_class(ev['message'])
         results = list(
             filter(lambda r: r is not None, await
             self._bus.emit(event_name, ev)))
@@ -1,6 +1,9 @@
 import abc
 import functools
-from typing import Callable, Any, Union, Awaitable
+from typing import (Callable, Any, Union, Awaitable, Iterable, Tuple, Dict,
+                    List)
+
+Action_T = Tuple[str, Dict[str, Any]]
 
 
 class Api:
@@ -8,6 +11,14 @@ class Api:
     def call_action(self, action: str, **params) -> Union[Awaitable[Any], Any]:
         pass
 
+    @abc.abstractmethod
+    def call_actions(self,
+                     actions: Iterable[Action_T],
+                     *,
+                     return_exceptions: bool = False
+                     ) -> Union[Awaitable[List[Any]], List[Any]]:
+        pass
+
     def __getattr__(self,
                     item: str) -> Callable[..., Union[Awaitable[Any], Any]]:
         return functools.partial(self.call_action, item)
@@ -1,100 +1,559 @@
 import abc
 import asyncio
+import copy
+import heapq
 import sys
-from typing import Dict, Any
-
-try:
-    import ujson as json
-except ImportError:
-    import json
+import time
+from collections import OrderedDict
+from typing import (Dict, Any, List, Tuple, Optional, Iterable, Hashable,
+                    Set)
 
 from quart import websocket as event_ws
 from quart.wrappers.request import Websocket
 
-from .api import Api
+from .api import Api, Action_T
+from .codec import Codec, default_codec
 from .exceptions import ActionFailed, ApiNotAvailable, NetworkError
+from .heartbeat import RttEstimator
+from .metrics import Histogram
+from .recorder import TrafficRecorder, KIND_OUT
 from .utils import sync_wait
 
+_action_latency = Histogram('anybot_action_latency_seconds',
+                            'Latency of API calls to speakers.', ['action'])
+
 
 class AsyncApi(Api):
     @abc.abstractmethod
     async def call_action(self, action: str, **params) -> Any:
         pass
 
+    async def call_actions(self,
+                           actions: Iterable[Action_T],
+                           *,
+                           return_exceptions: bool = False) -> List[Any]:
+        """
+        并发调用多个 API，按顺序返回结果。
 
-class _SequenceGenerator:
-    _seq = 1
+        ``actions`` 为 ``(action, params)`` 元组的可迭代对象，
+        ``return_exceptions`` 的含义与 `asyncio.gather` 相同。
+        """
+        coros = [self.call_action(action, **params)
+                 for action, params in actions]
+        return list(await asyncio.gather(*coros,
+                                         return_exceptions=return_exceptions))
 
-    @classmethod
-    def next(cls) -> int:
-        s = cls._seq
-        cls._seq = (cls._seq + 1) % sys.maxsize
-        return s
+
+class TimeoutQueue:
+    """
+    所有连接共享的 API 调用超时队列。
+
+    使用一个按截止时间排序的堆和一个事件循环定时器处理所有未完成调用的超时，
+    而不是为每次调用创建一个 `asyncio.wait_for` 计时器。已完成的 future
+    会在其截止时间到达时被惰性地跳过；当堆中已完成的超过一半时，堆会被压缩，
+    以免它们（及其结果）一直保留到截止时间。
+    """
+
+    # don't bother compacting heaps smaller than this
+    _COMPACT_MIN_SIZE = 64
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, asyncio.Future]] = []
+        self._counter = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # number of futures in the heap that are not done
+        self._live = 0
+
+    def add(self, future: asyncio.Future, timeout_sec: float) -> None:
+        """在 `timeout_sec` 秒后，若 `future` 仍未完成，则使其以超时失败。"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # the loop has changed (e.g. restarted), forget the old timer
+            self._heap.clear()
+            self._timer = None
+            self._loop = loop
+            self._live = 0
+
+        deadline = loop.time() + timeout_sec
+        self._counter += 1
+        heapq.heappush(self._heap, (deadline, self._counter, future))
+        self._live += 1
+        future.add_done_callback(self._on_done)
+        if self._heap[0][2] is future:
+            # the new future is the earliest one, reschedule the timer
+            self._schedule()
+
+    def _schedule(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._heap:
+            self._timer = self._loop.call_at(self._heap[0][0], self._expire)
+
+    def _expire(self) -> None:
+        self._timer = None
+        now = self._loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                # haven't received any result until timeout,
+                # we consider this API call failed with a network error.
+                future.set_exception(
+                    NetworkError('WebSocket API call timeout'))
+        self._schedule()
+
+    def _on_done(self, future: asyncio.Future) -> None:
+        if future.get_loop() is not self._loop:
+            # added before the loop changed, already forgotten
+            return
+        self._live -= 1
+        size = len(self._heap)
+        if size >= self._COMPACT_MIN_SIZE and size - self._live > size // 2:
+            self._heap = [e for e in self._heap if not e[2].done()]
+            heapq.heapify(self._heap)
+            self._schedule()
+
+    def __len__(self) -> int:
+        """未完成的调用数。"""
+        return self._live
 
 
 class ResultStore:
-    _futures: Dict[int, asyncio.Future] = {}
+    """
+    单个反向 WebSocket 连接的 API 调用结果存储。
+
+    连接关闭时，所有未完成的调用立即以 `NetworkError` 失败。
+    """
 
-    @classmethod
-    def add(cls, result: Dict[str, Any]):
+    def __init__(self, timeouts: TimeoutQueue):
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._timeouts = timeouts
+        self._seq = 1
+        self._closed = False
+
+    def next_seq(self) -> int:
+        s = self._seq
+        self._seq = (self._seq + 1) % sys.maxsize
+        return s
+
+    def add(self, result: Dict[str, Any]) -> None:
         if isinstance(result.get('echo'), dict) and \
                 isinstance(result['echo'].get('seq'), int):
-            future = cls._futures.get(result['echo']['seq'])
-            if future:
+            future = self._futures.get(result['echo']['seq'])
+            if future and not future.done():
                 future.set_result(result)
 
-    @classmethod
-    async def fetch(cls, seq: int, timeout_sec: float) -> Dict[str, Any]:
-        future = asyncio.get_event_loop().create_future()
-        cls._futures[seq] = future
+    def expect(self, seq: int, timeout_sec: float) -> None:
+        """
+        登记一个即将发出的调用，应在发送请求之前调用，以免错过过快到达的结果。
+        """
+        if self._closed:
+            raise NetworkError('WebSocket connection closed')
+
+        future = asyncio.get_running_loop().create_future()
+        self._futures[seq] = future
+        self._timeouts.add(future, timeout_sec)
+
+    def discard(self, seq: int) -> None:
+        future = self._futures.pop(seq, None)
+        if future and not future.done():
+            future.cancel()
+
+    async def fetch(self, seq: int) -> Dict[str, Any]:
         try:
-            return await asyncio.wait_for(future, timeout_sec)
-        except asyncio.TimeoutError:
-            # haven't received any result until timeout,
-            # we consider this API call failed with a network error.
-            raise NetworkError('WebSocket API call timeout')
+            return await self._futures[seq]
         finally:
             # don't forget to remove the future object
-            del cls._futures[seq]
+            self._futures.pop(seq, None)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        """关闭存储，使所有未完成的调用以 `NetworkError` 失败。"""
+        self._closed = True
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(
+                    NetworkError('WebSocket connection closed'))
+
+    def __len__(self) -> int:
+        return len(self._futures)
+
+
+class Connection:
+    """
+    已连接的反向 WebSocket 客户端（智能音箱），持有该连接的 API 结果存储。
+    """
+
+    __slots__ = ('ws', 'self_id', 'results', 'batch', 'codec', 'rtt',
+                 'last_received', 'recorder')
+
+    def __init__(self,
+                 ws: Websocket,
+                 self_id: str,
+                 timeouts: TimeoutQueue,
+                 *,
+                 batch: bool = False,
+                 codec: Codec = default_codec,
+                 recorder: Optional[TrafficRecorder] = None):
+        self.ws = ws
+        self.self_id = self_id
+        self.results = ResultStore(timeouts)
+        # the client accepts an array of requests in a single frame
+        self.batch = batch
+        self.codec = codec
+        self.rtt = RttEstimator()
+        # event loop time of the last frame received from the client
+        self.last_received = 0.0
+        self.recorder = recorder
+
+    @property
+    def closed(self) -> bool:
+        return self.results.closed
+
+    async def send(self, payload: Any) -> None:
+        data = self.codec.dumps(payload)
+        if self.recorder is not None:
+            self.recorder.record(KIND_OUT, self.self_id, data)
+        await self.ws.send(data)
+
+    async def request(self, action: str, params: Dict[str, Any],
+                      timeout_sec: float) -> Dict[str, Any]:
+        """发送一个 API 请求，返回原始的调用结果。"""
+        seq = self.results.next_seq()
+        self.results.expect(seq, timeout_sec)
+        try:
+            await self.send(_make_request(action, params, seq))
+        except Exception:
+            self.results.discard(seq)
+            raise
+        return await self.results.fetch(seq)
+
+    def close(self) -> None:
+        self.results.close()
+
+
+class CachePolicy:
+    """
+    API 调用结果的缓存策略。
+
+    ``key_params`` 为参与缓存键计算的参数名，为 `None` 时使用全部参数；
+    ``invalidated_by`` 中的 API 被调用时，同一智能音箱的缓存结果失效。
+    """
+
+    __slots__ = ('action', 'ttl', 'key_params', 'invalidated_by')
+
+    def __init__(self,
+                 action: str,
+                 ttl: float,
+                 *,
+                 key_params: Optional[Iterable[str]] = None,
+                 invalidated_by: Iterable[str] = ()):
+        self.action = action
+        self.ttl = ttl
+        self.key_params = tuple(key_params) \
+            if key_params is not None else None
+        self.invalidated_by = frozenset(invalidated_by)
+
+    def make_key(self, self_id: str,
+                 params: Dict[str, Any]) -> Optional[Hashable]:
+        if self.key_params is None:
+            items = tuple(sorted(
+                (k, v) for k, v in params.items() if k != 'self_id'))
+        else:
+            items = tuple(params.get(k) for k in self.key_params)
+        key = (self.action, self_id, items)
+        try:
+            hash(key)
+        except TypeError:
+            # unhashable params, don't cache
+            return None
+        return key
+
+
+class ActionCache:
+    """
+    只读 API 调用结果的 TTL 缓存，按策略声明要缓存的 API，最多保存
+    ``maxsize`` 个结果，超出时淘汰最久未使用的。
+
+    缓存保存结果的副本，命中时也返回副本，调用者修改结果不会影响缓存。
+    调用发出前应记下该智能音箱的 `generation`，并在存入结果时传入：调用期间
+    该智能音箱的缓存失效过时，结果可能已经过时，不会被存入。
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self._maxsize = maxsize
+        self._policies: Dict[str, CachePolicy] = {}
+        # key: action that invalidates others
+        # value: actions to invalidate
+        self._invalidations: Dict[str, List[str]] = {}
+        # value: (expire time, result data)
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = \
+            OrderedDict()
+        # key: self_id, value: keys of the entries of the speaker
+        self._keys_by_self_id: Dict[str, Set[Hashable]] = {}
+        # incremented on every invalidation of all speakers
+        self._generation = 0
+        # key: self_id, value: incremented on every invalidation of it
+        self._generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set_policy(self,
+                   action: str,
+                   ttl: float,
+                   *,
+                   key_params: Optional[Iterable[str]] = None,
+                   invalidated_by: Iterable[str] = ()) -> None:
+        """设置 API 的缓存策略，已有的策略会被替换。"""
+        self.remove_policy(action)
+        policy = CachePolicy(action,
+                             ttl,
+                             key_params=key_params,
+                             invalidated_by=invalidated_by)
+        self._policies[action] = policy
+        for other in policy.invalidated_by:
+            self._invalidations.setdefault(other, []).append(action)
+
+    def remove_policy(self, action: str) -> None:
+        policy = self._policies.pop(action, None)
+        if not policy:
+            return
+        for other in policy.invalidated_by:
+            self._invalidations[other].remove(action)
+            if not self._invalidations[other]:
+                del self._invalidations[other]
+        self.invalidate(action)
+
+    def make_key(self, action: str, self_id: str,
+                 params: Dict[str, Any]) -> Optional[Hashable]:
+        """计算缓存键，API 不需要缓存时返回 `None`。"""
+        policy = self._policies.get(action)
+        if not policy:
+            return None
+        return policy.make_key(self_id, params)
+
+    def generation(self, self_id: str) -> Tuple[int, int]:
+        """智能音箱的缓存的版本，每次使其缓存失效时改变。"""
+        return self._generation, self._generations.get(self_id, 0)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """查找缓存，返回 ``(是否命中, 结果)``。"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, copy.deepcopy(entry[1])
+            self._remove(key)
+        self.misses += 1
+        return False, None
+
+    def put(self, key: Hashable, data: Any,
+            generation: Tuple[int, int]) -> None:
+        """
+        存入结果，``generation`` 为调用发出前该智能音箱的 `generation`，
+        与当前的不同时不存入。
+        """
+        if generation != self.generation(key[1]):
+            return
+        policy = self._policies.get(key[0])
+        if not policy:
+            return
+        self._entries[key] = (time.monotonic() + policy.ttl,
+                              copy.deepcopy(data))
+        self._entries.move_to_end(key)
+        self._keys_by_self_id.setdefault(key[1], set()).add(key)
+        while len(self._entries) > self._maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Hashable) -> None:
+        del self._entries[key]
+        keys = self._keys_by_self_id[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_self_id[key[1]]
+
+    def on_called(self, action: str, self_id: str) -> None:
+        """在 API 被调用时使依赖它的缓存失效。"""
+        for other in self._invalidations.get(action, ()):
+            self.invalidate(other, self_id=self_id)
+
+    def invalidate(self,
+                   action: Optional[str] = None,
+                   *,
+                   self_id: Optional[str] = None) -> None:
+        """使匹配的缓存失效，参数为 `None` 表示不限制。"""
+        if self_id is not None:
+            self._generations[self_id] = self._generations.get(self_id, 0) + 1
+            keys = self._keys_by_self_id.get(self_id, ())
+        else:
+            self._generation += 1
+            if action is None:
+                self._entries.clear()
+                self._keys_by_self_id.clear()
+                return
+            keys = self._entries
+        for key in [k for k in keys if action is None or k[0] == action]:
+            self._remove(key)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
 
 
 class WebSocketReverseApi(AsyncApi):
-    def __init__(self, connected_clients: Dict[str, Websocket],
-                 timeout_sec: float):
+    def __init__(self,
+                 connected_clients: Dict[str, Connection],
+                 timeout_sec: float,
+                 *,
+                 cache_size: int = 1024):
         super().__init__()
         self._clients = connected_clients
         self._timeout_sec = timeout_sec
+        # key: self_id, value: timeout of api calls to the speaker
+        self._timeouts_by_id: Dict[str, float] = {}
+        self.timeouts = TimeoutQueue()
+        self.cache = ActionCache(cache_size)
 
-    async def call_action(self, action: str, **params) -> Any:
-        api_ws = None
+    def set_timeout(self, self_id: str, timeout_sec: Optional[float]) -> None:
+        """
+        设置发往指定智能音箱的 API 调用超时时间，为 `None` 时恢复默认值。
+        """
+        if timeout_sec is None:
+            self._timeouts_by_id.pop(self_id, None)
+        else:
+            self._timeouts_by_id[self_id] = timeout_sec
+
+    def _get_timeout(self, conn: Connection) -> float:
+        return self._timeouts_by_id.get(conn.self_id, self._timeout_sec)
+
+    def _get_connection(self, params: Dict[str, Any]) -> Connection:
+        conn = None
         if params.get('self_id'):
             # 明确指定
-            api_ws = self._clients.get(str(params['self_id']))
+            conn = self._clients.get(str(params['self_id']))
         elif event_ws and event_ws.headers['X-Self-ID'] in self._clients:
             # 没有指定，但在事件处理函数中
-            api_ws = self._clients.get(event_ws.headers['X-Self-ID'])
+            conn = self._clients.get(event_ws.headers['X-Self-ID'])
         elif len(self._clients) == 1:
             # 没有指定，不在事件处理函数中，但只有一个连接
-            api_ws = tuple(self._clients.values())[0]
+            conn = tuple(self._clients.values())[0]
 
-        if not api_ws:
+        if not conn:
             raise ApiNotAvailable
+        return conn
+
+    async def call_action(self, action: str, **params) -> Any:
+        conn = self._get_connection(params)
+        self.cache.on_called(action, conn.self_id)
+        cache_key = self.cache.make_key(action, conn.self_id, params)
+        if cache_key is not None:
+            hit, data = self.cache.get(cache_key)
+            if hit:
+                return data
+        generation = self.cache.generation(conn.self_id)
+
+        latency = _action_latency.labels(action)
+        start = time.perf_counter()
+        try:
+            result = await conn.request(action, params,
+                                        self._get_timeout(conn))
+        finally:
+            latency.observe(time.perf_counter() - start)
+        data = _extract_data(result)
+        if cache_key is not None:
+            self.cache.put(cache_key, data, generation)
+        return data
+
+    async def call_actions(self,
+                           actions: Iterable[Action_T],
+                           *,
+                           return_exceptions: bool = False) -> List[Any]:
+        """
+        批量调用多个 API。
+
+        发往同一连接的请求在一次写入中发出：若客户端声明支持批量请求，
+        则合并为一个数组帧，否则连续发送多个帧，不等待中间结果。
+        所有结果按 ``echo.seq`` 收集，按顺序返回。
+        """
+        batches: Dict[Connection, List[Tuple[int, Dict[str, Any]]]] = {}
+        # value: (connection, seq, cache key, cached data, latency metric),
+        # seq is None if the result is cached
+        calls: List[Tuple[Connection, Optional[int], Optional[Hashable],
+                          Any, Any]] = []
+        try:
+            for action, params in actions:
+                conn = self._get_connection(params)
+                self.cache.on_called(action, conn.self_id)
+                cache_key = self.cache.make_key(action, conn.self_id,
+                                                params)
+                if cache_key is not None:
+                    hit, data = self.cache.get(cache_key)
+                    if hit:
+                        calls.append((conn, None, None, data, None))
+                        continue
+
+                seq = conn.results.next_seq()
+                conn.results.expect(seq, self._get_timeout(conn))
+                calls.append((conn, seq, cache_key, None,
+                              _action_latency.labels(action)))
+                batches.setdefault(conn, []).append(
+                    (seq, _make_request(action, params, seq)))
+
+            # after all the invalidations by the actions themselves
+            generations = {
+                conn: self.cache.generation(conn.self_id)
+                for conn in batches
+            }
+            start = time.perf_counter()
+            for conn, requests in batches.items():
+                if conn.batch and len(requests) > 1:
+                    await conn.send([r for _, r in requests])
+                else:
+                    for _, r in requests:
+                        await conn.send(r)
+        except Exception:
+            for conn, seq, _, _, _ in calls:
+                if seq is not None:
+                    conn.results.discard(seq)
+            raise
+
+        async def fetch(conn: Connection, seq: Optional[int],
+                        cache_key: Optional[Hashable], data: Any,
+                        latency: Any) -> Any:
+            if seq is None:
+                return data
+            try:
+                result = await conn.results.fetch(seq)
+            finally:
+                latency.observe(time.perf_counter() - start)
+            data = _extract_data(result)
+            if cache_key is not None:
+                self.cache.put(cache_key, data, generations[conn])
+            return data
+
+        return list(await asyncio.gather(*(fetch(*call) for call in calls),
+                                         return_exceptions=return_exceptions))
 
-        seq = _SequenceGenerator.next()
-        await api_ws.send(
-            json.dumps({
-                'action': action,
-                'params': params,
-                'echo': {
-                    'seq': seq
-                }
-            }, ensure_ascii=False))
 
-        result = await ResultStore.fetch(seq, self._timeout_sec)
-        if isinstance(result, dict):
-            if result.get('status') == 'failed':
-                raise ActionFailed(retcode=result.get('retcode'))
-        return result.get('data')
+def _make_request(action: str, params: Dict[str, Any],
+                  seq: int) -> Dict[str, Any]:
+    return {'action': action, 'params': params, 'echo': {'seq': seq}}
+
+
+def _extract_data(result: Dict[str, Any]) -> Any:
+    if isinstance(result, dict):
+        if result.get('status') == 'failed':
+            raise ActionFailed(retcode=result.get('retcode'))
+    return result.get('data')
 
 
 class SyncApi(Api):
@@ -105,3 +564,11 @@ class SyncApi(Api):
     def call_action(self, action: str, **params) -> Any:
         return sync_wait(coro=self._async_api.call_action(action, **params),
                          loop=self._loop)
+
+    def call_actions(self,
+                     actions: Iterable[Action_T],
+                     *,
+                     return_exceptions: bool = False) -> List[Any]:
+        return sync_wait(coro=self._async_api.call_actions(
+            actions, return_exceptions=return_exceptions),
+                         loop=self._loop)
@@ -1,19 +1,28 @@
-from collections import defaultdict
-from typing import Callable, List, Any
+import asyncio
+from typing import Callable, List, Any, Dict, Set, Tuple
 
-from .utils import run_async_funcs
+# event names come from clients, so the dispatch table must be bounded
+_DISPATCH_TABLE_MAX_SIZE = 1024
 
 
 class EventBus:
     def __init__(self):
-        self._subscribers = defaultdict(set)
+        self._subscribers: Dict[str, Set[Callable]] = {}
+        # key: event name
+        # value: handlers of the event and all its ancestor events
+        self._dispatch_table: Dict[str, Tuple[Callable, ...]] = {}
 
     def subscribe(self, event: str, func: Callable) -> None:
-        self._subscribers[event].add(func)
+        self._subscribers.setdefault(event, set()).add(func)
+        self._dispatch_table.clear()
 
     def unsubscribe(self, event: str, func: Callable) -> None:
-        if func in self._subscribers[event]:
-            self._subscribers[event].remove(func)
+        funcs = self._subscribers.get(event)
+        if funcs and func in funcs:
+            funcs.remove(func)
+            if not funcs:
+                del self._subscribers[event]
+            self._dispatch_table.clear()
 
     def on(self, event: str) -> Callable:
         def decorator(func: Callable) -> Callable:
@@ -22,13 +31,23 @@ class EventBus:
 
         return decorator
 
-    async def emit(self, event: str, *args, **kwargs) -> List[Any]:
-        results = []
+    def _compile(self, event: str) -> Tuple[Callable, ...]:
+        handlers = []
         while True:
-            results += await run_async_funcs(self._subscribers[event],
-                                             *args, **kwargs)
+            handlers.extend(self._subscribers.get(event, ()))
             event, *sub_event = event.rsplit('.', maxsplit=1)
             if not sub_event:
                 # the current event is the root event
                 break
-        return results
+        return tuple(handlers)
+
+    async def emit(self, event: str, *args, **kwargs) -> List[Any]:
+        try:
+            handlers = self._dispatch_table[event]
+        except KeyError:
+            if len(self._dispatch_table) >= _DISPATCH_TABLE_MAX_SIZE:
+                self._dispatch_table.clear()
+            handlers = self._dispatch_table[event] = self._compile(event)
+        if not handlers:
+            return []
+        return await asyncio.gather(*(f(*args, **kwargs) for f in handlers))
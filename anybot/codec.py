@@ -0,0 +1,270 @@
+"""
+序列化与反向 WebSocket 连接的帧编解码器。
+
+JSON 依次优先使用 orjson、ujson、标准库 json，编解码均直接使用 `bytes`。
+
+客户端通过 WebSocket 子协议（``Sec-WebSocket-Protocol``）协商编解码器，
+按客户端给出的顺序选择第一个支持的；未请求或均不支持时使用 JSON 文本帧。
+
+``record`` 消息段的语音在 JSON 帧中为 base64 字符串（``data.base64``），
+在 MessagePack 帧中为原始字节（``data.audio``）。发送时，消息段中的
+`Audio` 对象（``data.audio``）按编解码器转换为相应的格式；接收时，
+编解码器保持线路上的格式，由 `AnyBot` 在构造 ``message_class`` 时转换为
+`Audio` 对象，未设置 ``message_class`` 时统一转换为 ``data.base64``。
+"""
+
+import base64
+import binascii
+import json
+from typing import Any, Union, Iterable, Dict, Optional, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    # MessagePack is not installed
+    msgpack = None
+
+from .message import Audio, Message, MessageSegment
+
+__all__ = [
+    'json_dumps',
+    'json_loads',
+    'Codec',
+    'JsonCodec',
+    'JsonBinaryCodec',
+    'MsgpackCodec',
+    'negotiate_codec',
+]
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, MessageSegment):
+        data = obj.data
+        if obj.type == 'record' and isinstance(data.get('audio'), Audio):
+            data = _audio_to_base64(data)
+        return {'type': obj.type, 'data': data}
+    if isinstance(obj, Message):
+        return list(obj)
+    if isinstance(obj, Audio):
+        return obj.base64
+    raise TypeError(f'Object of type {type(obj).__name__} '
+                    f'is not serializable')
+
+
+def _std_json_dumps(obj: Any) -> bytes:
+    """将对象序列化为 UTF-8 编码的 JSON。"""
+    return json.dumps(obj,
+                      ensure_ascii=False,
+                      separators=(',', ':'),
+                      default=_default).encode()
+
+
+if orjson:
+
+    def json_dumps(obj: Any) -> bytes:
+        """将对象序列化为 UTF-8 编码的 JSON。"""
+        try:
+            return orjson.dumps(obj,
+                                default=_default,
+                                option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which the standard json handles
+            return _std_json_dumps(obj)
+
+    json_loads = orjson.loads
+elif ujson:
+
+    def json_dumps(obj: Any) -> bytes:
+        """将对象序列化为 UTF-8 编码的 JSON。"""
+        return ujson.dumps(obj, ensure_ascii=False,
+                           default=_default).encode()
+
+    json_loads = ujson.loads
+else:
+    json_dumps = _std_json_dumps
+    json_loads = json.loads
+
+
+class Codec:
+    name: str = ''
+    binary: bool = False
+
+    def dumps(self, obj: Any) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        """解码一帧数据，数据无效时抛出 `ValueError`。"""
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """JSON 文本帧编解码器，ASGI 要求文本帧为 `str`。"""
+
+    name = 'json'
+
+    def dumps(self, obj: Any) -> str:
+        return json_dumps(_map_request_messages(obj,
+                                                _records_to_json)).decode()
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return json_loads(data)
+
+
+class JsonBinaryCodec(JsonCodec):
+    """JSON 二进制帧编解码器，序列化结果不经过 `str` 直接发送。"""
+
+    name = 'json.binary'
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return json_dumps(_map_request_messages(obj, _records_to_json))
+
+
+class MsgpackCodec(Codec):
+    """
+    MessagePack 二进制帧编解码器。
+
+    ``record`` 消息段的语音在线路上以原始字节（``data.audio``）传输，
+    而不是 base64 字符串。
+    """
+
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        obj = _map_request_messages(obj, _records_to_wire)
+        return msgpack.packb(obj,
+                             use_bin_type=True,
+                             default=_msgpack_default)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        if not isinstance(data, bytes):
+            raise ValueError('msgpack frame must be binary')
+        try:
+            obj = msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise ValueError(f'invalid msgpack frame: {e}')
+        return obj
+
+
+def _msgpack_default(obj: Any) -> Any:
+    if isinstance(obj, MessageSegment):
+        # record audio is passed to the packer as is, see below
+        return {'type': obj.type, 'data': obj.data}
+    if isinstance(obj, Audio):
+        return obj.raw
+    return _default(obj)
+
+
+def _map_request_messages(obj: Any, convert: Callable[[list], list]) -> Any:
+    """
+    对 API 请求（或批量请求）参数中的消息应用 ``convert``，返回新的请求，
+    不修改原请求。
+    """
+    if isinstance(obj, list):
+        return [_map_request_messages(o, convert) for o in obj]
+    params = obj.get('params') if isinstance(obj, dict) else None
+    if isinstance(params, dict) and isinstance(params.get('message'), list):
+        obj = dict(obj,
+                   params=dict(params, message=convert(params['message'])))
+    return obj
+
+
+def _audio_to_base64(data: Dict[str, Any]) -> Dict[str, Any]:
+    data = dict(data)
+    data['base64'] = data.pop('audio').base64
+    return data
+
+
+def _records_to_json(message: list) -> list:
+    # record segments may be dicts, which the default function can't see
+    result = []
+    for seg in message:
+        if isinstance(seg, MessageSegment):
+            type_, data = seg.type, seg.data
+        elif isinstance(seg, dict):
+            type_, data = seg.get('type'), seg.get('data')
+        else:
+            type_ = data = None
+        if isinstance(data, dict) and type_ == 'record' and \
+                isinstance(data.get('audio'), Audio):
+            seg = {'type': 'record', 'data': _audio_to_base64(data)}
+        result.append(seg)
+    return result
+
+
+def _records_to_wire(message: list) -> list:
+    # plugins may still put base64 strings into record segments
+    result = []
+    for seg in message:
+        if isinstance(seg, MessageSegment):
+            type_, data = seg.type, seg.data
+        elif isinstance(seg, dict):
+            type_, data = seg.get('type'), seg.get('data')
+        else:
+            type_ = data = None
+        if isinstance(data, dict) and type_ == 'record' and \
+                isinstance(data.get('base64'), str):
+            data = dict(data)
+            try:
+                data['audio'] = base64.b64decode(data.pop('base64'))
+            except binascii.Error:
+                result.append(seg)
+                continue
+            seg = {'type': 'record', 'data': data}
+        result.append(seg)
+    return result
+
+
+def _records_from_wire(message: Any, *, to_audio: bool) -> None:
+    """
+    原地转换接收到的消息中 ``record`` 消息段的语音。
+
+    ``to_audio`` 为真时，将 ``data.base64`` 或 ``data.audio`` 替换为
+    ``data.audio`` 中的 `Audio` 对象，不进行解码或编码；否则将 MessagePack
+    帧中的原始字节转换为 ``data.base64`` 中的 base64 字符串。
+    """
+    if not isinstance(message, list):
+        return
+    for seg in message:
+        data = seg.get('data') if isinstance(seg, dict) else None
+        if not isinstance(data, dict) or seg.get('type') != 'record':
+            continue
+        if to_audio:
+            if isinstance(data.get('base64'), str):
+                data['audio'] = Audio(base64=data.pop('base64'))
+            elif isinstance(data.get('audio'), bytes):
+                data['audio'] = Audio(data['audio'])
+        elif isinstance(data.get('audio'), bytes):
+            data['base64'] = base64.b64encode(data.pop('audio')).decode()
+
+
+_codecs: Dict[str, Codec] = {
+    JsonCodec.name: JsonCodec(),
+    JsonBinaryCodec.name: JsonBinaryCodec(),
+}
+if msgpack:
+    _codecs[MsgpackCodec.name] = MsgpackCodec()
+
+default_codec = _codecs[JsonCodec.name]
+
+
+def negotiate_codec(subprotocols: Iterable[str]) -> Optional[Codec]:
+    """
+    根据客户端请求的子协议选择编解码器，没有支持的子协议时返回 `None`。
+    """
+    for protocol in subprotocols:
+        codec = _codecs.get(protocol)
+        if codec:
+            return codec
+    return None
@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Dict
+
+__all__ = [
+    'Deduplicator',
+]
+
+
+class Deduplicator:
+    """
+    有界的时间窗口去重集合。
+
+    最多记住 ``maxsize`` 个键，每个键在 ``window`` 秒内有效
+    （为 `None` 时仅受 ``maxsize`` 限制）。检查和插入的时间复杂度均为 O(1)。
+    """
+
+    def __init__(self, maxsize: int, window: Optional[float] = None):
+        self._maxsize = maxsize
+        self._window = window
+        # keys in order of their last insertion, so the oldest comes first
+        self._seen: 'OrderedDict[Hashable, float]' = OrderedDict()
+        self.hits = 0
+
+    def check(self, key: Hashable) -> bool:
+        """检查键是否在窗口内出现过，并记录本次出现。返回是否重复。"""
+        now = time.monotonic()
+        seen_at = self._seen.get(key)
+        if seen_at is not None and \
+                (self._window is None or now - seen_at <= self._window):
+            self.hits += 1
+            return True
+
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        self._evict(now)
+        return False
+
+    def _evict(self, now: float) -> None:
+        seen = self._seen
+        while len(seen) > self._maxsize:
+            seen.popitem(last=False)
+        if self._window is not None:
+            while seen:
+                key, seen_at = next(iter(seen.items()))
+                if now - seen_at <= self._window:
+                    break
+                del seen[key]
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self._seen), 'hits': self.hits}
@@ -0,0 +1,256 @@
+import asyncio
+import logging
+from collections import deque
+from typing import (Callable, Awaitable, Dict, Any, Optional, Tuple, List,
+                    Deque)
+
+__all__ = [
+    'OVERFLOW_DROP_OLDEST',
+    'OVERFLOW_DROP_NEWEST',
+    'OVERFLOW_BLOCK',
+    'EventQueue',
+]
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_BLOCK = 'block'
+
+_OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST,
+                      OVERFLOW_BLOCK)
+
+
+class _Lane:
+    __slots__ = ('priority', 'items', 'limit', 'running')
+
+    def __init__(self, priority: int, limit: Optional[int]):
+        self.priority = priority
+        # value: (enqueue time, payload)
+        self.items: Deque[Tuple[float, Dict[str, Any]]] = deque()
+        # max number of events of this lane being handled at the same time
+        self.limit = limit
+        self.running = 0
+
+    def is_ready(self) -> bool:
+        return bool(self.items) and \
+            (self.limit is None or self.running < self.limit)
+
+
+class EventQueue:
+    """
+    单个智能音箱连接的有界事件队列，由固定数量的 worker 消费。
+
+    事件按 ``priorities`` 分入不同优先级的通道，键为事件类型（如
+    ``meta_event``）或事件名（如 ``message.private``），值为优先级，
+    数值越小越优先，未列出的事件优先级为 0。worker 总是先处理优先级高的
+    通道；``lane_concurrency`` 可限制某一优先级同时处理的事件数，
+    使其余 worker 始终可以处理更高优先级的事件。
+
+    ``maxsize`` 为每个通道的容量，通道满时的行为由 ``overflow`` 决定：
+
+    - ``drop_oldest``：丢弃该通道队首（最旧）的事件
+    - ``drop_newest``：丢弃新到达的事件
+    - ``block``：阻塞连接的读取，直到该通道有空位；注意此时该连接上的
+      API 调用结果也无法被读取
+
+    若设置了 ``max_age``（秒），在队列中等待超过该时长的事件会被丢弃。
+
+    关闭服务时，应先调用 `drain` 等待已接受的事件处理完毕，再调用 `close`；
+    等待超时则调用 `cancel` 取消仍在处理的事件。
+    """
+
+    def __init__(self,
+                 handler: Callable[[Dict[str, Any]], Awaitable[Any]],
+                 *,
+                 maxsize: int = 100,
+                 overflow: str = OVERFLOW_DROP_OLDEST,
+                 max_age: Optional[float] = None,
+                 workers: int = 4,
+                 priorities: Optional[Dict[str, int]] = None,
+                 lane_concurrency: Optional[Dict[int, int]] = None,
+                 logger: Optional[logging.Logger] = None):
+        if overflow not in _OVERFLOW_POLICIES:
+            raise ValueError(f'unknown overflow policy "{overflow}"')
+        if workers < 1:
+            raise ValueError('the number of workers must be positive')
+        if lane_concurrency and min(lane_concurrency.values()) < 1:
+            raise ValueError('the lane concurrency must be positive')
+
+        self._handler = handler
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._max_age = max_age
+        self._priorities = priorities or {}
+        self._lane_concurrency = lane_concurrency or {}
+        self._logger = logger or logging.getLogger(__name__)
+
+        # lanes sorted by priority, created on demand
+        self._lanes: List[_Lane] = []
+        self._lanes_by_priority: Dict[int, _Lane] = {}
+        # key: (type, detail_type), value: lane
+        self._lane_cache: Dict[Tuple[Any, Any], _Lane] = {}
+        self._ready = asyncio.Event()
+        self._not_full = asyncio.Event()
+        # set whenever a worker finishes an event
+        self._done = asyncio.Event()
+        self._draining = False
+        self._closed = False
+        self._workers = [
+            asyncio.ensure_future(self._work()) for _ in range(workers)
+        ]
+
+        self.received = 0
+        self.handled = 0
+        self.dropped_overflow = 0
+        self.dropped_stale = 0
+
+    @property
+    def depth(self) -> int:
+        """当前排队（尚未开始处理）的事件数。"""
+        return sum(len(lane.items) for lane in self._lanes)
+
+    @property
+    def running(self) -> int:
+        """当前正在处理的事件数。"""
+        return sum(lane.running for lane in self._lanes)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'depth': self.depth,
+            'running': self.running,
+            'received': self.received,
+            'handled': self.handled,
+            'dropped_overflow': self.dropped_overflow,
+            'dropped_stale': self.dropped_stale,
+            'lanes': {
+                lane.priority: {
+                    'depth': len(lane.items),
+                    'running': lane.running,
+                }
+                for lane in self._lanes
+            },
+        }
+
+    def _get_lane(self, payload: Dict[str, Any]) -> _Lane:
+        key = (payload.get('type'), payload.get('detail_type'))
+        lane = self._lane_cache.get(key)
+        if lane:
+            return lane
+
+        priority = self._priorities.get(f'{key[0]}.{key[1]}')
+        if priority is None:
+            priority = self._priorities.get(str(key[0]), 0)
+        lane = self._lanes_by_priority.get(priority)
+        if not lane:
+            lane = _Lane(priority, self._lane_concurrency.get(priority))
+            self._lanes_by_priority[priority] = lane
+            self._lanes.append(lane)
+            self._lanes.sort(key=lambda l: l.priority)
+        if len(self._lane_cache) < 256:
+            # don't let arbitrary event types from the client grow it
+            self._lane_cache[key] = lane
+        return lane
+
+    def _is_full(self, lane: _Lane) -> bool:
+        return 0 < self._maxsize <= len(lane.items)
+
+    async def put(self, payload: Dict[str, Any]) -> bool:
+        """将事件放入队列，返回事件是否被接受。"""
+        if self._closed or self._draining:
+            return False
+        self.received += 1
+
+        lane = self._get_lane(payload)
+        if self._is_full(lane):
+            if self._overflow == OVERFLOW_DROP_NEWEST:
+                self.dropped_overflow += 1
+                return False
+            elif self._overflow == OVERFLOW_DROP_OLDEST:
+                lane.items.popleft()
+                self.dropped_overflow += 1
+            else:
+                while self._is_full(lane) and not self._closed and \
+                        not self._draining:
+                    self._not_full.clear()
+                    await self._not_full.wait()
+                if self._closed or self._draining:
+                    return False
+
+        lane.items.append((asyncio.get_running_loop().time(), payload))
+        self._ready.set()
+        return True
+
+    def _take(self) -> Optional[Tuple[_Lane, float, Dict[str, Any]]]:
+        for lane in self._lanes:
+            if lane.is_ready():
+                enqueued_at, payload = lane.items.popleft()
+                self._not_full.set()
+                return lane, enqueued_at, payload
+        return None
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._closed:
+            item = self._take()
+            if item is None:
+                # nothing to handle, or the ready lanes are at their limits
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            lane, enqueued_at, payload = item
+            if self._max_age is not None and \
+                    loop.time() - enqueued_at > self._max_age:
+                self.dropped_stale += 1
+                self._done.set()
+                continue
+
+            lane.running += 1
+            try:
+                await self._handler(payload)
+            except Exception as e:
+                self._logger.error('An exception occurred while '
+                                   'handling event:')
+                self._logger.exception(e)
+            finally:
+                lane.running -= 1
+                if lane.items:
+                    # the lane may have been waiting for this slot
+                    self._ready.set()
+                self._done.set()
+            self.handled += 1
+
+    async def drain(self) -> None:
+        """
+        停止接受新事件（`put` 返回 `False`），并等待已排队和正在处理的
+        事件全部处理完毕。
+        """
+        self._draining = True
+        # wake up the puts blocked on full lanes, they'll be rejected
+        self._not_full.set()
+        while not self._closed and (self.depth or self.running):
+            self._done.clear()
+            await self._done.wait()
+
+    def close(self) -> None:
+        """
+        关闭队列，丢弃尚未开始处理的事件，正在处理的事件会继续执行完毕。
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for lane in self._lanes:
+            lane.items.clear()
+        self._ready.set()
+        self._not_full.set()
+        self._done.set()
+
+    async def cancel(self, timeout: Optional[float] = None) -> None:
+        """
+        关闭队列，并取消正在处理的事件，等待 worker 退出，最多等待
+        ``timeout`` 秒。
+        """
+        self.close()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.wait(self._workers, timeout=timeout)
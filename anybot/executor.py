@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial, wraps
+from typing import Any, Callable, Awaitable, Dict, Optional
+
+__all__ = [
+    'HandlerExecutor',
+]
+
+
+class HandlerExecutor:
+    """
+    运行同步事件处理函数的专用线程池，与 asyncio 默认 executor 隔离。
+
+    最多有 ``max_workers`` 个函数同时运行、``queue_size`` 个函数排队，
+    超出时调用方（异步地）等待，从而将压力传导回事件队列。
+    """
+
+    def __init__(self,
+                 max_workers: Optional[int] = None,
+                 queue_size: int = 100,
+                 *,
+                 thread_name_prefix: str = 'anybot-handler'):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix=thread_name_prefix)
+        # noinspection PyProtectedMember
+        self.max_workers = self._pool._max_workers
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_num = self.max_workers + queue_size
+        # guards the counters updated in worker threads
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.running = 0
+        self.queued = 0  # submitted to the pool but not started yet
+        self.waiting = 0  # waiting for a free slot to submit
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.run_time_total = 0.0
+        self.run_time_max = 0.0
+
+    def wrap(self, func: Callable[..., Any]) -> Callable[..., Awaitable[Any]]:
+        """将同步函数包装为在此线程池中运行的异步函数。"""
+        @wraps(func)
+        async def wrapper(*args, **kwargs) -> Any:
+            return await self.run(func, *args, **kwargs)
+
+        return wrapper
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._slots_num)
+
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            with self._lock:
+                self.submitted += 1
+                self.queued += 1
+            submitted_at = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._pool, copy_context().run,
+                partial(self._run_in_thread, submitted_at, func, *args,
+                        **kwargs))
+        finally:
+            self._slots.release()
+
+    def _run_in_thread(self, submitted_at: float, func: Callable[..., Any],
+                       *args, **kwargs) -> Any:
+        started_at = time.perf_counter()
+        queue_wait = started_at - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            run_time = time.perf_counter() - started_at
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.run_time_total += run_time
+                self.run_time_max = max(self.run_time_max, run_time)
+
+    @property
+    def saturation(self) -> float:
+        """正在运行的函数数与线程数之比。"""
+        return self.running / self.max_workers
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'max_workers': self.max_workers,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'running': self.running,
+            'queued': self.queued,
+            'waiting': self.waiting,
+            'saturation': self.saturation,
+            'queue_wait_total': self.queue_wait_total,
+            'queue_wait_max': self.queue_wait_max,
+            'run_time_total': self.run_time_total,
+            'run_time_max': self.run_time_max,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
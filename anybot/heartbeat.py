@@ -0,0 +1,144 @@
+"""
+反向 WebSocket 连接的心跳与往返时延（RTT）测量。
+
+服务端定期向智能音箱发送 ``heartbeat`` API 请求，智能音箱返回任何带有相同
+``echo`` 的结果（包括 ``status`` 为 ``failed`` 的结果）都视为一次心跳响应。
+在一个心跳周期内收到该连接上的任何帧也视为连接存活。连续多次未响应的连接
+被认为已断开（例如半开的 TCP 连接），会被立即移除。
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, TYPE_CHECKING
+
+from .exceptions import NetworkError
+from .utils import percentile
+
+if TYPE_CHECKING:
+    from .api_impl import Connection
+
+__all__ = [
+    'HEARTBEAT_ACTION',
+    'RttEstimator',
+    'Heartbeat',
+]
+
+HEARTBEAT_ACTION = 'heartbeat'
+
+# smoothing factor of the RTT estimate, same as TCP (RFC 6298)
+_SRTT_ALPHA = 1 / 8
+
+
+class RttEstimator:
+    """
+    单个连接的滚动 RTT 估计，保存最近 ``window`` 个样本用于计算百分位数。
+    """
+
+    __slots__ = ('_samples', 'srtt', 'missed')
+
+    def __init__(self, window: int = 100):
+        self._samples: Deque[float] = deque(maxlen=window)
+        # smoothed rtt in seconds, None if there is no sample yet
+        self.srtt: Optional[float] = None
+        # number of consecutive missed heartbeats
+        self.missed = 0
+
+    def add(self, rtt: float) -> None:
+        self._samples.append(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += _SRTT_ALPHA * (rtt - self.srtt)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """计算最近样本的 ``p`` 百分位数（最近秩法），没有样本时返回 `None`。"""
+        return percentile(sorted(self._samples), p)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    @property
+    def stats(self) -> Dict[str, Optional[float]]:
+        """RTT 统计，时间单位为秒。"""
+        samples = sorted(self._samples)
+        return {
+            'samples': len(samples),
+            'srtt': self.srtt,
+            'p50': percentile(samples, 50),
+            'p90': percentile(samples, 90),
+            'p99': percentile(samples, 99),
+            'max': samples[-1] if samples else None,
+            'missed': self.missed,
+        }
+
+
+class Heartbeat:
+    """
+    单个连接的心跳任务，每 ``interval`` 秒发送一次心跳请求，
+    连续 ``max_missed`` 次未响应时调用 ``on_dead``。
+    """
+
+    def __init__(self,
+                 conn: 'Connection',
+                 interval: float,
+                 *,
+                 max_missed: int = 3,
+                 on_dead: Callable[['Connection'], None],
+                 logger: Optional[logging.Logger] = None):
+        if interval <= 0:
+            raise ValueError('the heartbeat interval must be positive')
+        if max_missed < 1:
+            raise ValueError('the max missed heartbeats must be positive')
+
+        self._conn = conn
+        self._interval = interval
+        self._max_missed = max_missed
+        self._on_dead = on_dead
+        self._logger = logger or logging.getLogger(__name__)
+        self._task: Optional[asyncio.Task] = None
+        self.dead = False
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        conn = self._conn
+        # the connection has just been established
+        await asyncio.sleep(self._interval)
+        while True:
+            sent_at = loop.time()
+            try:
+                await conn.request(HEARTBEAT_ACTION, {}, self._interval)
+            except NetworkError:
+                if conn.closed:
+                    return
+                replied = False
+            else:
+                replied = True
+            now = loop.time()
+
+            if replied:
+                conn.rtt.add(now - sent_at)
+                conn.rtt.missed = 0
+            elif conn.last_received >= sent_at:
+                # the speaker is not replying to heartbeats,
+                # but it is still sending something
+                conn.rtt.missed = 0
+            else:
+                conn.rtt.missed += 1
+                self._logger.warning(f'speaker {conn.self_id} missed '
+                                     f'{conn.rtt.missed} heartbeat(s)')
+                if conn.rtt.missed >= self._max_missed:
+                    self.dead = True
+                    self._on_dead(conn)
+                    return
+
+            await asyncio.sleep(max(sent_at + self._interval - now, 0))
@@ -1,5 +1,11 @@
+import base64
 import re
-from typing import Iterable, Dict, Tuple, Any, Optional
+from typing import (Iterable, Iterator, Dict, Tuple, Any, Optional, Union,
+                    List)
+
+_TYPE_RE = re.compile(r'[a-zA-Z0-9-_.]+')
+# a comma that is not followed by a param key
+_BAD_COMMA_RE = re.compile(r',(?![a-zA-Z0-9-_.])')
 
 
 def escape(s: str, *, escape_comma: bool = True) -> str:
@@ -18,12 +24,109 @@ def escape(s: str, *, escape_comma: bool = True) -> str:
 
 def unescape(s: str) -> str:
     """对字符串进行 MT 码去转义。"""
+    if '&' not in s:
+        return s
     return s.replace('&#44;', ',') \
         .replace('&#91;', '[') \
         .replace('&#93;', ']') \
         .replace('&amp;', '&')
 
 
+def _iter_mt_codes(s: str) -> Iterator[Tuple[int, int, str, str]]:
+    """
+    依次查找字符串中的 MT 码，产生 ``(开始位置, 结束位置, 类型, 参数)``，
+    参数为去掉首尾逗号的 ``k=v,k=v`` 形式。
+
+    MT 码形如 ``[MT:type,k=v,k=v]``，其中的每个逗号后面都是参数名（最后
+    一个逗号可以直接跟 ``]``），且不含 ``]``，因此总是在其后第一个 ``]``
+    处结束。共用同一个 ``]`` 的候选位置只需扫描一次，对未闭合或不合法的
+    MT 码也只需线性时间。
+    """
+    pos = 0
+    close = -1
+    last_bad = -1  # position of the last bad comma before close
+    while True:
+        start = s.find('[MT:', pos)
+        if start < 0:
+            return
+        if start > close:
+            close = s.find(']', start)
+            if close < 0:
+                # nothing after here can be closed
+                return
+            last_bad = -1
+            for m in _BAD_COMMA_RE.finditer(s, start, close):
+                if m.start() < close - 1:
+                    # a comma right before "]" is allowed
+                    last_bad = m.start()
+
+        m = _TYPE_RE.match(s, start + 4, close)
+        if m and last_bad < m.end() and \
+                (m.end() == close or s[m.end()] == ','):
+            params = s[m.end() + 1:close]
+            if params.endswith(','):
+                params = params[:-1]
+            yield start, close + 1, m.group(), params
+            pos = close + 1
+        else:
+            pos = start + 1
+
+
+class Audio:
+    """
+    语音数据，以原始字节（可为 `memoryview`）或 base64 字符串之一保存，
+    另一种形式在首次访问时转换并缓存。
+
+    转换为字符串（如 MT 码和日志中）时只显示大小，语音只在发送时写入帧。
+    """
+
+    __slots__ = ('_raw', '_base64')
+
+    def __init__(self,
+                 raw: Union[bytes, bytearray, memoryview, None] = None,
+                 *,
+                 base64: Optional[str] = None):
+        if raw is None and base64 is None:
+            raise ValueError('either raw or base64 must be given')
+        self._raw = raw
+        self._base64 = base64
+
+    @property
+    def raw(self) -> Union[bytes, bytearray, memoryview]:
+        """原始字节，base64 无效时抛出 `ValueError`。"""
+        if self._raw is None:
+            self._raw = base64.b64decode(self._base64)
+        return self._raw
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self._raw).decode('ascii')
+        return self._base64
+
+    @property
+    def size(self) -> int:
+        """字节数，只有 base64 时由其长度推算，不进行解码。"""
+        if self._raw is not None:
+            return memoryview(self._raw).nbytes
+        s = self._base64
+        return len(s) * 3 // 4 - s[-2:].count('=')
+
+    def __eq__(self, other):
+        if not isinstance(other, Audio):
+            return False
+        if self is other:
+            return True
+        if self._base64 is not None and other._base64 is not None:
+            return self._base64 == other._base64
+        return self.raw == other.raw
+
+    def __repr__(self):
+        return f'<audio {self.size} bytes>'
+
+    __str__ = __repr__
+
+
 def _b2s(b: bool):
     if b:
         return 'true'
@@ -31,9 +134,10 @@ def _b2s(b: bool):
         return 'false'
 
 
-class MessageSegment(dict):
+class MessageSegment:
     """
-    消息段，即表示成字典的 MT 码。
+    消息段，即表示成对象的 MT 码，包含 ``type`` 和 ``data`` 两个属性，
+    发送时序列化为 ``{"type": ..., "data": {...}}`` 形式的字典。
 
     不建议手动构造消息段；建议使用此类的静态方法构造，例如：
 
@@ -47,60 +151,71 @@ class MessageSegment(dict):
     assert at_seg == MessageSegment.at(10001000)
     msg: Message = at_seg + MessageSegment.face(14)
     ```
+
+    转换成的 MT 码会被缓存，直到消息段的类型或数据发生变化。
     """
 
+    __slots__ = ('type', '_data', '_str_cache')
+
     def __init__(self,
-                 d: Optional[Dict[str, Any]] = None,
+                 d: Union[Dict[str, Any], 'MessageSegment', None] = None,
                  *,
                  type_: Optional[str] = None,
                  data: Optional[Dict[str, str]] = None):
-        super().__init__()
-        if isinstance(d, dict) and d.get('type'):
-            self.update(d)
-        elif type_:
-            self.type = type_
-            self.data = data
-        else:
+        if isinstance(d, MessageSegment):
+            type_, data = d.type, d.data
+        elif isinstance(d, dict) and d.get('type'):
+            type_, data = d['type'], d.get('data')
+        elif not type_:
             raise ValueError('the "type" field cannot be None or empty')
+        self.type: str = type_
+        self._data: Dict[str, Any] = data or {}
+        # (type and data items the MT code is made from, the MT code)
+        self._str_cache: Optional[Tuple[tuple, str]] = None
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        return self._data
+
+    @data.setter
+    def data(self, data: Optional[Dict[str, Any]]) -> None:
+        self._data = data or {}
+
+    # for the code written when this class was a dict, e.g. dict(seg)
+    def keys(self) -> Tuple[str, str]:
+        return 'type', 'data'
 
     def __getitem__(self, item):
         if item not in ('type', 'data'):
             raise KeyError(f'the key "{item}" is not allowed')
-        return super().__getitem__(item)
+        return getattr(self, item)
 
     def __setitem__(self, key, value):
         if key not in ('type', 'data'):
             raise KeyError(f'the key "{key}" is not allowed')
-        return super().__setitem__(key, value)
-
-    def __delitem__(self, key):
-        raise NotImplementedError
-
-    @property
-    def type(self) -> str:
-        return self['type']
+        setattr(self, key, value)
 
-    @type.setter
-    def type(self, type_: str):
-        self['type'] = type_
-
-    @property
-    def data(self) -> Dict[str, str]:
-        return self['data']
-
-    @data.setter
-    def data(self, data: Optional[Dict[str, str]]):
-        self['data'] = data or {}
+    def __repr__(self):
+        return repr({'type': self.type, 'data': self.data})
 
     def __str__(self):
-        if self.type == 'text':
-            return escape(self.data.get('text', ''), escape_comma=False)
+        # the data dict may be modified in place, so compare the items,
+        # which is cheap for the unchanged values (the same objects)
+        key = (self.type, tuple(self.data.items()))
+        cache = self._str_cache
+        if cache is not None and cache[0] == key:
+            return cache[1]
 
-        params = ','.join(
-            ('{}={}'.format(k, escape(str(v))) for k, v in self.data.items()))
-        if params:
-            params = ',' + params
-        return '[MT:{type}{params}]'.format(type=self.type, params=params)
+        if self.type == 'text':
+            s = escape(self.data.get('text', ''), escape_comma=False)
+        else:
+            params = ','.join(('{}={}'.format(k, escape(str(v)))
+                               for k, v in self.data.items()))
+            if params:
+                params = ',' + params
+            s = '[MT:{type}{params}]'.format(type=self.type, params=params)
+        self._str_cache = (key, s)
+        return s
 
     def __eq__(self, other):
         if not isinstance(other, MessageSegment):
@@ -122,6 +237,15 @@ class MessageSegment(dict):
             'file': file,
         })
 
+    @staticmethod
+    def record_audio(audio: Union[Audio, bytes]) -> 'MessageSegment':
+        """语音，``audio`` 为语音数据或 wav 格式的原始字节。"""
+        if not isinstance(audio, Audio):
+            audio = Audio(audio)
+        return MessageSegment(type_='record', data={
+            'audio': audio,
+        })
+
 
 class Message(list):
     """
@@ -134,43 +258,39 @@ class Message(list):
         try:
             if isinstance(msg, (list, str)):
                 self.extend(msg)
-            elif isinstance(msg, dict):
+            elif isinstance(msg, (dict, MessageSegment)):
                 self.append(msg)
         except ValueError:
             raise ValueError('the msg argument is not recognizable')
 
     @staticmethod
     def _split_iter(msg_str: str) -> Iterable[MessageSegment]:
-        def iter_function_name_and_extra() -> Iterable[Tuple[str, str]]:
-            text_begin = 0
-            for code in re.finditer(
-                    r'\[MT:(?P<type>[a-zA-Z0-9-_.]+)'
-                    r'(?P<params>'
-                    r'(?:,[a-zA-Z0-9-_.]+=?[^,\]]*)*'
-                    r'),?\]', msg_str):
-                yield (
-                    'text',
-                    unescape(msg_str[text_begin:code.pos + code.start()])
-                )
-                text_begin = code.pos + code.end()
-                yield code.group('type'), code.group('params').lstrip(',')
-            yield 'text', unescape(msg_str[text_begin:])
-
-        for function_name, extra in iter_function_name_and_extra():
-            if function_name == 'text':
-                if extra:
-                    # only yield non-empty text segment
-                    yield MessageSegment(type_=function_name,
-                                         data={'text': extra})
-            else:
-                data = {
-                    k: v
-                    for k, v in map(
-                        lambda x: x.split('=', maxsplit=1),
-                        filter(lambda x: x, (x.lstrip()
-                                             for x in extra.split(','))))
-                }
-                yield MessageSegment(type_=function_name, data=data)
+        if '[MT:' not in msg_str:
+            # plain text
+            if msg_str:
+                yield MessageSegment(type_='text',
+                                     data={'text': unescape(msg_str)})
+            return
+
+        text_begin = 0
+        for start, end, type_, params in _iter_mt_codes(msg_str):
+            if start > text_begin:
+                # only yield non-empty text segment
+                yield MessageSegment(
+                    type_='text',
+                    data={'text': unescape(msg_str[text_begin:start])})
+            text_begin = end
+
+            data = {}
+            if params:
+                for param in params.split(','):
+                    k, v = param.split('=', maxsplit=1)
+                    data[k] = v
+            yield MessageSegment(type_=type_, data=data)
+
+        if text_begin < len(msg_str):
+            yield MessageSegment(type_='text',
+                                 data={'text': unescape(msg_str[text_begin:])})
 
     def __str__(self):
         return ''.join((str(seg) for seg in self))
@@ -208,30 +328,51 @@ class Message(list):
 
     def extend(self, msg: Any) -> Any:
         """在消息末尾追加消息（字符串或消息段列表）。"""
+        # same as appending one by one, but adjacent texts are joined once
+        # instead of being concatenated to the last segment repeatedly
+        texts = []  # to be merged into the last segment
         try:
             if isinstance(msg, str):
                 msg = self._split_iter(msg)
 
             for seg in msg:
-                self.append(seg)
+                if not isinstance(seg, MessageSegment):
+                    seg = MessageSegment(seg)
+                if self and self[-1].type == 'text' and seg.type == 'text':
+                    texts.append(seg.data['text'])
+                    continue
+                if texts:
+                    self[-1].data['text'] += ''.join(texts)
+                    texts.clear()
+                if seg.type != 'text' or seg.data['text'] or not self:
+                    super().append(seg)
             return self
         except ValueError:
             raise ValueError('the object is not a valid message')
+        finally:
+            if texts:
+                self[-1].data['text'] += ''.join(texts)
 
     def reduce(self) -> None:
         """
         化简消息，即去除多余消息段、合并相邻纯文本消息段。
 
-        由于 `Message` 类基于 `list`，此方法时间复杂度为 O(n)。
+        此方法时间复杂度为 O(n)。
         """
-        idx = 0
-        while idx < len(self):
-            if idx > 0 and \
-                    self[idx - 1].type == 'text' and self[idx].type == 'text':
-                self[idx - 1].data['text'] += self[idx].data['text']
-                del self[idx]
-            else:
-                idx += 1
+        reduced = []
+        texts = []  # to be merged into the last segment of reduced
+        for seg in self:
+            if seg.type == 'text' and reduced and reduced[-1].type == 'text':
+                texts.append(seg.data['text'])
+                continue
+            if texts:
+                reduced[-1].data['text'] += ''.join(texts)
+                texts.clear()
+            reduced.append(seg)
+        if texts:
+            reduced[-1].data['text'] += ''.join(texts)
+        if len(reduced) < len(self):
+            self[:] = reduced
 
     def extract_plain_text(self, reduce: bool = False) -> str:
         """
@@ -242,10 +383,102 @@ class Message(list):
         if reduce:
             self.reduce()
 
-        result = ''
-        for seg in self:
-            if seg.type == 'text':
-                result += ' ' + seg.data['text']
-        if result:
-            result = result[1:]
-        return result
+        return ' '.join(seg.data['text'] for seg in self if seg.type == 'text')
+
+
+class ParsedMessage:
+    """
+    消息的各种形式，在首次访问时计算并缓存，使同一条消息在命令、自然语言
+    处理、参数过滤器等各阶段只需解析一次：
+
+    - ``raw``：MT 码字符串
+    - ``message``：`Message` 对象
+    - ``text``：所有纯文本消息段，中间用空格分隔（同 `Message.extract_plain_text`）
+    - ``text_length``：``text`` 的长度
+    - ``images``：图片 URL 列表
+    - ``normalized``：去除首尾空白、并将连续空白合并为一个空格的 ``text``
+
+    不含 MT 码的字符串不会被构造成 `Message` 对象。缓存的结果不会随消息的
+    原地修改而更新。
+    """
+
+    __slots__ = ('_source', '_raw', '_message', '_text', '_images',
+                 '_normalized')
+
+    def __init__(self, msg: Any):
+        """``msg`` 参数为字符串、`Message` 对象或其它可转换为消息的对象。"""
+        self._source = msg
+        self._raw: Optional[str] = msg if isinstance(msg, str) else None
+        self._message: Optional[Message] = None
+        if isinstance(msg, Message):
+            self._message = msg
+        elif self._raw is None:
+            self._message = Message(msg)
+        self._text: Optional[str] = None
+        self._images: Optional[List[str]] = None
+        self._normalized: Optional[str] = None
+
+    @staticmethod
+    def of(event: Dict[str, Any]) -> 'ParsedMessage':
+        """
+        获取事件当前消息的 `ParsedMessage`，保存在事件对象上，直到事件的
+        ``message`` 字段被替换为另一个对象。
+        """
+        msg = event.get('message')
+        parsed = getattr(event, '_parsed_message', None)
+        if parsed is None or parsed._source is not msg:
+            parsed = ParsedMessage(msg)
+            try:
+                # an attribute, so that it's not a part of the event payload
+                event._parsed_message = parsed
+            except AttributeError:
+                # a plain dict, don't cache it
+                pass
+        return parsed
+
+    def _has_segments(self) -> bool:
+        # whether there may be segments other than one text segment
+        return self._message is not None or '[MT:' in self._raw
+
+    @property
+    def raw(self) -> str:
+        if self._raw is None:
+            self._raw = str(self._message)
+        return self._raw
+
+    @property
+    def message(self) -> Message:
+        if self._message is None:
+            self._message = Message(self._raw)
+        return self._message
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            if self._has_segments():
+                self._text = self.message.extract_plain_text()
+            else:
+                self._text = unescape(self._raw)
+        return self._text
+
+    @property
+    def text_length(self) -> int:
+        return len(self.text)
+
+    @property
+    def images(self) -> List[str]:
+        if self._images is None:
+            if self._has_segments():
+                self._images = [
+                    s.data['url'] for s in self.message
+                    if s.type == 'image' and 'url' in s.data
+                ]
+            else:
+                self._images = []
+        return self._images
+
+    @property
+    def normalized(self) -> str:
+        if self._normalized is None:
+            self._normalized = ' '.join(self.text.split())
+        return self._normalized
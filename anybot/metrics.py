@@ -0,0 +1,258 @@
+"""
+内置的指标注册表，以 Prometheus 文本格式导出。
+
+指标在模块级别定义并注册到默认注册表 `registry`，热路径上应使用预先绑定
+标签的子指标（`labels` 的返回值），避免每次记录时查找或分配。需要在抓取时
+才计算的值（如连接数、队列深度）应使用 `Gauge.set_function`，不占用热路径。
+
+多进程 worker 模式下，每个 worker 进程拥有各自的注册表。
+"""
+
+import math
+from bisect import bisect_left
+from typing import (Callable, Dict, Iterable, Optional, Sequence, Tuple,
+                    Union)
+
+__all__ = [
+    'Registry',
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'registry',
+    'CONTENT_TYPE',
+]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+LabelValues_T = Tuple[str, ...]
+# (metric name suffix, label values, extra label, value)
+_Sample_T = Tuple[str, LabelValues_T, Optional[Tuple[str, str]], float]
+_GaugeFunc_T = Callable[[], Union[float, Iterable[Tuple[LabelValues_T,
+                                                        float]]]]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, '_Metric'] = {}
+
+    def register(self, metric: '_Metric') -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f'duplicate metric "{metric.name}"')
+        self._metrics[metric.name] = metric
+
+    def unregister(self, metric: '_Metric') -> None:
+        if self._metrics.get(metric.name) is metric:
+            del self._metrics[metric.name]
+
+    def get(self, name: str) -> Optional['_Metric']:
+        return self._metrics.get(name)
+
+    def exposition(self) -> str:
+        """以 Prometheus 文本格式导出所有指标。"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} '
+                         f'{_escape_help(metric.documentation)}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, values, extra, value in metric.collect():
+                labels = list(zip(metric.labelnames, values))
+                if extra:
+                    labels.append(extra)
+                label_str = ','.join(f'{k}="{_escape_label(str(v))}"'
+                                     for k, v in labels)
+                if label_str:
+                    label_str = '{' + label_str + '}'
+                lines.append(f'{metric.name}{suffix}{label_str} '
+                             f'{_format_value(value)}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 *,
+                 registry: Optional[Registry] = registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[LabelValues_T, object] = {}
+        if not self.labelnames:
+            self._children[()] = self._make_child()
+        if registry is not None:
+            registry.register(self)
+
+    def _make_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """返回给定标签值的子指标，应在热路径之外调用并保存其结果。"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'expected labels {self.labelnames}, '
+                                 f'got {values}')
+            child = self._children[values] = self._make_child()
+        return child
+
+    def collect(self) -> Iterable[_Sample_T]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _make_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self._children[()].inc(amount)
+
+    def collect(self) -> Iterable[_Sample_T]:
+        for values, child in self._children.items():
+            yield '_total', values, None, child.value
+
+
+class _GaugeChild:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._func: Optional[_GaugeFunc_T] = None
+
+    def _make_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self._children[()].set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        self._children[()].inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self._children[()].dec(amount)
+
+    def set_function(self, func: Optional[_GaugeFunc_T]) -> None:
+        """
+        设置在抓取时计算指标值的函数，替代通过 `set` 等方法设置的值。
+
+        没有标签的指标，函数返回数值；有标签的指标，函数返回
+        ``(标签值, 数值)`` 的可迭代对象。
+        """
+        self._func = func
+
+    def collect(self) -> Iterable[_Sample_T]:
+        if self._func is None:
+            for values, child in self._children.items():
+                yield '', values, None, child.value
+        elif self.labelnames:
+            for values, value in self._func():
+                yield '', tuple(values), None, value
+        else:
+            yield '', (), None, self._func()
+
+
+class _HistogramChild:
+    __slots__ = ('_bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._bounds = bounds
+        # the last one is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self._bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 *,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 registry: Optional[Registry] = registry):
+        bounds = tuple(sorted(float(b) for b in buckets))
+        if bounds and bounds[-1] == math.inf:
+            bounds = bounds[:-1]
+        self._bounds = bounds
+        super().__init__(name,
+                         documentation,
+                         labelnames,
+                         registry=registry)
+
+    def _make_child(self) -> _HistogramChild:
+        return _HistogramChild(self._bounds)
+
+    def observe(self, value: float) -> None:
+        self._children[()].observe(value)
+
+    def collect(self) -> Iterable[_Sample_T]:
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self._bounds + (math.inf, ),
+                                    child.counts):
+                cumulative += count
+                yield '_bucket', values, ('le', _format_value(bound)), \
+                    cumulative
+            yield '_sum', values, None, child.sum
+            yield '_count', values, None, cumulative
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _escape_help(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n')
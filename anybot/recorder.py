@@ -0,0 +1,183 @@
+"""
+反向 WebSocket 流量录制。
+
+录制文件只追加写入，由连续的记录组成，每条记录为一个定长头部::
+
+    时间戳（float64，Unix 时间） | 类型（uint8） | self_id 长度（uint16） |
+    数据长度（uint32）
+
+（小端序）加上 UTF-8 编码的 ``self_id`` 和数据。类型的最高位表示数据是
+二进制帧，其余为 `KIND_OPEN`、`KIND_IN`、`KIND_OUT`、`KIND_CLOSE` 之一；
+``KIND_OPEN`` 记录的数据为 JSON，包含连接协商的编解码器和是否支持批量请求。
+
+多进程 worker 模式下，应在路径中包含 ``{pid}``，使每个进程写入各自的文件。
+"""
+
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Iterator, NamedTuple, Optional, Union, BinaryIO
+
+__all__ = [
+    'KIND_OPEN',
+    'KIND_IN',
+    'KIND_OUT',
+    'KIND_CLOSE',
+    'TrafficRecord',
+    'TrafficRecorder',
+    'read_records',
+]
+
+KIND_OPEN = 1
+KIND_IN = 2
+KIND_OUT = 3
+KIND_CLOSE = 4
+
+_BINARY_FLAG = 0x80
+_HEADER = struct.Struct('<dBHI')
+# the writer thread flushes the buffer at least this often,
+# also when no more frames come, so that a quiet bot loses little
+_FLUSH_INTERVAL_SEC = 1.0
+# max number of records waiting for the writer thread,
+# the ones exceeding it are dropped instead of taking up memory
+_QUEUE_SIZE = 10000
+# how long closing waits for the writer thread to write the rest
+_CLOSE_TIMEOUT_SEC = 5.0
+
+
+class TrafficRecord(NamedTuple):
+    time: float
+    kind: int
+    self_id: str
+    data: Union[str, bytes]
+
+
+class TrafficRecorder:
+    """
+    将连接的打开、关闭和收发的每一帧追加写入录制文件。
+
+    记录由专门的写入线程写入文件，事件循环中只进行打包和入队；写入失败时
+    停止录制。
+    """
+
+    def __init__(self,
+                 path: str,
+                 *,
+                 logger: Optional[logging.Logger] = None):
+        self._path = path
+        self._logger = logger or logging.getLogger(__name__)
+        # None tells the writer thread to stop
+        self._queue: 'queue.Queue[Optional[bytes]]' = queue.Queue(
+            _QUEUE_SIZE)
+        self._writer: Optional[threading.Thread] = None
+        self._dropped = 0
+        # failed to write, or closed
+        self._stopped = False
+
+    def _start_writer(self) -> None:
+        # started on the first record, which is after forking in worker mode
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name='anybot-recorder',
+                                        daemon=True)
+        self._writer.start()
+
+    def record(self, kind: int, self_id: str,
+               data: Union[str, bytes]) -> None:
+        if self._stopped:
+            return
+        now = time.time()
+        if isinstance(data, str):
+            data = data.encode()
+        else:
+            kind |= _BINARY_FLAG
+        sid = self_id.encode()
+        if not self._writer:
+            self._start_writer()
+        try:
+            self._queue.put_nowait(
+                _HEADER.pack(now, kind, len(sid), len(data)) + sid + data)
+        except queue.Full:
+            if not self._dropped:
+                self._logger.warning('Websocket traffic is recorded slower '
+                                     'than it comes, dropping records')
+            self._dropped += 1
+
+    def record_open(self, self_id: str, codec: str, batch: bool) -> None:
+        self.record(KIND_OPEN, self_id,
+                    json.dumps({
+                        'codec': codec,
+                        'batch': batch
+                    }))
+
+    def _write_loop(self) -> None:
+        file: Optional[BinaryIO] = None
+        try:
+            path = self._path.format(pid=os.getpid())
+            file = open(path, 'ab', buffering=256 * 1024)
+            self._logger.info(f'Recording websocket traffic to {path}')
+            last_flush = time.monotonic()
+            dirty = False
+            while True:
+                try:
+                    item = self._queue.get(timeout=_FLUSH_INTERVAL_SEC)
+                except queue.Empty:
+                    item = b''
+                if item is None:
+                    break
+                if item:
+                    file.write(item)
+                    dirty = True
+                now = time.monotonic()
+                if dirty and (not item or
+                              now - last_flush >= _FLUSH_INTERVAL_SEC):
+                    file.flush()
+                    last_flush = now
+                    dirty = False
+        except OSError as e:
+            self._stopped = True
+            self._logger.error(f'Failed to record websocket traffic, '
+                               f'recording stopped: {e}')
+        finally:
+            if file:
+                try:
+                    file.close()
+                except OSError:
+                    pass
+
+    def close(self) -> None:
+        """停止录制，等待写入线程写完已入队的记录。"""
+        self._stopped = True
+        if not self._writer:
+            return
+        try:
+            self._queue.put(None, timeout=_CLOSE_TIMEOUT_SEC)
+        except queue.Full:
+            pass
+        self._writer.join(_CLOSE_TIMEOUT_SEC)
+        self._writer = None
+        if self._dropped:
+            self._logger.warning(f'{self._dropped} websocket traffic records '
+                                 f'were dropped')
+
+
+def read_records(path: str) -> Iterator[TrafficRecord]:
+    """读取录制文件，忽略末尾不完整的记录。"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            ts, kind, sid_len, data_len = _HEADER.unpack(header)
+            body = f.read(sid_len + data_len)
+            if len(body) < sid_len + data_len:
+                return
+            data = body[sid_len:]
+            if kind & _BINARY_FLAG:
+                kind &= ~_BINARY_FLAG
+            else:
+                data = data.decode()
+            yield TrafficRecord(ts, kind, body[:sid_len].decode(), data)
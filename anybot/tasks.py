@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Awaitable, Dict, Optional, Set
+
+__all__ = [
+    'TaskRegistry',
+]
+
+
+class TaskRegistry:
+    """
+    后台任务登记表。
+
+    通过 `spawn` 创建的任务按种类计数，完成后自动移除，异常会被记录到日志；
+    关闭时可通过 `join` 等待所有任务完成，而不是直接丢弃它们。
+    """
+
+    def __init__(self, logger: Optional[logging.Logger] = None):
+        self._logger = logger or logging.getLogger(__name__)
+        # key: kind of the tasks
+        self._tasks: Dict[str, Set[asyncio.Future]] = {}
+        self._idle: Optional[asyncio.Event] = None
+
+    @property
+    def counts(self) -> Dict[str, int]:
+        """各种类未完成的任务数。"""
+        return {kind: len(tasks) for kind, tasks in self._tasks.items()}
+
+    def __len__(self) -> int:
+        return sum(len(tasks) for tasks in self._tasks.values())
+
+    def spawn(self, coro: Awaitable, kind: str = 'task') -> asyncio.Future:
+        """在当前事件循环中运行协程，并登记该任务。"""
+        task = asyncio.ensure_future(coro)
+        self._tasks.setdefault(kind, set()).add(task)
+        if self._idle:
+            self._idle.clear()
+        task.add_done_callback(lambda t: self._on_done(t, kind))
+        return task
+
+    def spawn_threadsafe(self,
+                         coro: Awaitable,
+                         loop: asyncio.AbstractEventLoop,
+                         kind: str = 'task') -> None:
+        """
+        在 ``loop`` 中运行协程并登记该任务，可在其它线程（如同步的事件
+        处理函数）中调用。
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self.spawn(coro, kind)
+        else:
+            loop.call_soon_threadsafe(self.spawn, coro, kind)
+
+    def _on_done(self, task: asyncio.Future, kind: str) -> None:
+        tasks = self._tasks.get(kind)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._tasks[kind]
+        if self._idle and not self._tasks:
+            self._idle.set()
+
+        if not task.cancelled() and task.exception() is not None:
+            self._logger.error(f'An exception occurred in a background '
+                               f'task ({kind}):')
+            self._logger.exception(task.exception())
+
+    async def join(self) -> None:
+        """等待所有已登记的任务（包括等待期间新登记的）完成。"""
+        if not self._idle:
+            self._idle = asyncio.Event()
+        if self._tasks:
+            self._idle.clear()
+        else:
+            self._idle.set()
+        await self._idle.wait()
+
+    def cancel_all(self) -> None:
+        for tasks in self._tasks.values():
+            for task in tasks:
+                task.cancel()
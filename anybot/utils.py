@@ -1,16 +1,27 @@
 import asyncio
-from typing import Any, Callable, Awaitable, Iterable, List
+import math
+from datetime import timedelta
+from typing import (Any, Callable, Awaitable, Iterable, List, Union, Optional,
+                    Sequence, TYPE_CHECKING)
 
 from quart.utils import run_sync
 
+if TYPE_CHECKING:
+    from .executor import HandlerExecutor
 
-def ensure_async(func: Callable[..., Any]) -> Callable[..., Awaitable[Any]]:
+
+def ensure_async(func: Callable[..., Any],
+                 executor: Optional['HandlerExecutor'] = None
+                 ) -> Callable[..., Awaitable[Any]]:
     """
-    确保可调用对象 `func` 为异步函数，如果不是，则使用 `run_sync`
-    包裹，使其在 asyncio 的默认 executor 中运行。
+    确保可调用对象 `func` 为异步函数，如果不是，则包裹它，使其在 `executor`
+    中运行，未指定 `executor` 时使用 `run_sync` 在 asyncio 的默认 executor
+    中运行。
     """
     if asyncio.iscoroutinefunction(func):
         return func
+    elif executor is not None:
+        return executor.wrap(func)
     else:
         return run_sync(func)
 
@@ -32,3 +43,17 @@ async def run_async_funcs(funcs: Iterable[Callable[..., Awaitable[Any]]],
     if coros:
         results += await asyncio.gather(*coros)
     return results
+
+
+def to_seconds(t: Union[float, timedelta, None]) -> Optional[float]:
+    """将以秒为单位的数字或 `timedelta` 转换为秒数。"""
+    if isinstance(t, timedelta):
+        return t.total_seconds()
+    return t
+
+
+def percentile(samples: Sequence[float], p: float) -> Optional[float]:
+    """计算已排序样本的 ``p`` 百分位数（最近秩法），没有样本时返回 `None`。"""
+    if not samples:
+        return None
+    return samples[max(math.ceil(p / 100 * len(samples)), 1) - 1]
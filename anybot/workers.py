@@ -0,0 +1,398 @@
+"""
+多进程 worker 模式。
+
+主进程（supervisor）在公开端口上接受连接，以 ``MSG_PEEK`` 方式读取（不消耗）
+WebSocket 握手请求头，按 ``X-Self-ID`` 头（或 ``self_id`` 查询参数）的哈希值
+选择固定的 worker，并通过 Unix 域套接字（``SCM_RIGHTS``）将连接的文件描述符
+交给该 worker。因此同一智能音箱总是由同一 worker 处理，进程内的连接、会话等
+状态保持有效。worker 崩溃后由 supervisor 重新启动。
+
+仅支持提供 ``os.fork`` 的平台。
+
+worker 使用 hypercorn 的内部接口（``TCPServer``、``Lifespan``）处理接收到的
+连接，这些接口在 hypercorn 的不同版本间有变化，因此仅支持经过测试的 hypercorn
+版本，其它版本下拒绝启动。需要 worker 模式时按 requirements-workers.txt 安装
+依赖，单进程运行不受此限制。
+"""
+
+import array
+import asyncio
+import gc
+import logging
+import os
+import selectors
+import signal
+import socket
+import time
+import zlib
+from typing import Callable, Awaitable, Dict, Optional, Tuple, List
+from urllib.parse import urlsplit, parse_qs
+
+__all__ = [
+    'parse_self_id',
+    'worker_index',
+    'Supervisor',
+]
+
+# max size of the websocket handshake request head we read
+_HEAD_MAX_SIZE = 16 * 1024
+# close the connection if the request head is not received in time
+_HEAD_TIMEOUT_SEC = 10.0
+# poll interval of incomplete request heads
+_HEAD_RETRY_INTERVAL_SEC = 0.01
+# delay before restarting a worker that crashed right after starting
+_RESTART_BACKOFF_SEC = 1.0
+# hypercorn versions whose internals _worker_main works with
+_HYPERCORN_VERSIONS = ('0.11.', )
+
+# index of the current worker process, None when not in a worker process
+_worker_index: Optional[int] = None
+
+
+def worker_index() -> Optional[int]:
+    """
+    当前 worker 进程的序号（从 0 开始），不在 worker 进程中时为 `None`。
+
+    worker 模式下每个 worker 都会执行 ASGI 应用的 lifespan 启动与关闭，
+    只需执行一次的任务可据此只在某个 worker 中执行。
+    """
+    return _worker_index
+
+
+def parse_self_id(head: bytes) -> str:
+    """
+    从 HTTP 请求头中解析智能音箱 ID，规则与 `AnyBot` 中的一致。
+    """
+    lines = head.split(b'\r\n')
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if sep and name.strip().lower() == b'x-self-id':
+            return value.strip().decode('latin-1')
+
+    request_line = lines[0].split()
+    if len(request_line) >= 2:
+        query = urlsplit(request_line[1].decode('latin-1')).query
+        values = parse_qs(query).get('self_id')
+        if values:
+            return values[0]
+    return '*'
+
+
+def _send_fd(channel: socket.socket, fd: int) -> None:
+    channel.sendmsg(
+        [b'\0'],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+
+
+def _recv_fd(channel: socket.socket) -> Optional[int]:
+    fds = array.array('i')
+    msg, ancdata, _, _ = channel.recvmsg(1,
+                                         socket.CMSG_LEN(fds.itemsize))
+    if not msg:
+        raise EOFError('the supervisor has closed the channel')
+    for level, type_, data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+            return fds[0] if fds else None
+    return None
+
+
+def _check_hypercorn_version() -> None:
+    import hypercorn
+    version = getattr(hypercorn, '__version__', None)
+    if version is None:
+        from importlib.metadata import version as get_version
+        version = get_version('hypercorn')
+    if not version.startswith(_HYPERCORN_VERSIONS):
+        raise RuntimeError(f'worker mode does not support hypercorn '
+                           f'{version}, install requirements-workers.txt')
+
+
+def _worker_main(app: Callable[..., Awaitable], channel: socket.socket,
+                 logger: logging.Logger) -> None:
+    from hypercorn.config import Config
+    from hypercorn.asyncio.lifespan import Lifespan
+    from hypercorn.asyncio.tcp_server import TCPServer
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    config = Config()
+    config.access_log_format = '%(h)s %(r)s %(s)s %(b)s %(D)s'
+    config.errorlog = logger
+
+    async def serve() -> None:
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        lifespan = Lifespan(app, config)
+        lifespan_task = loop.create_task(lifespan.handle_lifespan())
+        await lifespan.wait_for_startup()
+
+        async def on_connected(reader: asyncio.StreamReader,
+                               writer: asyncio.StreamWriter) -> None:
+            await TCPServer(app, loop, config, reader, writer)
+
+        def on_channel_readable() -> None:
+            try:
+                fd = _recv_fd(channel)
+            except BlockingIOError:
+                return
+            except (EOFError, OSError):
+                # the supervisor is gone
+                stop.set()
+                return
+            if fd is None:
+                return
+            sock = socket.socket(fileno=fd)
+            loop.create_task(
+                loop.connect_accepted_socket(
+                    lambda: asyncio.StreamReaderProtocol(
+                        asyncio.StreamReader(), on_connected), sock))
+
+        channel.setblocking(False)
+        loop.add_reader(channel.fileno(), on_channel_readable)
+        await stop.wait()
+        loop.remove_reader(channel.fileno())
+
+        await lifespan.wait_for_shutdown()
+        lifespan_task.cancel()
+
+    try:
+        loop.run_until_complete(serve())
+    finally:
+        loop.close()
+
+
+class Supervisor:
+    """
+    启动并监督多个 worker 进程，将连接按智能音箱 ID 分发给固定的 worker。
+    """
+
+    def __init__(self,
+                 app: Callable[..., Awaitable],
+                 *,
+                 host: str,
+                 port: int,
+                 workers: int,
+                 backlog: int = 100,
+                 logger: Optional[logging.Logger] = None):
+        if workers < 1:
+            raise ValueError('the number of workers must be positive')
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('worker mode requires os.fork')
+        _check_hypercorn_version()
+
+        self._app = app
+        self._address = (host, port)
+        self._workers_num = workers
+        self._backlog = backlog
+        self._logger = logger or logging.getLogger(__name__)
+
+        self._sock: Optional[socket.socket] = None
+        self._selector: Optional[selectors.BaseSelector] = None
+        # key: worker index
+        # value: (pid, channel, start time)
+        self._workers: Dict[int, Tuple[int, socket.socket, float]] = {}
+        # key: worker index, value: time to restart the worker
+        self._restarts: Dict[int, float] = {}
+        # key: connection, value: deadline of receiving the request head
+        self._pending: Dict[socket.socket, float] = {}
+        # connections whose request head is incomplete, with retry time
+        self._waiting: List[Tuple[float, socket.socket]] = []
+        self._stopping = False
+
+    def run(self) -> None:
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(self._address)
+        self._sock.listen(self._backlog)
+        self._sock.setblocking(False)
+
+        # everything loaded so far is shared by the workers copy-on-write,
+        # keep the collector from touching (and thus copying) it
+        gc.freeze()
+        for index in range(self._workers_num):
+            self._spawn(index)
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self._on_stop_signal)
+
+        self._logger.info(f'Running {self._workers_num} workers on '
+                          f'{self._address[0]}:{self._address[1]}')
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ)
+        try:
+            while not self._stopping:
+                for key, _ in self._selector.select(timeout=0.05):
+                    if key.fileobj is self._sock:
+                        self._accept()
+                    else:
+                        self._route(key.fileobj)
+                self._tick()
+        finally:
+            self._shutdown()
+
+    def _on_stop_signal(self, *_) -> None:
+        self._stopping = True
+
+    def _spawn(self, index: int) -> None:
+        channel, child_channel = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            # in the worker process
+            global _worker_index
+            _worker_index = index
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self._close_inherited(channel)
+                _worker_main(self._app, child_channel, self._logger)
+            except Exception as e:
+                self._logger.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+
+        child_channel.close()
+        # a worker that stops receiving must not block the routing of the
+        # connections of every other worker
+        channel.setblocking(False)
+        self._workers[index] = (pid, channel, time.monotonic())
+        self._logger.info(f'Worker {index} started, pid: {pid}')
+
+    def _close_inherited(self, channel: socket.socket) -> None:
+        channel.close()
+        self._sock.close()
+        if self._selector:
+            self._selector.close()
+        for _, other_channel, _ in self._workers.values():
+            other_channel.close()
+        for conn in self._pending:
+            conn.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._logger.warning(f'Failed to accept: {e}')
+                return
+            conn.setblocking(False)
+            self._pending[conn] = time.monotonic() + _HEAD_TIMEOUT_SEC
+            self._selector.register(conn, selectors.EVENT_READ)
+
+    def _route(self, conn: socket.socket) -> None:
+        self._selector.unregister(conn)
+        try:
+            head = conn.recv(_HEAD_MAX_SIZE, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            head = None
+        except OSError:
+            head = b''
+
+        if head == b'':
+            # the connection is closed by the peer
+            self._drop(conn)
+            return
+
+        end = head.find(b'\r\n\r\n') if head else -1
+        if end < 0:
+            if head and len(head) >= _HEAD_MAX_SIZE:
+                self._drop(conn)
+            else:
+                # the data stays in the kernel buffer since we only peeked,
+                # so wait a little before polling again instead of spinning
+                self._waiting.append(
+                    (time.monotonic() + _HEAD_RETRY_INTERVAL_SEC, conn))
+            return
+
+        self_id = parse_self_id(head[:end])
+        index = zlib.crc32(self_id.encode()) % self._workers_num
+        worker = self._workers.get(index)
+        del self._pending[conn]
+        try:
+            if not worker:
+                raise OSError(f'worker {index} is not running')
+            _send_fd(worker[1], conn.fileno())
+        except BlockingIOError:
+            # the channel is full, the speaker will reconnect
+            self._logger.warning(f'Worker {index} is not taking connections, '
+                                 f'closing the connection of {self_id}')
+        except OSError as e:
+            self._logger.warning(f'Failed to pass connection of '
+                                 f'{self_id} to worker {index}: {e}')
+        conn.close()
+
+    def _drop(self, conn: socket.socket) -> None:
+        self._pending.pop(conn, None)
+        conn.close()
+
+    def _tick(self) -> None:
+        now = time.monotonic()
+
+        waiting, self._waiting = self._waiting, []
+        for retry_at, conn in waiting:
+            if retry_at <= now:
+                self._selector.register(conn, selectors.EVENT_READ)
+            else:
+                self._waiting.append((retry_at, conn))
+
+        for conn, deadline in list(self._pending.items()):
+            if deadline < now:
+                self._waiting = [(t, c) for t, c in self._waiting
+                                 if c is not conn]
+                if conn.fileno() in self._selector.get_map():
+                    self._selector.unregister(conn)
+                self._drop(conn)
+
+        self._reap(now)
+        for index, restart_at in list(self._restarts.items()):
+            if restart_at <= now:
+                del self._restarts[index]
+                self._spawn(index)
+
+    def _reap(self, now: float) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for index, (worker_pid, channel, started_at) in \
+                    list(self._workers.items()):
+                if worker_pid != pid:
+                    continue
+                del self._workers[index]
+                channel.close()
+                self._logger.warning(f'Worker {index} (pid: {pid}) exited '
+                                     f'with status {status}, restarting')
+                restart_at = now
+                if now - started_at < _RESTART_BACKOFF_SEC:
+                    restart_at += _RESTART_BACKOFF_SEC
+                self._restarts[index] = restart_at
+
+    def _shutdown(self) -> None:
+        self._logger.info('Stopping workers')
+        self._selector.close()
+        self._sock.close()
+        for conn in self._pending:
+            conn.close()
+        for pid, channel, _ in self._workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid, channel, _ in self._workers.values():
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            channel.close()
+        self._workers.clear()
@@ -0,0 +1,127 @@
+"""
+Micro-benchmark of the wire codecs on realistic speaker payloads.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_codec
+"""
+
+import base64
+import json
+import os
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from anybot.codec import _codecs, json_dumps, json_loads
+from anybot.message import Message
+
+# 5 seconds of 16000Hz 16bit mono wav
+AUDIO = b'RIFF' + os.urandom(16000 * 2 * 5)
+
+
+def make_event(audio_seconds: float, raw: bool = False) -> dict:
+    audio = AUDIO[:int(16000 * 2 * audio_seconds)]
+    data = {'audio': audio} if raw else \
+        {'base64': base64.b64encode(audio).decode()}
+    return {
+        'type': 'message',
+        'detail_type': 'private',
+        'self_id': 'speaker-0001',
+        'message_id': 12345,
+        'message': [{
+            'type': 'record',
+            'data': data
+        }],
+    }
+
+
+def make_send_request(message: Message) -> dict:
+    return {
+        'action': 'send',
+        'params': {
+            'type': 'message',
+            'detail_type': 'private',
+            'self_id': 'speaker-0001',
+            'message': message,
+        },
+        'echo': {
+            'seq': 1
+        },
+    }
+
+
+def wire_frame(codec, event: dict, audio_seconds: float):
+    if codec.name == 'msgpack':
+        import msgpack
+        return msgpack.packb(make_event(audio_seconds, raw=True),
+                             use_bin_type=True)
+    return codec.dumps(event)
+
+
+def bench(label: str, func, number: int) -> None:
+    sec = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f'  {label:<36} {sec * 1e6:>12.1f} us')
+
+
+def size_of(data) -> int:
+    return len(data if isinstance(data, bytes) else data.encode())
+
+
+def main():
+    text_msg = Message('今天天气怎么样？' * 4)
+    cases = [
+        ('text', 0, 2000),
+        ('record 1s', 1, 200),
+        ('record 5s', 5, 50),
+    ]
+    for name, seconds, number in cases:
+        if seconds:
+            event = make_event(seconds)
+            request = make_send_request(Message(event['message']))
+        else:
+            event = dict(make_event(0), message=[{
+                'type': 'text',
+                'data': {
+                    'text': str(text_msg)
+                }
+            }])
+            request = make_send_request(text_msg)
+        text = json.dumps(event, ensure_ascii=False)
+        print(f'{name} event ({size_of(text)} bytes as json)')
+
+        print(' raw libraries:')
+        bench('json dumps', lambda: json.dumps(event, ensure_ascii=False),
+              number)
+        bench('json loads', lambda: json.loads(text), number)
+        if ujson:
+            bench('ujson dumps',
+                  lambda: ujson.dumps(event, ensure_ascii=False), number)
+            bench('ujson loads', lambda: ujson.loads(text), number)
+        if orjson:
+            bench('orjson dumps', lambda: orjson.dumps(event), number)
+            bench('orjson loads', lambda: orjson.loads(text), number)
+        bench('anybot json_dumps', lambda: json_dumps(event), number)
+        bench('anybot json_loads', lambda: json_loads(text), number)
+
+        print(' wire codecs:')
+        for codec in _codecs.values():
+            out = codec.dumps(request)
+            bench(f'{codec.name} send ({size_of(out)} bytes)',
+                  lambda: codec.dumps(request), number)
+            frame = wire_frame(codec, event, seconds)
+            bench(f'{codec.name} receive ({size_of(frame)} bytes)',
+                  lambda: codec.loads(frame), number)
+        print()
+
+
+if __name__ == '__main__':
+    main()
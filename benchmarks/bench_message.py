@@ -0,0 +1,273 @@
+"""
+Micro-benchmark of parsing MT-code strings into messages and of building,
+reducing and extracting text from messages with many segments.
+
+Compares ``Message._split_iter`` with the original regex-based parser on
+typical and pathological inputs, after checking that both produce the
+same segments. The original parser backtracks exponentially on unclosed
+codes with many params, so it's skipped where it wouldn't finish.
+
+The message operations are compared with the original implementations
+on thousands of segments, which were quadratic in the number of them.
+Segment creation, attribute access and memory are compared with the
+original dict-based segment class.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_message
+"""
+
+import copy
+import re
+import time
+import timeit
+import tracemalloc
+from typing import Any, Iterable, List, Tuple
+
+from anybot.message import Message, MessageSegment, unescape
+
+
+def legacy_split_iter(msg_str: str) -> Iterable[MessageSegment]:
+    """The parser before it was precompiled, kept for comparison."""
+    def iter_function_name_and_extra() -> Iterable[Tuple[str, str]]:
+        text_begin = 0
+        for code in re.finditer(
+                r'\[MT:(?P<type>[a-zA-Z0-9-_.]+)'
+                r'(?P<params>'
+                r'(?:,[a-zA-Z0-9-_.]+=?[^,\]]*)*'
+                r'),?\]', msg_str):
+            yield ('text',
+                   unescape(msg_str[text_begin:code.pos + code.start()]))
+            text_begin = code.pos + code.end()
+            yield code.group('type'), code.group('params').lstrip(',')
+        yield 'text', unescape(msg_str[text_begin:])
+
+    for function_name, extra in iter_function_name_and_extra():
+        if function_name == 'text':
+            if extra:
+                yield MessageSegment(type_=function_name,
+                                     data={'text': extra})
+        else:
+            data = {
+                k: v
+                for k, v in map(
+                    lambda x: x.split('=', maxsplit=1),
+                    filter(lambda x: x, (x.lstrip()
+                                         for x in extra.split(','))))
+            }
+            yield MessageSegment(type_=function_name, data=data)
+
+
+def legacy_extend(msg: Message, segments: Iterable[Any]) -> None:
+    for seg in segments:
+        if not isinstance(seg, MessageSegment):
+            seg = MessageSegment(seg)
+        if msg and msg[-1].type == 'text' and seg.type == 'text':
+            msg[-1].data['text'] += seg.data['text']
+        elif seg.type != 'text' or seg.data['text'] or not msg:
+            list.append(msg, seg)
+
+
+def legacy_reduce(msg: Message) -> None:
+    idx = 0
+    while idx < len(msg):
+        if idx > 0 and \
+                msg[idx - 1].type == 'text' and msg[idx].type == 'text':
+            msg[idx - 1].data['text'] += msg[idx].data['text']
+            del msg[idx]
+        else:
+            idx += 1
+
+
+def legacy_extract_plain_text(msg: Message) -> str:
+    result = ''
+    for seg in msg:
+        if seg.type == 'text':
+            result += ' ' + seg.data['text']
+    if result:
+        result = result[1:]
+    return result
+
+
+class LegacySegment(dict):
+    """The original dict-based MessageSegment, without the methods."""
+    def __init__(self, d=None, *, type_=None, data=None):
+        super().__init__()
+        if isinstance(d, dict) and d.get('type'):
+            self.update(d)
+        elif type_:
+            self.type = type_
+            self.data = data
+        else:
+            raise ValueError('the "type" field cannot be None or empty')
+
+    def __getitem__(self, item):
+        if item not in ('type', 'data'):
+            raise KeyError(f'the key "{item}" is not allowed')
+        return super().__getitem__(item)
+
+    def __setitem__(self, key, value):
+        if key not in ('type', 'data'):
+            raise KeyError(f'the key "{key}" is not allowed')
+        return super().__setitem__(key, value)
+
+    @property
+    def type(self) -> str:
+        return self['type']
+
+    @type.setter
+    def type(self, type_: str):
+        self['type'] = type_
+
+    @property
+    def data(self):
+        return self['data']
+
+    @data.setter
+    def data(self, data):
+        self['data'] = data or {}
+
+
+def make_segments(n: int) -> List[dict]:
+    """Short texts, like the words streamed by speech recognition."""
+    return [{'type': 'text', 'data': {'text': '好的'}} for _ in range(n)]
+
+
+def unreduced(segments: List[dict]) -> Message:
+    # bypass the merging in Message.extend
+    msg = Message()
+    list.extend(msg, map(MessageSegment, copy.deepcopy(segments)))
+    return msg
+
+
+RECORD = '[MT:record,file=https://example.com/tts/0123456789abcdef.mp3]'
+
+# (name, string, number of runs, whether to run the legacy parser)
+CASES: List[Tuple[str, str, int, bool]] = [
+    ('short text', '今天天气怎么样', 20000, True),
+    ('long text', '今天天气怎么样，' * 1250, 2000, True),
+    ('text with escapes', 'a &#91;b&#93; &amp; c, ' * 50, 5000, True),
+    ('command with a record', '跟我说 ' + RECORD, 10000, True),
+    ('1000 codes', (RECORD + '好的，') * 1000, 10, True),
+    ('unclosed code, 6 params', '[MT:a' + ',bbbbbbbbbb' * 6 + '!', 2, True),
+    ('unclosed code, 500 params', '[MT:a' + ',bbbbbbbbbb' * 500, 100,
+     False),
+    ('500 unclosed codes', '[MT:face,id=1 ' * 500, 100, False),
+    ('500 unclosed codes and "]"', '[MT:face,id=1 ' * 500 + ']', 100,
+     False),
+]
+
+
+def bench(label: str, func, number: int) -> float:
+    sec = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print(f'  {label:<12} {sec * 1e6:>14.1f} us')
+    return sec
+
+
+def bench_parse():
+    for name, msg_str, number, run_legacy in CASES:
+        print(f'{name} ({len(msg_str)} chars)')
+        if not run_legacy:
+            bench('current', lambda: list(Message._split_iter(msg_str)),
+                  number)
+            print()
+            continue
+
+        assert list(Message._split_iter(msg_str)) == \
+            list(legacy_split_iter(msg_str)), name
+        old = bench('legacy', lambda: list(legacy_split_iter(msg_str)),
+                    number)
+        new = bench('current', lambda: list(Message._split_iter(msg_str)),
+                    number)
+        print(f'  {"speedup":<12} {old / new:>14.1f} x')
+        print()
+
+
+
+def bench_on(label: str, func, make_input, number: int) -> float:
+    """Like bench(), but func gets a fresh input made outside the timing."""
+    best = None
+    for _ in range(3):
+        inputs = [make_input() for _ in range(number)]
+        start = time.perf_counter()
+        for x in inputs:
+            func(x)
+        sec = (time.perf_counter() - start) / number
+        best = sec if best is None else min(best, sec)
+    print(f'  {label:<12} {best * 1e6:>14.1f} us')
+    return best
+
+
+def bench_segments():
+    for n in (1000, 4000, 16000):
+        segments = make_segments(n)
+        number = max(16000 // n, 1)
+
+        def segment_dicts():
+            # the merged texts are written into the dicts given
+            return copy.deepcopy(segments)
+
+        legacy_msg = Message()
+        legacy_extend(legacy_msg, segment_dicts())
+        assert Message(segment_dicts()) == legacy_msg
+        print(f'build from {n} segments')
+        old = bench_on('legacy', lambda x: legacy_extend(Message(), x),
+                       segment_dicts, number)
+        new = bench_on('current', Message, segment_dicts, number)
+        print(f'  {"speedup":<12} {old / new:>14.1f} x')
+        print()
+
+        msg, legacy_msg = unreduced(segments), unreduced(segments)
+        msg.reduce()
+        legacy_reduce(legacy_msg)
+        assert msg == legacy_msg
+        print(f'reduce {n} segments')
+        old = bench_on('legacy', legacy_reduce,
+                       lambda: unreduced(segments), number)
+        new = bench_on('current', Message.reduce,
+                       lambda: unreduced(segments), number)
+        print(f'  {"speedup":<12} {old / new:>14.1f} x')
+        print()
+
+        msg = unreduced(segments)
+        assert msg.extract_plain_text() == legacy_extract_plain_text(msg)
+        print(f'extract plain text from {n} segments')
+        old = bench('legacy', lambda: legacy_extract_plain_text(msg),
+                    number)
+        new = bench('current', lambda: msg.extract_plain_text(), number)
+        print(f'  {"speedup":<12} {old / new:>14.1f} x')
+        print()
+
+
+def allocated_per_segment(cls, n: int = 10000) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    segments = [cls(type_='text', data=None) for _ in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del segments
+    return (after - before) / n
+
+
+def bench_segment_class():
+    text = {'type': 'text', 'data': {'text': '好的'}}
+    for cls in (LegacySegment, MessageSegment):
+        seg = cls(text)
+        print(f'{cls.__name__}')
+        bench('create', lambda: cls(type_='text', data={'text': '好的'}),
+              100000)
+        bench('from dict', lambda: cls(text), 100000)
+        bench('.type', lambda: seg.type, 1000000)
+        bench('.data', lambda: seg.data, 1000000)
+        print(f'  {"memory":<12} {allocated_per_segment(cls):>14.0f} B')
+        print()
+
+
+def main():
+    bench_parse()
+    bench_segments()
+    bench_segment_class()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Synthetic speaker load generator for end-to-end throughput testing.
+
+Opens N reverse websocket connections to a running bot with distinct
+``X-Self-ID`` headers, the way real speakers do. It sends a mix of text
+and record message events at a target rate, answers every action the
+bot issues, and reports throughput plus the latency from each event to
+the first ``send`` action that follows it on the same connection.
+
+Run from the repository root against a local milktea instance:
+
+    python -m benchmarks.loadgen --speakers 50 --rate 100 --duration 60
+
+Speech recognition, speech synthesis and chat go through the AI vendor.
+To keep everything local, let this tool serve a stub of the vendor API
+and point the bot's ``TENCENT_AI_API_ROOT`` at it:
+
+    python -m benchmarks.loadgen --stub-vendor 127.0.0.1:8090 ...
+    # in the bot's config: TENCENT_AI_API_ROOT = 'http://127.0.0.1:8090'
+
+The ``message_id`` of the events starts from a base taken from the
+current time, so that a run is not dropped by the bot's de-duplication
+of the events of an earlier run with the same self_ids.
+
+Replies are matched to events in order on each connection. An event
+that makes the bot send more than one message counts only the first
+one, and the extra ones are reported as unmatched replies.
+
+Requires the ``websockets`` package.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import math
+import random
+import sys
+import time
+import wave
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+try:
+    # websockets >= 13
+    from websockets.asyncio.client import connect as ws_connect
+    _HEADERS_KWARG = 'additional_headers'
+except ImportError:
+    try:
+        from websockets import connect as ws_connect
+        _HEADERS_KWARG = 'extra_headers'
+    except ImportError:
+        ws_connect = None
+
+from anybot.utils import percentile
+
+STUB_TEXT = '今天天气怎么样'
+
+
+def make_wav(seconds: float) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(b'\0\0' * int(16000 * seconds))
+    return buf.getvalue()
+
+
+def parse_mix(mix: str) -> Tuple[List[str], List[float]]:
+    kinds, weights = [], []
+    for item in mix.split(','):
+        kind, _, weight = item.partition(':')
+        kind = kind.strip()
+        if kind not in ('text', 'record'):
+            raise argparse.ArgumentTypeError(f'unknown event kind "{kind}"')
+        kinds.append(kind)
+        weights.append(float(weight) if weight else 1.0)
+    return kinds, weights
+
+
+class Stats:
+    def __init__(self):
+        self.sent: Counter = Counter()
+        # key: event kind, value: latencies in seconds
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.actions: Counter = Counter()
+        self.unmatched = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    @property
+    def replied(self) -> int:
+        return sum(len(v) for v in self.latencies.values())
+
+
+class Speaker:
+    def __init__(self,
+                 self_id: str,
+                 stats: Stats,
+                 reply_timeout: float,
+                 message_id_base: int = 0):
+        self.self_id = self_id
+        self._stats = stats
+        self._reply_timeout = reply_timeout
+        self._ws = None
+        self._reader: Optional[asyncio.Task] = None
+        # value: (sent time, event kind)
+        self._pending: Deque[Tuple[float, str]] = deque()
+        self._message_id = message_id_base
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def connect(self, url: str, access_token: str) -> None:
+        headers = {'X-Self-ID': self.self_id}
+        if access_token:
+            headers['Authorization'] = f'Bearer {access_token}'
+        self._ws = await ws_connect(url,
+                                    max_size=None,
+                                    **{_HEADERS_KWARG: headers})
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def close(self) -> None:
+        if self._reader:
+            self._reader.cancel()
+        if self._ws:
+            await self._ws.close()
+
+    async def send_event(self, kind: str, record_base64: str,
+                         text: str) -> None:
+        self._message_id += 1
+        if kind == 'record':
+            segment = {'type': 'record', 'data': {'base64': record_base64}}
+        else:
+            segment = {'type': 'text', 'data': {'text': text}}
+        payload = {
+            'type': 'message',
+            'detail_type': 'private',
+            'self_id': self.self_id,
+            'message_id': self._message_id,
+            'message': [segment],
+        }
+        try:
+            await self._ws.send(json.dumps(payload, ensure_ascii=False))
+        except Exception:
+            self._stats.errors += 1
+            return
+        self._pending.append((time.perf_counter(), kind))
+        self._stats.sent[kind] += 1
+
+    def expire(self, now: float) -> None:
+        while self._pending and \
+                now - self._pending[0][0] > self._reply_timeout:
+            self._pending.popleft()
+            self._stats.timeouts += 1
+
+    async def _read(self) -> None:
+        try:
+            async for frame in self._ws:
+                try:
+                    data = json.loads(frame)
+                except ValueError:
+                    continue
+                requests = data if isinstance(data, list) else [data]
+                results = [self._on_request(r) for r in requests
+                           if isinstance(r, dict)]
+                if isinstance(data, list):
+                    await self._ws.send(json.dumps(results))
+                else:
+                    for result in results:
+                        await self._ws.send(json.dumps(result))
+        except Exception:
+            self._stats.errors += 1
+
+    def _on_request(self, request: dict) -> dict:
+        action = request.get('action')
+        self._stats.actions[action] += 1
+        if action == 'send':
+            now = time.perf_counter()
+            self.expire(now)
+            if self._pending:
+                sent_at, kind = self._pending.popleft()
+                self._stats.latencies[kind].append(now - sent_at)
+            else:
+                self._stats.unmatched += 1
+        return {
+            'status': 'ok',
+            'retcode': 0,
+            'data': None,
+            'echo': request.get('echo'),
+        }
+
+
+async def serve_stub_vendor(bind: str, delay: float,
+                            stop: asyncio.Event) -> None:
+    """Serve a stub of the Tencent AI API used by milktea."""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    from quart import Quart, jsonify
+
+    app = Quart('loadgen-stub-vendor')
+    speech = base64.b64encode(make_wav(0.5)).decode()
+
+    async def reply(data: dict):
+        if delay:
+            await asyncio.sleep(delay)
+        return jsonify({'ret': 0, 'msg': 'ok', 'data': data})
+
+    @app.route('/aai/aai_asr', methods=['POST'])
+    async def asr():
+        return await reply({'text': STUB_TEXT})
+
+    @app.route('/aai/aai_tts', methods=['POST'])
+    async def tts():
+        return await reply({'speech': speech})
+
+    @app.route('/nlp/nlp_textchat', methods=['POST'])
+    async def chat():
+        return await reply({'answer': '挺好的'})
+
+    config = Config()
+    config.bind = [bind]
+    await serve(app, config, shutdown_trigger=stop.wait)
+
+
+def report(stats: Stats, elapsed: float) -> None:
+    sent = sum(stats.sent.values())
+    print(f'\nevents sent: {sent} ({sent / elapsed:.1f}/s), '
+          f'replied: {stats.replied} ({stats.replied / elapsed:.1f}/s), '
+          f'timed out: {stats.timeouts}, unmatched replies: '
+          f'{stats.unmatched}, errors: {stats.errors}')
+    print(f'actions received: {dict(stats.actions)}')
+    print(f'{"kind":<8}{"sent":>8}{"replied":>9}'
+          f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    kinds = sorted(stats.sent)
+    if len(kinds) > 1:
+        kinds.append('all')
+    for kind in kinds:
+        if kind == 'all':
+            samples = sorted(x for v in stats.latencies.values() for x in v)
+            count = sum(stats.sent.values())
+        else:
+            samples = sorted(stats.latencies[kind])
+            count = stats.sent[kind]
+        cols = [percentile(samples, p) for p in (50, 95, 99, 100)]
+        print(f'{kind:<8}{count:>8}{len(samples):>9}' + ''.join(
+            f'{x * 1000:>10.1f}' if x is not None else f'{"-":>10}'
+            for x in cols))
+
+
+async def run(args: argparse.Namespace) -> None:
+    kinds, weights = args.mix
+    rng = random.Random(args.seed)
+    record_base64 = base64.b64encode(make_wav(args.record_seconds)).decode()
+
+    stop_vendor = asyncio.Event()
+    vendor_task = None
+    if args.stub_vendor:
+        vendor_task = asyncio.ensure_future(
+            serve_stub_vendor(args.stub_vendor, args.stub_delay,
+                              stop_vendor))
+
+    stats = Stats()
+    # the same as replay.py, unique for every run started a second apart
+    message_id_base = int(time.time()) * 1_000_000
+    speakers = [
+        Speaker(f'{args.self_id_prefix}{i:05d}', stats, args.reply_timeout,
+                message_id_base) for i in range(args.speakers)
+    ]
+    await asyncio.gather(
+        *(s.connect(args.url, args.access_token) for s in speakers))
+    print(f'{len(speakers)} speakers connected to {args.url}')
+
+    start = time.perf_counter()
+    last_progress = start
+    i = 0
+    while True:
+        now = time.perf_counter()
+        if now - start >= args.duration:
+            break
+        delay = start + i / args.rate - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = rng.choices(kinds, weights)[0]
+        await speakers[i % len(speakers)].send_event(kind, record_base64,
+                                                     args.text)
+        i += 1
+
+        if now - last_progress >= 5:
+            last_progress = now
+            pending = sum(s.pending for s in speakers)
+            print(f'[{now - start:6.1f}s] sent: {sum(stats.sent.values())}, '
+                  f'replied: {stats.replied}, pending: {pending}')
+
+    # wait for the outstanding replies
+    deadline = time.perf_counter() + args.reply_timeout
+    while time.perf_counter() < deadline and \
+            any(s.pending for s in speakers):
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    for s in speakers:
+        s.expire(math.inf)
+
+    await asyncio.gather(*(s.close() for s in speakers),
+                         return_exceptions=True)
+    if vendor_task:
+        stop_vendor.set()
+        await vendor_task
+    report(stats, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Synthetic speaker load generator.')
+    parser.add_argument('--url', default='ws://127.0.0.1:8080/ws')
+    parser.add_argument('--access-token', default='')
+    parser.add_argument('-n', '--speakers', type=int, default=10)
+    parser.add_argument('-r', '--rate', type=float, default=10,
+                        help='total events per second')
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help='seconds to send events for')
+    parser.add_argument('--mix', type=parse_mix, default='text:4,record:1',
+                        help='weights of event kinds, e.g. text:4,record:1')
+    parser.add_argument('--text', default='你好')
+    parser.add_argument('--record-seconds', type=float, default=2.0)
+    parser.add_argument('--reply-timeout', type=float, default=10.0)
+    parser.add_argument('--self-id-prefix', default='loadgen-')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--stub-vendor', metavar='HOST:PORT',
+                        help='serve a stub of the AI vendor API')
+    parser.add_argument('--stub-delay', type=float, default=0.05,
+                        help='seconds the stub vendor takes to respond')
+    args = parser.parse_args()
+
+    if ws_connect is None:
+        print('The "websockets" package is required.', file=sys.stderr)
+        exit(1)
+    if args.speakers < 1 or args.rate <= 0:
+        parser.error('the number of speakers and the rate must be positive')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+"""
+Replay recorded websocket traffic into a local bot.
+
+Feeds the events of a file recorded with ``TRAFFIC_RECORD_PATH`` back
+into a running bot. Each recorded connection becomes a new connection
+with the same ``X-Self-ID``, codec and batch setting. Events are sent
+with their original spacing, scaled by ``--speed``, where 0 means as
+fast as possible.
+
+The ``message_id`` of replayed events is made unique for every run, so
+that the bot's event de-duplication doesn't drop them, unless
+``--keep-message-ids`` is given.
+
+Actions issued by the bot are answered with the results the speaker gave
+to the same action in the recording, in order. Actions with no recorded
+result get an empty ok result. Recorded results themselves are not
+replayed, since their echo no longer matches anything.
+
+The actions the bot issues are compared with the recorded ones per
+connection, ignoring heartbeats and the order, since the events of a
+connection are handled concurrently. Unless replaying at max speed, the
+report also gives the latency from each event to the first action that
+follows it, in the recording and in the replay.
+
+Run from the repository root:
+
+    python -m benchmarks.replay traffic-*.rec --speed 2
+
+Requires the ``websockets`` package.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+from anybot.codec import Codec, _codecs, default_codec, json_loads
+from anybot.heartbeat import HEARTBEAT_ACTION
+from anybot.recorder import (KIND_OPEN, KIND_IN, KIND_OUT, KIND_CLOSE,
+                             read_records)
+from anybot.utils import percentile
+from benchmarks.loadgen import ws_connect, _HEADERS_KWARG
+
+
+class Session:
+    """A recorded connection."""
+
+    def __init__(self, self_id: str, opened_at: float, codec: Codec,
+                 batch: bool):
+        self.self_id = self_id
+        self.opened_at = opened_at
+        self.codec = codec
+        self.batch = batch
+        # value: (time, raw frame)
+        self.events: List[Tuple[float, Union[str, bytes]]] = []
+        # value: (time, action, params)
+        self.calls: List[Tuple[float, str, Any]] = []
+        # key: action, value: recorded results in order
+        self.results: Dict[str, Deque[dict]] = defaultdict(deque)
+        # key: echo seq of a recorded call, value: action
+        self._pending: Dict[int, str] = {}
+
+    def on_in(self, ts: float, frame: Union[str, bytes]) -> None:
+        try:
+            payload = self.codec.loads(frame)
+        except ValueError:
+            return
+        items = payload if isinstance(payload, list) else [payload]
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            if 'type' in item:
+                self.events.append((ts, frame))
+                return
+            echo = item.get('echo')
+            seq = echo.get('seq') if isinstance(echo, dict) else None
+            action = self._pending.pop(seq, None)
+            if action:
+                self.results[action].append(item)
+
+    def on_out(self, ts: float, frame: Union[str, bytes]) -> None:
+        try:
+            payload = self.codec.loads(frame)
+        except ValueError:
+            return
+        for item in payload if isinstance(payload, list) else [payload]:
+            if not isinstance(item, dict) or 'action' not in item:
+                continue
+            echo = item.get('echo')
+            if isinstance(echo, dict) and 'seq' in echo:
+                self._pending[echo['seq']] = item['action']
+            if item['action'] != HEARTBEAT_ACTION:
+                self.calls.append((ts, item['action'], item.get('params')))
+
+
+def with_message_id(codec: Codec, frame: Union[str, bytes],
+                    run_id: int) -> Union[str, bytes]:
+    """Make the message id of an event frame unique for this run."""
+    if codec.name == 'msgpack':
+        import msgpack
+        # don't go through the codec to keep the audio as raw bytes
+        payload = msgpack.unpackb(frame, raw=False)
+    else:
+        payload = json_loads(frame)
+    message_id = payload.get('message_id')
+    if isinstance(message_id, int):
+        payload['message_id'] = run_id * 1_000_000 + message_id
+    elif message_id is not None:
+        payload['message_id'] = f'{message_id}.{run_id}'
+    else:
+        return frame
+    if codec.name == 'msgpack':
+        return msgpack.packb(payload, use_bin_type=True)
+    return codec.dumps(payload)
+
+
+def load_sessions(paths: List[str]) -> List[Session]:
+    sessions: List[Session] = []
+    # key: self_id, value: the currently open session
+    current: Dict[str, Session] = {}
+    # a speaker is always served by the same worker,
+    # so the files of different workers can be read one by one
+    for rec in (r for path in paths for r in read_records(path)):
+        session = current.get(rec.self_id)
+        if rec.kind == KIND_OPEN or session is None:
+            info = json.loads(rec.data) if rec.kind == KIND_OPEN else {}
+            session = Session(rec.self_id, rec.time,
+                              _codecs.get(info.get('codec'), default_codec),
+                              bool(info.get('batch')))
+            current[rec.self_id] = session
+            sessions.append(session)
+        if rec.kind == KIND_IN:
+            session.on_in(rec.time, rec.data)
+        elif rec.kind == KIND_OUT:
+            session.on_out(rec.time, rec.data)
+        elif rec.kind == KIND_CLOSE:
+            del current[rec.self_id]
+    return [s for s in sessions if s.events]
+
+
+def event_latencies(events: List[float], calls: List[float]) -> List[float]:
+    """Latency from each event to the first call before the next event."""
+    result = []
+    j = 0
+    for i, t in enumerate(events):
+        end = events[i + 1] if i + 1 < len(events) else math.inf
+        while j < len(calls) and calls[j] < t:
+            j += 1
+        if j < len(calls) and calls[j] < end:
+            result.append(calls[j] - t)
+    return result
+
+
+class Replayer:
+    def __init__(self, session: Session, url: str, access_token: str,
+                 settle: float, run_id: Optional[int]):
+        self.session = session
+        self._frames = [
+            with_message_id(session.codec, frame, run_id)
+            if run_id is not None else frame for _, frame in session.events
+        ]
+        self._url = url
+        self._access_token = access_token
+        self._settle = settle
+        self._results = {k: deque(v) for k, v in session.results.items()}
+        # value: (time, raw frame)
+        self.events: List[Tuple[float, Union[str, bytes]]] = []
+        self.calls: List[Tuple[float, str, Any]] = []
+        self.error: Optional[str] = None
+
+    async def run(self, start: float, t0: float, speed: float) -> None:
+        session = self.session
+        headers = {'X-Self-ID': session.self_id}
+        if session.batch:
+            headers['X-Batch-Actions'] = '1'
+        if self._access_token:
+            headers['Authorization'] = f'Bearer {self._access_token}'
+        kwargs = {_HEADERS_KWARG: headers, 'max_size': None}
+        if session.codec is not default_codec:
+            kwargs['subprotocols'] = [session.codec.name]
+
+        await self._sleep_until(start, t0, session.opened_at, speed)
+        try:
+            ws = await ws_connect(self._url, **kwargs)
+        except Exception as e:
+            self.error = f'failed to connect: {e}'
+            return
+        reader = asyncio.ensure_future(self._read(ws))
+        try:
+            for (ts, _), frame in zip(session.events, self._frames):
+                await self._sleep_until(start, t0, ts, speed)
+                self.events.append((time.perf_counter(), frame))
+                await ws.send(frame)
+            # wait for the replies to the last events
+            last = len(self.calls)
+            while True:
+                await asyncio.sleep(self._settle)
+                if len(self.calls) == last:
+                    break
+                last = len(self.calls)
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            reader.cancel()
+            await ws.close()
+
+    @staticmethod
+    async def _sleep_until(start: float, t0: float, ts: float,
+                           speed: float) -> None:
+        if speed > 0:
+            delay = start + (ts - t0) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _read(self, ws) -> None:
+        codec = self.session.codec
+        async for frame in ws:
+            try:
+                payload = codec.loads(frame)
+            except ValueError:
+                continue
+            requests = payload if isinstance(payload, list) else [payload]
+            results = [
+                self._on_request(r) for r in requests if isinstance(r, dict)
+            ]
+            if isinstance(payload, list):
+                await ws.send(codec.dumps(results))
+            else:
+                for result in results:
+                    await ws.send(codec.dumps(result))
+
+    def _on_request(self, request: dict) -> dict:
+        action = request.get('action')
+        if action != HEARTBEAT_ACTION:
+            self.calls.append(
+                (time.perf_counter(), action, request.get('params')))
+        recorded = self._results.get(action)
+        if recorded:
+            result = dict(recorded.popleft())
+        else:
+            result = {'status': 'ok', 'retcode': 0, 'data': None}
+        result['echo'] = request.get('echo')
+        return result
+
+
+def compare(replayers: List[Replayer], elapsed: float,
+            speed: float) -> None:
+    matched = missing = extra = 0
+    # value: (self_id, 'missing' or 'extra', call)
+    diffs: List[Tuple[str, str, str]] = []
+    recorded_latencies, replayed_latencies = [], []
+    for r in replayers:
+        s = r.session
+        if r.error:
+            print(f'{s.self_id}: {r.error}')
+
+        # events of a connection are handled concurrently,
+        # so the order of the actions is not compared
+        recorded = Counter(_normalize(a, p) for _, a, p in s.calls)
+        replayed = Counter(_normalize(a, p) for _, a, p in r.calls)
+        matched += sum((recorded & replayed).values())
+        for kind, calls in (('missing', recorded - replayed),
+                            ('extra', replayed - recorded)):
+            count = sum(calls.values())
+            if kind == 'missing':
+                missing += count
+            else:
+                extra += count
+            diffs += [(s.self_id, kind, c) for c in calls][:5 - len(diffs)]
+
+        recorded_latencies += event_latencies([t for t, _ in s.events],
+                                              [t for t, _, _ in s.calls])
+        replayed_latencies += event_latencies([t for t, _ in r.events],
+                                              [t for t, _, _ in r.calls])
+
+    events = sum(len(r.events) for r in replayers)
+    print(f'\nreplayed {events} events of {len(replayers)} connections '
+          f'in {elapsed:.1f}s ({events / elapsed:.1f}/s)')
+    print(f'actions: {matched} matched, {missing} missing, {extra} extra')
+    for self_id, kind, call in diffs:
+        print(f'  {kind} on {self_id}: {_short(call)}')
+
+    if speed <= 0:
+        # events are sent back to back, the actions can't be told apart
+        print('latencies are not measured at max speed')
+        return
+    print(f'{"latency":<10}{"events":>8}'
+          f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name, samples in (('recorded', recorded_latencies),
+                          ('replayed', replayed_latencies)):
+        samples.sort()
+        cols = [percentile(samples, p) for p in (50, 95, 99, 100)]
+        print(f'{name:<10}{len(samples):>8}' + ''.join(
+            f'{x * 1000:>10.1f}' if x is not None else f'{"-":>10}'
+            for x in cols))
+
+
+def _normalize(action: str, params: Any) -> str:
+    return json.dumps([action, params],
+                      sort_keys=True,
+                      ensure_ascii=False,
+                      default=str)
+
+
+def _short(text: str, limit: int = 200) -> str:
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+async def run(args: argparse.Namespace) -> None:
+    sessions = load_sessions(args.files)
+    if args.self_id:
+        sessions = [s for s in sessions if s.self_id in args.self_id]
+    if not sessions:
+        print('No events to replay.')
+        return
+    print(f'Loaded {len(sessions)} connections, '
+          f'{sum(len(s.events) for s in sessions)} events')
+
+    t0 = min(s.opened_at for s in sessions)
+    run_id = None if args.keep_message_ids else int(time.time())
+    replayers = [
+        Replayer(s, args.url, args.access_token, args.settle, run_id)
+        for s in sessions
+    ]
+    start = time.perf_counter()
+    await asyncio.gather(*(r.run(start, t0, args.speed) for r in replayers))
+    compare(replayers, time.perf_counter() - start, args.speed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay recorded websocket traffic into a local bot.')
+    parser.add_argument('files',
+                        nargs='+',
+                        help='files recorded by TRAFFIC_RECORD_PATH')
+    parser.add_argument('--url', default='ws://127.0.0.1:8080/ws')
+    parser.add_argument('--access-token', default='')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='speed factor, 0 for as fast as possible')
+    parser.add_argument('--self-id', action='append',
+                        help='only replay these speakers')
+    parser.add_argument('--keep-message-ids',
+                        action='store_true',
+                        help='send the events with their original ids')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds without actions before a '
+                        'connection is considered done')
+    args = parser.parse_args()
+
+    if ws_connect is None:
+        print('The "websockets" package is required.', file=sys.stderr)
+        exit(1)
+    if args.speed < 0:
+        parser.error('the speed must not be negative')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from nonebot.default_config import *
 COMMAND_START = {'', '/', '!', '.'}
 
 # 腾讯 AI
+TENCENT_AI_API_ROOT = 'https://api.ai.qq.com/fcgi-bin'
 TENCENT_AI_APP_ID = ''
 TENCENT_AI_APP_KEY = ''
 
@@ -8,10 +8,25 @@ from urllib.parse import urlencode
 import httpx
 
 import nonebot
+from anybot.metrics import Histogram
+from nonebot.log import logger
 
-STT_API_URL = 'https://api.ai.qq.com/fcgi-bin/aai/aai_asr'
-TTS_API_URL = 'https://api.ai.qq.com/fcgi-bin/aai/aai_tts'
-CHAT_API_URL = 'https://api.ai.qq.com/fcgi-bin/nlp/nlp_textchat'
+STT_API_PATH = '/aai/aai_asr'
+TTS_API_PATH = '/aai/aai_tts'
+CHAT_API_PATH = '/nlp/nlp_textchat'
+
+_request_latency = Histogram('milktea_vendor_request_seconds',
+                             'Latency of AI vendor HTTP requests.',
+                             ['vendor', 'api'])
+_request_latency_by_path = {
+    STT_API_PATH: _request_latency.labels('tencent_ai', 'stt'),
+    TTS_API_PATH: _request_latency.labels('tencent_ai', 'tts'),
+    CHAT_API_PATH: _request_latency.labels('tencent_ai', 'chat'),
+}
+
+
+def get_api_root() -> str:
+    return nonebot.get_bot().config.TENCENT_AI_API_ROOT.rstrip('/')
 
 
 def get_app_id() -> str:
@@ -28,15 +43,23 @@ def calc_sign(params: Dict[str, str]) -> None:
     params['sign'] = md5(query.encode()).hexdigest().upper()
 
 
-async def do_post_request(url: str,
+async def do_post_request(path: str,
                           params: Dict[str, str]) -> Optional[Dict[str, Any]]:
     if not params.get('sign'):
         calc_sign(params)
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, data=params)
+    latency = _request_latency_by_path.get(path)
+    start = time.perf_counter()
+    try:
+        async with httpx.AsyncClient() as client:
+            resp = await client.post(get_api_root() + path, data=params)
+    finally:
+        if latency is not None:
+            latency.observe(time.perf_counter() - start)
     payload = resp.json()
-    print(payload)
+    # not the whole payload, which may contain the synthesized speech
+    logger.debug(f'Tencent AI {path} returned {payload.get("ret")}: '
+                 f'{payload.get("msg")}')
     if payload.get('ret') == 0:
         return payload['data']
     return None
@@ -67,7 +90,7 @@ async def stt(speech_base64: str) -> Optional[str]:
     params['format'] = '2'  # wav
     params['speech'] = speech_base64
     params['rate'] = '16000'  # 16000Hz 采样率
-    data = await do_post_request(STT_API_URL, params)
+    data = await do_post_request(STT_API_PATH, params)
     return data['text'] if data else None
 
 
@@ -90,7 +113,7 @@ async def tts(text: str) -> Optional[str]:
     params['aht'] = '0'
     params['apc'] = '58'
     params['text'] = text
-    data = await do_post_request(TTS_API_URL, params)
+    data = await do_post_request(TTS_API_PATH, params)
     return data['speech'] if data else None
 
 
@@ -109,5 +132,5 @@ async def chat(question: str, session: str) -> Optional[str]:
     params = gen_base_params()
     params['question'] = question
     params['session'] = session
-    data = await do_post_request(CHAT_API_URL, params)
+    data = await do_post_request(CHAT_API_PATH, params)
     return data['answer'] if data else None
@@ -1,5 +1,5 @@
 from milktea.ai_vendor import tencent_ai
-from nonebot import (NoneBot, Event, Message, before_handle_message,
+from nonebot import (NoneBot, Event, Message, Audio, before_handle_message,
                      before_send_message)
 
 
@@ -9,9 +9,9 @@ async def stt(bot: NoneBot, event: Event):
     for seg in event.message:
         if seg.type != 'record':
             continue
-        speech_base64 = seg.data.get('base64')
-        if speech_base64:
-            text = await tencent_ai.stt(speech_base64)
+        audio = seg.data.get('audio')
+        if isinstance(audio, Audio):
+            text = await tencent_ai.stt(audio.base64)
             if text:
                 seg.type = 'text'
                 seg.data = {'text': text}
@@ -30,5 +30,5 @@ async def tts(bot: NoneBot, event: Event, message: Message):
             speech_base64 = await tencent_ai.tts(text)
             if speech_base64:
                 seg.type = 'record'
-                seg.data = {'base64': speech_base64}
+                seg.data = {'audio': Audio(base64=speech_base64)}
     message.reduce()
@@ -1,10 +1,12 @@
-import asyncio
 import logging
+from functools import wraps
 from typing import Any, Optional, Callable, Awaitable
 
 from anybot import AnyBot, Event, Message, Error
+from anybot.workers import worker_index
 
 from .log import logger
+from .routing import Routing
 from .sched import Scheduler
 
 if Scheduler:
@@ -30,12 +32,23 @@ class NoneBot(AnyBot):
 
         self.config = config_object
         self.asgi.debug = self.config.DEBUG
+        self._routing = Routing.from_config(self.config)
 
         from .message import handle_message
 
         @self.on_message
         async def _(event: Event):
-            asyncio.create_task(handle_message(self, event))
+            await handle_message(self, event)
+
+    @property
+    def routing(self) -> Routing:
+        """
+        Compiled routing configuration, rebuilt when NICKNAME, COMMAND_START
+        or COMMAND_SEP of the config object is replaced or modified in place.
+        """
+        if not self._routing.is_built_from(self.config):
+            self._routing = Routing.from_config(self.config)
+        return self._routing
 
     def run(self,
             host: Optional[str] = None,
@@ -44,6 +57,16 @@ class NoneBot(AnyBot):
             **kwargs) -> None:
         host = host or self.config.HOST
         port = port or self.config.PORT
+        if self.config.WORKERS > 1:
+            logger.info(f'Running on {host}:{port} '
+                        f'with {self.config.WORKERS} workers')
+            if scheduler and scheduler.get_jobs():
+                logger.warning('Scheduled jobs run in the first worker only, '
+                               'and can only call the API of the speakers '
+                               'connected to that worker')
+            self.run_workers(self.config.WORKERS, host=host, port=port)
+            return
+
         if 'debug' not in kwargs:
             kwargs['debug'] = self.config.DEBUG
 
@@ -75,8 +98,14 @@ def init(config_object: Optional[Any] = None) -> None:
     _bot.server_app.before_serving(_start_scheduler)
 
 
+def _in_first_worker() -> bool:
+    # every worker starts the server app, run the things meant to run once
+    # per bot in one of them
+    return worker_index() in (None, 0)
+
+
 async def _start_scheduler():
-    if scheduler and not scheduler.running:
+    if scheduler and not scheduler.running and _in_first_worker():
         scheduler.configure(_bot.config.APSCHEDULER_CONFIG)
         scheduler.start()
         logger.info('Scheduler started')
@@ -108,14 +137,23 @@ def on_startup(func: Callable[[], Awaitable[None]]) \
         -> Callable[[], Awaitable[None]]:
     """
     Decorator to register a function as startup callback.
+
+    In the worker mode (WORKERS > 1), it's called in the first worker only,
+    where only the speakers connected to that worker are reachable.
     """
-    return get_bot().server_app.before_serving(func)
+    @wraps(func)
+    async def callback():
+        if _in_first_worker():
+            await func()
+
+    get_bot().server_app.before_serving(callback)
+    return func
 
 
 from .plugin import (load_plugin, load_plugins, load_builtin_plugins,
                      get_loaded_plugins)
 from .message import (before_handle_message, before_send_message, Message,
-                      MessageSegment)
+                      MessageSegment, Audio, ParsedMessage)
 from .command import on_command, CommandSession, CommandGroup
 from .natural_language import (on_natural_language, NLPSession, NLPResult,
                                IntentCommand)
@@ -139,6 +177,8 @@ __all__ = [
     'before_send_message',
     'Message',
     'MessageSegment',
+    'Audio',
+    'ParsedMessage',
     'on_command',
     'CommandSession',
     'CommandGroup',
@@ -1,5 +1,4 @@
 import asyncio
-import re
 import shlex
 import warnings
 from datetime import datetime
@@ -8,12 +7,16 @@ from typing import (Tuple, Union, Callable, Iterable, Any, Optional, List,
                     Dict, Awaitable)
 
 from anybot import Event
+from anybot.metrics import Gauge
 
 from nonebot import NoneBot
 from nonebot.command.argfilter import ValidateError
+# noinspection PyProtectedMember
+from nonebot.command.argfilter.extractors import _filtering_session
 from nonebot.helpers import context_id, render_expression
 from nonebot.log import logger
-from nonebot.message import Message
+from nonebot.message import Message, ParsedMessage
+from nonebot.routing import Routing
 from nonebot.session import BaseSession
 from nonebot.typing import (CommandName_T, CommandArgs_T, Message_T, State_T,
                             Filter_T)
@@ -22,14 +25,29 @@ from nonebot.typing import (CommandName_T, CommandArgs_T, Message_T, State_T,
 # value: subtree or a leaf Command object
 _registry = {}  # type: Dict[str, Union[Dict, Command]]
 
+# key: full command name
+# value: Command object
+_commands = {}  # type: Dict[CommandName_T, Command]
+
 # key: alias
 # value: real command name
 _aliases = {}  # type: Dict[str, CommandName_T]
 
+# key: every spelling of a command name that parse_command accepts, that is,
+#      the name joined by each string separator, and the aliases
+# value: Command object
+# built from the commands above for a Routing object, see _get_index()
+_index = {}  # type: Dict[str, Command]
+_index_routing = None  # type: Optional[Routing]
+
 # key: context id
 # value: CommandSession object
 _sessions = {}  # type: Dict[str, CommandSession]
 
+_active_sessions = Gauge('nonebot_command_sessions',
+                         'Number of active command sessions.')
+_active_sessions.set_function(lambda: len(_sessions))
+
 CommandHandler_T = Callable[['CommandSession'], Any]
 
 
@@ -64,36 +82,40 @@ class Command:
             # argument-level filters are given, use them
             arg = session.current_arg
             config = session.bot.config
-            for f in session.current_arg_filters:
-                try:
-                    res = f(arg)
-                    if isinstance(res, Awaitable):
-                        res = await res
-                    arg = res
-                except ValidateError as e:
-                    # validation failed
-                    if config.MAX_VALIDATION_FAILURES > 0:
-                        # should check number of validation failures
-                        session.state['__validation_failure_num'] = \
-                            session.state.get(
-                                '__validation_failure_num', 0) + 1
-
-                        if session.state['__validation_failure_num'] >= \
-                                config.MAX_VALIDATION_FAILURES:
-                            # noinspection PyProtectedMember
-                            session.finish(
-                                render_expression(
-                                    config.
-                                    TOO_MANY_VALIDATION_FAILURES_EXPRESSION),
-                                **session._current_send_kwargs)
-
-                    failure_message = e.message
-                    if failure_message is None:
-                        failure_message = render_expression(
-                            config.DEFAULT_VALIDATION_FAILURE_EXPRESSION)
-                    # noinspection PyProtectedMember
-                    session.pause(failure_message,
-                                  **session._current_send_kwargs)
+            token = _filtering_session.set(session)
+            try:
+                for f in session.current_arg_filters:
+                    try:
+                        res = f(arg)
+                        if isinstance(res, Awaitable):
+                            res = await res
+                        arg = res
+                    except ValidateError as e:
+                        # validation failed
+                        if config.MAX_VALIDATION_FAILURES > 0:
+                            # should check number of validation failures
+                            session.state['__validation_failure_num'] = \
+                                session.state.get(
+                                    '__validation_failure_num', 0) + 1
+
+                            if session.state['__validation_failure_num'] >= \
+                                    config.MAX_VALIDATION_FAILURES:
+                                # noinspection PyProtectedMember
+                                session.finish(
+                                    render_expression(
+                                        config.
+                                        TOO_MANY_VALIDATION_FAILURES_EXPRESSION
+                                    ), **session._current_send_kwargs)
+
+                        failure_message = e.message
+                        if failure_message is None:
+                            failure_message = render_expression(
+                                config.DEFAULT_VALIDATION_FAILURE_EXPRESSION)
+                        # noinspection PyProtectedMember
+                        session.pause(failure_message,
+                                      **session._current_send_kwargs)
+            finally:
+                _filtering_session.reset(token)
 
             # passed all filters
             session.state[session.current_key] = arg
@@ -172,6 +194,7 @@ def on_command(name: Union[str, CommandName_T],
             warnings.warn(f'There is already a command named {cmd_name}')
             return func
         current_parent[cmd_name[-1]] = cmd
+        _commands[cmd_name] = cmd
 
         nonlocal aliases
         if isinstance(aliases, str):
@@ -179,6 +202,8 @@ def on_command(name: Union[str, CommandName_T],
         for alias in aliases:
             _aliases[alias] = cmd_name
 
+        global _index_routing
+        _index_routing = None  # rebuild the index on the next lookup
         return func
 
     return deco
@@ -186,17 +211,49 @@ def on_command(name: Union[str, CommandName_T],
 
 def _find_command(name: Union[str, CommandName_T]) -> Optional[Command]:
     cmd_name = (name, ) if isinstance(name, str) else name
-    if not cmd_name:
-        return None
+    return _commands.get(cmd_name)
+
+
+def _get_index(routing: Routing) -> Dict[str, Command]:
+    global _index, _index_routing
+    if _index_routing is routing:
+        return _index
+
+    index = {}
+    for cmd_name, cmd in _commands.items():
+        if len(cmd_name) == 1:
+            spellings = cmd_name
+        else:
+            spellings = (sep.join(cmd_name) for sep in routing.command_seps
+                         if isinstance(sep, str))
+        for spelling in spellings:
+            # only the spellings that are split back into the name,
+            # e.g. not "a.b/c" for ('a.b', 'c') if "." is also a separator
+            if routing.split_command_name(spelling) == cmd_name:
+                index[spelling] = cmd
+    for alias, cmd_name in _aliases.items():
+        # aliases are checked before splitting
+        if cmd_name in _commands:
+            index[alias] = _commands[cmd_name]
+        else:
+            index.pop(alias, None)
 
-    cmd_tree = _registry
-    for part in cmd_name[:-1]:
-        if part not in cmd_tree or not isinstance(cmd_tree[part], dict):
-            return None
-        cmd_tree = cmd_tree[part]
+    _index, _index_routing = index, routing
+    return index
 
-    cmd = cmd_tree.get(cmd_name[-1])
-    return cmd if isinstance(cmd, Command) else None
+
+def dump_command_index(bot: NoneBot) -> Dict[str, CommandName_T]:
+    """
+    Get all spellings of command names that are accepted in messages,
+    except the ones only matched by regex separators, for debugging.
+
+    :param bot: NoneBot instance
+    :return: dict of spelling to command name
+    """
+    return {
+        spelling: cmd.name
+        for spelling, cmd in _get_index(bot.routing).items()
+    }
 
 
 class _PauseException(Exception):
@@ -238,9 +295,9 @@ class SwitchException(Exception):
 
 class CommandSession(BaseSession):
     __slots__ = ('cmd', 'current_key', 'current_arg_filters',
-                 '_current_send_kwargs', 'current_arg', '_current_arg_text',
-                 '_current_arg_images', '_state', '_last_interaction',
-                 '_running', '_run_future')
+                 '_current_send_kwargs', 'current_arg', '_current_arg_parsed',
+                 '_state', '_last_interaction', '_running', '_released',
+                 '_run_future')
 
     def __init__(self,
                  bot: NoneBot,
@@ -262,12 +319,13 @@ class CommandSession(BaseSession):
 
         # initialize current argument
         self.current_arg: str = ''  # with potential MT codes
-        self._current_arg_text = None
-        self._current_arg_images = None
+        self._current_arg_parsed: Optional[ParsedMessage] = None
         self.refresh(event, current_arg=current_arg)  # fill the above
 
-        self._run_future = partial(asyncio.run_coroutine_threadsafe,
-                                   loop=bot.loop)
+        # tracked by the bot, so that the messages are sent before shutdown
+        self._run_future = partial(bot.tasks.spawn_threadsafe,
+                                   loop=bot.loop,
+                                   kind='send')
 
         self._state: State_T = {}
         if args:
@@ -275,6 +333,9 @@ class CommandSession(BaseSession):
 
         self._last_interaction = None  # last interaction time of this session
         self._running = False
+        # set when the session is not running or is removed from its context
+        self._released = asyncio.Event()
+        self._released.set()
 
     @property
     def state(self) -> State_T:
@@ -301,6 +362,10 @@ class CommandSession(BaseSession):
             # change status from running to not running, record the time
             self._last_interaction = datetime.now()
         self._running = value
+        if value:
+            self._released.clear()
+        else:
+            self._released.set()
 
     @property
     def is_valid(self) -> bool:
@@ -316,27 +381,30 @@ class CommandSession(BaseSession):
     def is_first_run(self) -> bool:
         return self._last_interaction is None
 
+    @property
+    def current_arg_parsed(self) -> ParsedMessage:
+        """
+        The current argument parsed, shared with the event if the argument
+        is the whole message.
+        """
+        if self._current_arg_parsed is None or \
+                self._current_arg_parsed.raw != self.current_arg:
+            self._current_arg_parsed = ParsedMessage(self.current_arg)
+        return self._current_arg_parsed
+
     @property
     def current_arg_text(self) -> str:
         """
         Plain text part in the current argument, without any MT codes.
         """
-        if self._current_arg_text is None:
-            self._current_arg_text = Message(
-                self.current_arg).extract_plain_text()
-        return self._current_arg_text
+        return self.current_arg_parsed.text
 
     @property
     def current_arg_images(self) -> List[str]:
         """
         Images (as list of urls) in the current argument.
         """
-        if self._current_arg_images is None:
-            self._current_arg_images = [
-                s.data['url'] for s in Message(self.current_arg)
-                if s.type == 'image' and 'url' in s.data
-            ]
-        return self._current_arg_images
+        return self.current_arg_parsed.images
 
     @property
     def argv(self) -> List[str]:
@@ -355,8 +423,11 @@ class CommandSession(BaseSession):
         """
         self.event = event
         self.current_arg = current_arg
-        self._current_arg_text = None
-        self._current_arg_images = None
+        parsed = ParsedMessage.of(event)
+        if parsed.raw == current_arg:
+            self._current_arg_parsed = parsed
+        else:
+            self._current_arg_parsed = None
 
     def get(self,
             key: str,
@@ -439,24 +510,8 @@ def parse_command(bot: NoneBot,
     """
     logger.debug(f'Parsing command: {repr(cmd_string)}')
 
-    matched_start = None
-    for start in bot.config.COMMAND_START:
-        # loop through COMMAND_START to find the longest matched start
-        curr_matched_start = None
-        if isinstance(start, type(re.compile(''))):
-            m = start.search(cmd_string)
-            if m and m.start(0) == 0:
-                curr_matched_start = m.group(0)
-        elif isinstance(start, str):
-            if cmd_string.startswith(start):
-                curr_matched_start = start
-
-        if curr_matched_start is not None and \
-                (matched_start is None or
-                 len(curr_matched_start) > len(matched_start)):
-            # a longer start, use it
-            matched_start = curr_matched_start
-
+    routing = bot.routing
+    matched_start = routing.match_command_start(cmd_string)
     if matched_start is None:
         # it's not a command
         logger.debug('It\'s not a command')
@@ -471,29 +526,17 @@ def parse_command(bot: NoneBot,
         return None, None
 
     cmd_name_text, *cmd_remained = full_command.split(maxsplit=1)
-    cmd_name = _aliases.get(cmd_name_text)
-
-    if not cmd_name:
-        for sep in bot.config.COMMAND_SEP:
-            # loop through COMMAND_SEP to find the most optimized split
-            curr_cmd_name = None
-            if isinstance(sep, type(re.compile(''))):
-                curr_cmd_name = tuple(sep.split(cmd_name_text))
-            elif isinstance(sep, str):
-                curr_cmd_name = tuple(cmd_name_text.split(sep))
-
-            if curr_cmd_name is not None and \
-                    (not cmd_name or len(curr_cmd_name) > len(cmd_name)):
-                # a more optimized split, use it
-                cmd_name = curr_cmd_name
-
-        if not cmd_name:
-            cmd_name = (cmd_name_text, )
-
-    logger.debug(f'Split command name: {cmd_name}')
-    cmd = _find_command(cmd_name)
+    cmd = _get_index(routing).get(cmd_name_text)
+
+    if not cmd and cmd_name_text not in _aliases and \
+            routing.has_pattern_seps:
+        # the spellings split by regex separators are not in the index
+        cmd_name = routing.split_command_name(cmd_name_text)
+        logger.debug(f'Split command name: {cmd_name}')
+        cmd = _find_command(cmd_name)
+
     if not cmd:
-        logger.debug(f'Command {cmd_name} not found')
+        logger.debug(f'Command {cmd_name_text} not found')
         return None, None
 
     logger.debug(f'Command {cmd.name} found, function: {cmd.func}')
@@ -510,7 +553,8 @@ async def handle_command(bot: NoneBot, event: Event) -> bool:
     :param event: message event
     :return: the message is handled as a command
     """
-    cmd, current_arg = parse_command(bot, str(event.message).lstrip())
+    parsed = ParsedMessage.of(event)
+    cmd, current_arg = parse_command(bot, parsed.raw.lstrip())
     is_privileged_cmd = cmd and cmd.privileged
     if is_privileged_cmd and cmd.only_to_me and not event['to_me']:
         is_privileged_cmd = False
@@ -521,13 +565,10 @@ async def handle_command(bot: NoneBot, event: Event) -> bool:
 
     ctx_id = context_id(event)
 
-    if not is_privileged_cmd:
-        # wait for 1.5 seconds (at most) if the current session is running
-        retry = 5
-        while retry > 0 and \
-                _sessions.get(ctx_id) and _sessions[ctx_id].running:
-            retry -= 1
-            await asyncio.sleep(0.3)
+    if not is_privileged_cmd and bot.config.SESSION_RUNNING_WAIT:
+        # wait (for a while at most) if the current session is running
+        await _wait_for_session_released(
+            ctx_id, bot.config.SESSION_RUNNING_WAIT.total_seconds())
 
     session = _sessions.get(ctx_id) if not is_privileged_cmd else None
     if session:
@@ -535,9 +576,8 @@ async def handle_command(bot: NoneBot, event: Event) -> bool:
             logger.warning(f'There is a session of command '
                            f'{session.cmd.name} running, notify the user')
             from nonebot.message import send
-            asyncio.ensure_future(
-                send(bot, event,
-                     render_expression(bot.config.SESSION_RUNNING_EXPRESSION)))
+            msg = render_expression(bot.config.SESSION_RUNNING_EXPRESSION)
+            bot.tasks.spawn(send(bot, event, msg), kind='send')
             # pretend we are successful, so that NLP won't handle it
             return True
 
@@ -545,7 +585,7 @@ async def handle_command(bot: NoneBot, event: Event) -> bool:
             logger.debug(f'Session of command {session.cmd.name} exists')
             # since it's in a session, the user must be talking to me
             event['to_me'] = True
-            session.refresh(event, current_arg=str(event['message']))
+            session.refresh(event, current_arg=parsed.raw)
             # there is no need to check permission for existing session
         else:
             # the session is expired, remove it
@@ -569,6 +609,28 @@ async def handle_command(bot: NoneBot, event: Event) -> bool:
                                    disable_interaction=disable_interaction)
 
 
+async def _wait_for_session_released(ctx_id: str, timeout: float) -> None:
+    """
+    Wait until there is no running session in the given context,
+    or the timeout expires.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        session = _sessions.get(ctx_id)
+        if not session or not session.running:
+            return
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return
+        try:
+            # noinspection PyProtectedMember
+            await asyncio.wait_for(session._released.wait(), remaining)
+        except asyncio.TimeoutError:
+            return
+        # another message may have taken the session, check again
+
+
 async def call_command(bot: NoneBot,
                        event: Event,
                        name: Union[str, CommandName_T],
@@ -677,7 +739,8 @@ def kill_current_session(event: Event) -> None:
     """
     ctx_id = context_id(event)
     if ctx_id in _sessions:
-        del _sessions[ctx_id]
+        # wake up the messages waiting for it
+        _sessions.pop(ctx_id)._released.set()
 
 
 from nonebot.command.group import CommandGroup
@@ -1,28 +1,37 @@
 import re
-from typing import List
+from contextvars import ContextVar
+from typing import List, Union
 
-from nonebot.message import Message
+from nonebot.message import ParsedMessage
 from nonebot.typing import Message_T
 
+# the session whose argument filters are running, set by Command.run
+_filtering_session = ContextVar('_filtering_session', default=None)
 
-def _extract_text(arg: Message_T) -> str:
+
+def _parsed(arg: Union[Message_T, ParsedMessage]) -> ParsedMessage:
+    if isinstance(arg, ParsedMessage):
+        return arg
+    session = _filtering_session.get()
+    if session is not None and arg is session.current_arg:
+        # the argument as is, reuse the parse shared with the session
+        return session.current_arg_parsed
+    return ParsedMessage(arg)
+
+
+def _extract_text(arg: Union[Message_T, ParsedMessage]) -> str:
     """Extract all plain text segments from a message-like object."""
-    arg_as_msg = Message(arg)
-    return arg_as_msg.extract_plain_text()
+    return _parsed(arg).text
 
 
-def _extract_image_urls(arg: Message_T) -> List[str]:
+def _extract_image_urls(arg: Union[Message_T, ParsedMessage]) -> List[str]:
     """Extract all image urls from a message-like object."""
-    arg_as_msg = Message(arg)
-    return [
-        s.data['url'] for s in arg_as_msg
-        if s.type == 'image' and 'url' in s.data
-    ]
+    return _parsed(arg).images
 
 
-def _extract_numbers(arg: Message_T) -> List[float]:
+def _extract_numbers(arg: Union[Message_T, ParsedMessage]) -> List[float]:
     """Extract all numbers (integers and floats) from a message-like object."""
-    s = str(arg)
+    s = _parsed(arg).raw
     return list(map(float, re.findall(r'[+-]?(\d*\.?\d+|\d+\.?\d*)', s)))
 
 
@@ -25,6 +25,13 @@ SECRET: str = ''
 HOST: str = '127.0.0.1'
 PORT: int = 8080
 DEBUG: bool = True
+# > 1 for the worker mode, see anybot/workers.py, the scheduler and the
+# on_startup callbacks run in the first worker only
+WORKERS: int = 1
+METRICS_PATH: Optional[str] = '/metrics'  # None to disable
+# record websocket traffic for benchmarks/replay.py, None to disable,
+# include "{pid}" in the path when running with multiple workers
+TRAFFIC_RECORD_PATH: Optional[str] = None
 
 SUPERUSERS: Container[int] = set()
 NICKNAME: Union[str, Iterable[str]] = ''
@@ -34,6 +41,9 @@ COMMAND_SEP: Iterable[Union[str, Pattern]] = {'/', '.'}
 
 SESSION_EXPIRE_TIMEOUT: Optional[timedelta] = timedelta(minutes=5)
 SESSION_RUN_TIMEOUT: Optional[timedelta] = None
+# how long a message waits for the running session of its context to pause
+# or finish, before SESSION_RUNNING_EXPRESSION is sent, None to not wait
+SESSION_RUNNING_WAIT: Optional[timedelta] = timedelta(seconds=1.5)
 SESSION_RUNNING_EXPRESSION: Expression_T = '您有命令正在执行，请稍后再试'
 
 SHORT_MESSAGE_MAX_LENGTH: int = 50
@@ -45,4 +55,41 @@ TOO_MANY_VALIDATION_FAILURES_EXPRESSION: Expression_T = \
 
 SESSION_CANCEL_EXPRESSION: Expression_T = '好的'
 
+EVENT_QUEUE_SIZE: int = 100
+EVENT_QUEUE_OVERFLOW: str = 'drop_oldest'  # or 'drop_newest', 'block'
+EVENT_QUEUE_WORKERS: int = 4
+EVENT_MAX_AGE: Optional[timedelta] = timedelta(seconds=30)
+# key: event type or name, value: priority, the smaller the higher
+EVENT_PRIORITIES: Dict[str, int] = {
+    'meta_event': 0,
+    'notice': 0,
+    'request': 0,
+    'message': 1,
+}
+# key: priority, value: max number of events handled at the same time,
+# leave the rest of EVENT_QUEUE_WORKERS to higher priority events
+EVENT_LANE_CONCURRENCY: Dict[int, int] = {1: 3}
+# 0 to disable event de-duplication, only enable it, e.g. 10000, if the
+# speakers never reuse a message_id, not even after restarting, otherwise
+# their new messages are dropped as duplicates within EVENT_DEDUP_WINDOW
+EVENT_DEDUP_SIZE: int = 0
+EVENT_DEDUP_WINDOW: Optional[timedelta] = timedelta(minutes=5)
+
+HANDLER_EXECUTOR_WORKERS: Optional[int] = None  # None for the default
+HANDLER_EXECUTOR_QUEUE_SIZE: int = 100
+
+# None to disable heartbeats, only enable them for speakers that implement
+# the "heartbeat" action, e.g. timedelta(seconds=30), otherwise idle
+# speakers are disconnected after HEARTBEAT_MAX_MISSED intervals
+HEARTBEAT_INTERVAL: Optional[timedelta] = None
+HEARTBEAT_MAX_MISSED: int = 3
+# on shutdown, how long to wait for the accepted events and pending sends
+SHUTDOWN_DRAIN_TIMEOUT: timedelta = timedelta(seconds=30)
+
+ACTION_CACHE_SIZE: int = 1024
+# key: action name
+# value: keyword arguments of ActionCache.set_policy(), for example:
+# {'get_status': {'ttl': timedelta(seconds=5)}}
+ACTION_CACHE_POLICIES: Dict[str, Dict[str, Any]] = {}
+
 APSCHEDULER_CONFIG: Dict[str, Any] = {'apscheduler.timezone': 'Asia/Shanghai'}
@@ -1,6 +1,8 @@
+import time
 from typing import Callable, Awaitable
 
 from anybot.message import *
+from anybot.metrics import Histogram
 from anybot.utils import run_async_funcs
 
 from . import NoneBot, Event, Error
@@ -12,6 +14,11 @@ from .typing import Message_T
 _before_handle_message_funcs = set()
 _before_send_message_funcs = set()
 
+_command_latency = Histogram('nonebot_command_handling_seconds',
+                             'Time spent handling messages as commands.')
+_nlp_latency = Histogram('nonebot_nlp_handling_seconds',
+                         'Time spent handling messages as natural language.')
+
 
 def before_handle_message(
         func: Callable[[NoneBot, Event], Awaitable[None]]) -> Callable:
@@ -39,6 +46,7 @@ async def handle_message(bot: NoneBot, event: Event) -> None:
     _check_calling_me_nickname(bot, event)
     event['to_me'] = raw_to_me or event['to_me']
 
+    start = time.perf_counter()
     while True:
         try:
             handled = await handle_command(bot, event)
@@ -47,11 +55,14 @@ async def handle_message(bot: NoneBot, event: Event) -> None:
             # we are sure that there is no session existing now
             event['message'] = e.new_message
             event['to_me'] = True
+    _command_latency.observe(time.perf_counter() - start)
     if handled:
         logger.info(f'Message {event.message_id} is handled as a command')
         return
 
+    start = time.perf_counter()
     handled = await handle_natural_language(bot, event)
+    _nlp_latency.observe(time.perf_counter() - start)
     if handled:
         logger.info(f'Message {event.message_id} is handled '
                     f'as natural language')
@@ -73,16 +84,10 @@ def _check_calling_me_nickname(bot: NoneBot, event: Event) -> None:
 
     first_text = first_msg_seg.data['text']
 
-    if bot.config.NICKNAME:
+    nickname_re = bot.routing.nickname
+    if nickname_re:
         # check if the user is calling me with my nickname
-        if isinstance(bot.config.NICKNAME, str) or \
-                not isinstance(bot.config.NICKNAME, Iterable):
-            nicknames = (bot.config.NICKNAME, )
-        else:
-            nicknames = filter(lambda n: n, bot.config.NICKNAME)
-        nickname_regex = '|'.join(nicknames)
-        m = re.search(rf'^({nickname_regex})([\s,，]*|$)', first_text,
-                      re.IGNORECASE)
+        m = nickname_re.match(first_text)
         if m:
             nickname = m.group(1)
             logger.debug(f'User is calling me {nickname}')
@@ -1,12 +1,12 @@
 import asyncio
-from typing import Iterable, Optional, Callable, Union, NamedTuple
+from typing import Iterable, Optional, Callable, Union, NamedTuple, List
 
 from anybot import Event
 
 from . import NoneBot
 from .command import call_command
 from .log import logger
-from .message import Message
+from .message import ParsedMessage
 from .session import BaseSession
 from .typing import CommandName_T, CommandArgs_T
 
@@ -60,17 +60,23 @@ def on_natural_language(keywords: Union[Optional[Iterable], str,
 
 
 class NLPSession(BaseSession):
-    __slots__ = ('msg', 'msg_text', 'msg_images')
+    __slots__ = ('msg', 'parsed')
 
     def __init__(self, bot: NoneBot, event: Event, msg: str):
         super().__init__(bot, event)
         self.msg = msg
-        tmp_msg = Message(msg)
-        self.msg_text = tmp_msg.extract_plain_text()
-        self.msg_images = [
-            s.data['url'] for s in tmp_msg
-            if s.type == 'image' and 'url' in s.data
-        ]
+        parsed = ParsedMessage.of(event)
+        if parsed.raw != msg:
+            parsed = ParsedMessage(msg)
+        self.parsed = parsed
+
+    @property
+    def msg_text(self) -> str:
+        return self.parsed.text
+
+    @property
+    def msg_images(self) -> List[str]:
+        return self.parsed.images
 
 
 class NLPResult(NamedTuple):
@@ -108,11 +114,11 @@ async def handle_natural_language(bot: NoneBot, event: Event) -> bool:
     :param event: message event
     :return: the message is handled as natural language
     """
-    session = NLPSession(bot, event, str(event.message))
+    session = NLPSession(bot, event, ParsedMessage.of(event).raw)
 
     # use msg_text here because MT code may be very long,
     # at the same time some plugins may want to handle it
-    msg_text_length = len(session.msg_text)
+    msg_text_length = session.parsed.text_length
 
     futures = []
     for p in _nl_processors:
@@ -0,0 +1,121 @@
+import re
+from typing import Any, Iterable, NamedTuple, Optional, Pattern, Tuple, Union
+
+
+class Routing(NamedTuple):
+    """
+    Message routing configuration (NICKNAME, COMMAND_START, COMMAND_SEP)
+    compiled once, so that no regex is built while handling messages.
+
+    Use NoneBot.routing to get the one for the current configuration.
+    """
+
+    # matches a nickname at the beginning of a message and the separator
+    # after it, None if NICKNAME is empty
+    nickname: Optional[Pattern]
+
+    # matches the longest string command start at the beginning of a
+    # command string, None if there is no string command start
+    command_start: Optional[Pattern]
+
+    # the regex command starts, matched at the beginning separately
+    command_start_patterns: Tuple[Pattern, ...]
+
+    # the string separators and the regex ones
+    command_seps: Tuple[Union[str, Pattern], ...]
+
+    # snapshots of the config values this is built from, see _snapshot()
+    source: Tuple[Any, Any, Any]
+
+    @classmethod
+    def from_config(cls, config: Any) -> 'Routing':
+        nickname = None
+        if config.NICKNAME:
+            if isinstance(config.NICKNAME, str) or \
+                    not isinstance(config.NICKNAME, Iterable):
+                nicknames = (config.NICKNAME, )
+            else:
+                nicknames = filter(lambda n: n, config.NICKNAME)
+            nickname_regex = '|'.join(nicknames)
+            nickname = re.compile(rf'^({nickname_regex})([\s,，]*|$)',
+                                  re.IGNORECASE)
+
+        start_strings = []
+        start_patterns = []
+        for start in config.COMMAND_START:
+            if isinstance(start, re.Pattern):
+                start_patterns.append(start)
+            elif isinstance(start, str):
+                start_strings.append(start)
+        command_start = None
+        if start_strings:
+            # the first alternative that matches wins, so longer ones first
+            start_strings.sort(key=len, reverse=True)
+            command_start = re.compile('|'.join(
+                re.escape(s) for s in start_strings))
+
+        command_seps = tuple(sep for sep in config.COMMAND_SEP
+                             if isinstance(sep, (str, re.Pattern)))
+
+        return cls(nickname=nickname,
+                   command_start=command_start,
+                   command_start_patterns=tuple(start_patterns),
+                   command_seps=command_seps,
+                   source=_snapshot_config(config))
+
+    @property
+    def has_pattern_seps(self) -> bool:
+        return any(not isinstance(sep, str) for sep in self.command_seps)
+
+    def is_built_from(self, config: Any) -> bool:
+        """
+        Check if the config values are still the same, whether they are
+        replaced or modified in place, e.g. COMMAND_START.add('!').
+        """
+        return self.source == _snapshot_config(config)
+
+    def match_command_start(self, cmd_string: str) -> Optional[str]:
+        """Return the longest command start of the string, if any."""
+        matched_start = None
+        if self.command_start is not None:
+            m = self.command_start.match(cmd_string)
+            if m:
+                matched_start = m.group(0)
+        for pattern in self.command_start_patterns:
+            m = pattern.match(cmd_string)
+            if m and (matched_start is None
+                      or len(m.group(0)) > len(matched_start)):
+                matched_start = m.group(0)
+        return matched_start
+
+    def split_command_name(self, cmd_name_text: str) -> Tuple[str, ...]:
+        """Split the command name with the separator giving most parts."""
+        cmd_name = None
+        for sep in self.command_seps:
+            if isinstance(sep, str):
+                if sep not in cmd_name_text:
+                    # can't be better than the current one
+                    curr_cmd_name = (cmd_name_text, )
+                else:
+                    curr_cmd_name = tuple(cmd_name_text.split(sep))
+            else:
+                curr_cmd_name = tuple(sep.split(cmd_name_text))
+            if not cmd_name or len(curr_cmd_name) > len(cmd_name):
+                cmd_name = curr_cmd_name
+        return cmd_name or (cmd_name_text, )
+
+
+def _snapshot(value: Any) -> Any:
+    # the values are a few strings or patterns, cheap to copy and compare
+    if isinstance(value, str):
+        return value
+    try:
+        return tuple(value)
+    except TypeError:
+        # not iterable
+        return value
+
+
+def _snapshot_config(config: Any) -> Tuple[Any, Any, Any]:
+    return (_snapshot(config.NICKNAME), _snapshot(config.COMMAND_START),
+            _snapshot(config.COMMAND_SEP))
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+import nonebot.command as command
+from anybot import Event
+from nonebot.message import Message
+from nonebot.routing import Routing
+
+
+class FakeBot:
+    """
+    A bot with the config the command code reads. Sends are recorded by
+    the kind of the task instead of being run.
+    """
+
+    def __init__(self,
+                 command_sep=('/', '.'),
+                 command_start=('', '/'),
+                 running_wait=None):
+        self.config = SimpleNamespace(
+            NICKNAME='',
+            COMMAND_START=set(command_start),
+            COMMAND_SEP=list(command_sep),
+            SESSION_RUNNING_WAIT=running_wait,
+            SESSION_RUN_TIMEOUT=None,
+            SESSION_EXPIRE_TIMEOUT=None,
+            SESSION_RUNNING_EXPRESSION='busy',
+        )
+        self.routing = Routing.from_config(self.config)
+        self.loop = None
+        self.spawned = []
+        self.tasks = SimpleNamespace(spawn=self._spawn,
+                                     spawn_threadsafe=self._spawn)
+
+    def _spawn(self, coro, *args, **kwargs):
+        coro.close()
+        self.spawned.append(kwargs.get('kind'))
+
+
+def _make_event(message):
+    return Event(type='message',
+                 detail_type='private',
+                 self_id='s1',
+                 to_me=True,
+                 message=Message(message))
+
+
+@pytest.fixture
+def make_bot():
+    return FakeBot
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def make_event():
+    return _make_event
+
+
+@pytest.fixture
+def command_registry(monkeypatch):
+    """Start from empty command registries and sessions."""
+    monkeypatch.setattr(command, '_registry', {})
+    monkeypatch.setattr(command, '_commands', {})
+    monkeypatch.setattr(command, '_aliases', {})
+    monkeypatch.setattr(command, '_index_routing', None)
+    monkeypatch.setattr(command, '_sessions', {})
@@ -0,0 +1,76 @@
+from anybot.api_impl import ActionCache
+
+
+def make_cache(maxsize=1024):
+    cache = ActionCache(maxsize)
+    cache.set_policy('get_status', 60)
+    cache.set_policy('get_volume', 60, invalidated_by=['set_volume'])
+    return cache
+
+
+def put(cache, action, self_id, data):
+    key = cache.make_key(action, self_id, {})
+    cache.put(key, data, cache.generation(self_id))
+    return key
+
+
+def test_results_are_copied():
+    cache = make_cache()
+    data = {'online': True}
+    key = put(cache, 'get_status', 'a', data)
+    data['online'] = False
+    hit, cached = cache.get(key)
+    assert hit and cached == {'online': True}
+    cached['online'] = False
+    assert cache.get(key) == (True, {'online': True})
+
+
+def test_invalidation_only_skips_puts_of_the_same_speaker():
+    cache = make_cache()
+    key_a = cache.make_key('get_status', 'a', {})
+    key_b = cache.make_key('get_status', 'b', {})
+    generation_a = cache.generation('a')
+    generation_b = cache.generation('b')
+
+    # e.g. speaker b disconnected while both calls were in flight
+    cache.invalidate(self_id='b')
+    cache.put(key_a, 1, generation_a)
+    cache.put(key_b, 2, generation_b)
+    assert cache.get(key_a) == (True, 1)
+    assert cache.get(key_b) == (False, None)
+
+    # invalidating every speaker skips all of them
+    generation_a = cache.generation('a')
+    cache.invalidate('get_volume')
+    cache.put(key_a, 3, generation_a)
+    assert cache.get(key_a) == (True, 1)
+
+
+def test_invalidate_by_speaker_and_action():
+    cache = make_cache()
+    status_a = put(cache, 'get_status', 'a', 1)
+    volume_a = put(cache, 'get_volume', 'a', 2)
+    volume_b = put(cache, 'get_volume', 'b', 3)
+
+    cache.on_called('set_volume', 'a')
+    assert cache.get(volume_a)[0] is False
+    assert cache.get(status_a)[0] and cache.get(volume_b)[0]
+
+    cache.invalidate(self_id='a')
+    assert cache.get(status_a)[0] is False
+    assert cache.get(volume_b)[0]
+    assert list(cache._keys_by_self_id) == ['b']
+
+    cache.invalidate()
+    assert cache.stats['size'] == 0 and not cache._keys_by_self_id
+
+
+def test_eviction_keeps_speaker_index():
+    cache = make_cache(maxsize=2)
+    first = put(cache, 'get_status', 'a', 1)
+    put(cache, 'get_status', 'b', 2)
+    put(cache, 'get_volume', 'b', 3)
+    assert cache.get(first)[0] is False
+    assert list(cache._keys_by_self_id) == ['b']
+    cache.invalidate(self_id='b')
+    assert cache.stats['size'] == 0 and not cache._keys_by_self_id
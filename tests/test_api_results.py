@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from anybot.api_impl import Connection, ResultStore, TimeoutQueue
+from anybot.exceptions import NetworkError
+
+
+def test_timeouts_fire_in_deadline_order():
+    async def main():
+        loop = asyncio.get_running_loop()
+        timeouts = TimeoutQueue()
+        failed = []
+        futures = {}
+        for name, timeout in [('late', 0.05), ('early', 0.01),
+                              ('never', 60)]:
+            future = futures[name] = loop.create_future()
+            future.add_done_callback(lambda f, n=name: failed.append(n))
+            timeouts.add(future, timeout)
+        await asyncio.wait([futures['late'], futures['early']])
+        assert failed == ['early', 'late']
+        assert isinstance(futures['late'].exception(), NetworkError)
+        assert not futures['never'].done() and len(timeouts) == 1
+        futures['never'].cancel()
+
+    asyncio.run(main())
+
+
+def test_done_futures_are_compacted():
+    async def main():
+        loop = asyncio.get_running_loop()
+        timeouts = TimeoutQueue()
+        futures = [loop.create_future() for _ in range(100)]
+        for i, future in enumerate(futures):
+            timeouts.add(future, 60 + i)
+        for future in futures[:60]:
+            future.set_result(None)
+        await asyncio.sleep(0)
+        assert len(timeouts) == 40
+        # compacted once more than half were done, the done callbacks run
+        # after all of them are done here
+        assert len(timeouts._heap) == 40
+        assert timeouts._timer.when() == timeouts._heap[0][0]
+        for future in futures[60:]:
+            future.cancel()
+
+    asyncio.run(main())
+
+
+def test_results_are_matched_by_seq():
+    async def main():
+        store = ResultStore(TimeoutQueue())
+        first, second = store.next_seq(), store.next_seq()
+        store.expect(first, 60)
+        store.expect(second, 60)
+        store.add({'echo': {'seq': second}, 'data': 2})
+        store.add({'echo': {'seq': 12345}, 'data': 0})
+        assert (await store.fetch(second))['data'] == 2
+        assert len(store) == 1
+        store.discard(first)
+        assert len(store) == 0
+
+    asyncio.run(main())
+
+
+def test_pending_calls_fail_when_connection_lost():
+    sent = []
+
+    async def send(data):
+        sent.append(data)
+
+    async def main():
+        conn = Connection(SimpleNamespace(send=send), '1', TimeoutQueue())
+        request = asyncio.ensure_future(conn.request('get_status', {}, 60))
+        await asyncio.sleep(0)
+        assert sent and not request.done()
+
+        conn.close()
+        with pytest.raises(NetworkError):
+            await request
+        assert conn.closed
+        with pytest.raises(NetworkError):
+            await conn.request('get_status', {}, 60)
+        assert len(sent) == 1
+
+    asyncio.run(main())
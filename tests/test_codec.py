@@ -0,0 +1,110 @@
+import base64
+import json
+
+import pytest
+
+from anybot.codec import (JsonCodec, JsonBinaryCodec, json_dumps,
+                          _records_from_wire)
+from anybot.message import Audio, Message, MessageSegment
+
+try:
+    import msgpack
+    from anybot.codec import MsgpackCodec
+except ImportError:
+    msgpack = None
+
+RAW = b'RIFF\x00\x01\x02wave'
+B64 = base64.b64encode(RAW).decode()
+
+
+def _event(seg_data):
+    return {
+        'type': 'message',
+        'detail_type': 'private',
+        'message': [{'type': 'record', 'data': seg_data}],
+    }
+
+
+def _request(*segments):
+    return {'action': 'send_msg', 'params': {'message': list(segments)}}
+
+
+@pytest.mark.parametrize('codec', [JsonCodec(), JsonBinaryCodec()])
+def test_json_loads_keeps_base64(codec):
+    frame = json.dumps(_event({'base64': B64}))
+    payload = codec.loads(frame)
+    assert payload['message'][0]['data'] == {'base64': B64}
+
+
+@pytest.mark.skipif(msgpack is None, reason='msgpack is not installed')
+def test_msgpack_records_to_base64_without_message_class():
+    frame = msgpack.packb(_event({'audio': RAW}), use_bin_type=True)
+    message = MsgpackCodec().loads(frame)['message']
+    _records_from_wire(message, to_audio=False)
+    assert message[0]['data'] == {'base64': B64}
+
+
+@pytest.mark.parametrize('data', [{'base64': B64}, {'audio': RAW}])
+def test_records_to_audio_for_message_class(data):
+    message = [{'type': 'record', 'data': data}]
+    _records_from_wire(message, to_audio=True)
+    audio = message[0]['data']['audio']
+    assert isinstance(audio, Audio)
+    assert 'base64' not in message[0]['data']
+    assert bytes(audio.raw) == RAW and audio.base64 == B64
+
+
+@pytest.mark.parametrize('segment', [
+    MessageSegment.record_audio(Audio(RAW)),
+    {'type': 'record', 'data': {'audio': Audio(RAW)}},
+    {'type': 'record', 'data': {'base64': B64}},
+])
+@pytest.mark.parametrize('codec', [JsonCodec(), JsonBinaryCodec()])
+def test_json_dumps_record_as_base64(codec, segment):
+    request = _request(segment)
+    sent = json.loads(codec.dumps(request))
+    assert sent['params']['message'] == [{
+        'type': 'record',
+        'data': {'base64': B64},
+    }]
+    # the request itself is left untouched
+    assert request['params']['message'][0] is segment
+
+
+def test_json_dumps_batch_and_message_object():
+    message = Message(MessageSegment.text('hi')) + \
+        MessageSegment.record_audio(RAW)
+    sent = json.loads(JsonCodec().dumps([_request(*message)]))
+    assert sent[0]['params']['message'] == [
+        {'type': 'text', 'data': {'text': 'hi'}},
+        {'type': 'record', 'data': {'base64': B64}},
+    ]
+
+
+@pytest.mark.skipif(msgpack is None, reason='msgpack is not installed')
+@pytest.mark.parametrize('segment', [
+    MessageSegment.record_audio(Audio(base64=B64)),
+    {'type': 'record', 'data': {'audio': Audio(RAW)}},
+    {'type': 'record', 'data': {'base64': B64}},
+])
+def test_msgpack_dumps_record_as_bytes(segment):
+    sent = msgpack.unpackb(MsgpackCodec().dumps(_request(segment)),
+                           raw=False)
+    assert sent['params']['message'] == [{
+        'type': 'record',
+        'data': {'audio': RAW},
+    }]
+
+
+@pytest.mark.parametrize('obj', [
+    {'a': {1: 'x'}},
+    {'n': 2**70},
+    {'n': -2**70, 'm': [{2: 2**64}]},
+])
+def test_json_dumps_same_as_standard_json(obj):
+    assert json.loads(json_dumps(obj)) == json.loads(json.dumps(obj))
+
+
+def test_json_dumps_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        json_dumps({'x': object()})
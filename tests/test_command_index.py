@@ -0,0 +1,81 @@
+import re
+
+import pytest
+
+import nonebot.command as command
+from nonebot.command import (on_command, parse_command, dump_command_index,
+                             CommandGroup)
+
+pytestmark = pytest.mark.usefixtures('command_registry')
+
+
+async def noop(session):
+    pass
+
+
+def test_spellings_and_aliases(make_bot):
+    on_command('echo', aliases='复读')(noop)
+    on_command(('weather', 'today'), aliases=('天气', ))(noop)
+    bot = make_bot()
+    assert dump_command_index(bot) == {
+        'echo': ('echo', ),
+        '复读': ('echo', ),
+        'weather/today': ('weather', 'today'),
+        'weather.today': ('weather', 'today'),
+        '天气': ('weather', 'today'),
+    }
+    cmd, arg = parse_command(bot, '/weather.today 北京')
+    assert cmd.name == ('weather', 'today') and arg == '北京'
+    cmd, arg = parse_command(bot, '天气')
+    assert cmd.name == ('weather', 'today') and arg == ''
+    assert parse_command(bot, 'weather') == (None, None)
+
+
+def test_index_follows_registration_and_config(make_bot):
+    bot = make_bot(command_sep=('.', ))
+    on_command(('a', 'b'))(noop)
+    assert parse_command(bot, 'a.b')[0].name == ('a', 'b')
+    assert parse_command(bot, 'a/b') == (None, None)
+
+    # registered after the index was built
+    on_command('c')(noop)
+    assert parse_command(bot, 'c')[0].name == ('c', )
+
+    # config reloaded with other separators
+    bot = make_bot(command_sep=('/', ))
+    assert parse_command(bot, 'a/b')[0].name == ('a', 'b')
+    assert parse_command(bot, 'a.b') == (None, None)
+
+
+def test_group_commands_are_indexed(make_bot):
+    group = CommandGroup('note')
+    group.command('add')(noop)
+    assert dump_command_index(make_bot())['note.add'] == ('note', 'add')
+
+
+def test_name_part_containing_separator(make_bot):
+    on_command(('a.b', 'c'))(noop)
+    # both split "a.b/c" into two parts, the first separator wins
+    bot = make_bot(command_sep=('/', '.'))
+    assert parse_command(bot, 'a.b/c')[0].name == ('a.b', 'c')
+    bot = make_bot(command_sep=('.', '/'))
+    assert 'a.b/c' not in dump_command_index(bot)
+    assert parse_command(bot, 'a.b/c') == (None, None)
+
+
+def test_alias_overrides_name_and_missing_target(make_bot):
+    on_command('x')(noop)
+    on_command('y', aliases='x')(noop)
+    on_command('z')(noop)
+    command._aliases['z'] = ('missing', )
+    bot = make_bot()
+    assert parse_command(bot, 'x')[0].name == ('y', )
+    # an alias is checked first, even if its command doesn't exist
+    assert parse_command(bot, 'z') == (None, None)
+
+
+def test_regex_separator_falls_back_to_split(make_bot):
+    on_command(('a', 'b'))(noop)
+    bot = make_bot(command_sep=(re.compile(r'\s*>\s*'), ))
+    assert dump_command_index(bot) == {}
+    assert parse_command(bot, 'a>b')[0].name == ('a', 'b')
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+
+import anybot.dedup
+from anybot.dedup import Deduplicator
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(anybot.dedup, 'time',
+                        SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_duplicates_within_window(clock):
+    dedup = Deduplicator(100, window=10)
+    assert not dedup.check(('a', 1))
+    assert not dedup.check(('b', 1))
+    clock.now += 10
+    assert dedup.check(('a', 1))
+    assert dedup.stats == {'size': 2, 'hits': 1}
+
+
+def test_window_expiry(clock):
+    dedup = Deduplicator(100, window=10)
+    dedup.check(('a', 1))
+    clock.now += 5
+    dedup.check(('a', 2))
+    clock.now += 5.5
+    # ('a', 1) expired and was evicted on the check of another key
+    assert not dedup.check(('a', 3))
+    assert len(dedup) == 2
+    assert not dedup.check(('a', 1))
+    assert dedup.check(('a', 2))
+
+
+def test_maxsize_evicts_oldest(clock):
+    dedup = Deduplicator(2)
+    for i in range(3):
+        assert not dedup.check(i)
+        clock.now += 1000
+    assert len(dedup) == 2
+    assert not dedup.check(0)
+    assert dedup.check(2)
@@ -0,0 +1,37 @@
+import asyncio
+
+from anybot import AnyBot
+from anybot.event_queue import EventQueue
+
+
+def test_drain_timeout_cancels_running_handlers():
+    bot = AnyBot(__name__)
+    cancelled = []
+
+    async def handler(payload):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(payload['message_id'])
+            raise
+
+    async def main():
+        queue = EventQueue(handler, workers=2)
+        bot._event_queues['1'] = queue
+        for i in range(3):
+            await queue.put({'type': 'message', 'message_id': i})
+        await asyncio.sleep(0)
+        assert not await bot.drain(0.05)
+        return queue
+
+    queue = asyncio.run(main())
+    assert sorted(cancelled) == [0, 1]
+    assert all(worker.done() for worker in queue._workers)
+    assert queue.depth == 0
+
+
+def test_after_serving_shuts_down_handler_executor():
+    bot = AnyBot(__name__)
+    asyncio.run(bot._after_serving())
+    # noinspection PyProtectedMember
+    assert bot._handler_executor._pool._shutdown
@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from anybot.event_queue import EventQueue
+
+
+class Recorder:
+    """An event handler that waits for the gate to open."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.started = []
+        self.handled = []
+
+    async def __call__(self, payload):
+        self.started.append(payload['id'])
+        await self.gate.wait()
+        self.handled.append(payload['id'])
+
+
+def message(id_):
+    return {'type': 'message', 'detail_type': 'private', 'id': id_}
+
+
+@pytest.mark.parametrize('overflow, handled, dropped', [
+    ('drop_oldest', [0, 2, 3], [False, False, True]),
+    ('drop_newest', [0, 1, 2], [False, False, False]),
+])
+def test_overflow_drops(overflow, handled, dropped):
+    async def main():
+        recorder = Recorder()
+        queue = EventQueue(recorder, maxsize=2, overflow=overflow,
+                           workers=1)
+        await queue.put(message(0))
+        await asyncio.sleep(0)
+        assert recorder.started == [0]
+        accepted = [await queue.put(message(i)) for i in (1, 2, 3)]
+        assert accepted == [True, True, overflow == 'drop_oldest']
+        assert queue.dropped_overflow == 1
+        recorder.gate.set()
+        await queue.drain()
+        assert recorder.handled == handled
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_overflow_block_waits_for_space():
+    async def main():
+        recorder = Recorder()
+        queue = EventQueue(recorder, maxsize=1, overflow='block', workers=1)
+        await queue.put(message(0))
+        await asyncio.sleep(0)
+        await queue.put(message(1))
+        blocked = asyncio.ensure_future(queue.put(message(2)))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        recorder.gate.set()
+        assert await blocked
+        await queue.drain()
+        assert recorder.handled == [0, 1, 2]
+        assert queue.dropped_overflow == 0
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_stale_events_are_dropped():
+    async def main():
+        recorder = Recorder()
+        queue = EventQueue(recorder, max_age=0.01, workers=1)
+        await queue.put(message(0))
+        await asyncio.sleep(0)
+        await queue.put(message(1))
+        # message 1 waits longer than max_age behind message 0
+        await asyncio.sleep(0.05)
+        recorder.gate.set()
+        await queue.put(message(2))
+        await queue.drain()
+        assert recorder.handled == [0, 2]
+        assert queue.dropped_stale == 1
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_closed_queue_rejects_events():
+    async def main():
+        recorder = Recorder()
+        queue = EventQueue(recorder, workers=1)
+        queue.close()
+        assert not await queue.put(message(0))
+
+    asyncio.run(main())
+
+
+def meta_event(id_):
+    return {'type': 'meta_event', 'detail_type': 'heartbeat', 'id': id_}
+
+
+PRIORITIES = {'meta_event': 0, 'message': 1}
+
+
+def test_higher_priority_lane_first():
+    async def main():
+        recorder = Recorder()
+        queue = EventQueue(recorder, workers=1, priorities=PRIORITIES)
+        await queue.put(message('m0'))
+        await asyncio.sleep(0)
+        for payload in (message('m1'), meta_event('e1'), message('m2'),
+                        meta_event('e2')):
+            await queue.put(payload)
+        recorder.gate.set()
+        await queue.drain()
+        assert recorder.handled == ['m0', 'e1', 'e2', 'm1', 'm2']
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_lane_concurrency_leaves_workers_to_higher_priority():
+    async def main():
+        recorder = Recorder()
+        queue = EventQueue(recorder,
+                           workers=2,
+                           priorities=PRIORITIES,
+                           lane_concurrency={1: 1})
+        await queue.put(message('m0'))
+        await queue.put(message('m1'))
+        await asyncio.sleep(0)
+        # the second worker doesn't take m1
+        assert recorder.started == ['m0']
+        await queue.put(meta_event('e0'))
+        await asyncio.sleep(0)
+        assert recorder.started == ['m0', 'e0']
+        assert queue.stats['lanes'] == {
+            0: {'depth': 0, 'running': 1},
+            1: {'depth': 1, 'running': 1},
+        }
+        recorder.gate.set()
+        await queue.drain()
+        assert sorted(recorder.handled) == ['e0', 'm0', 'm1']
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_overflow_is_per_lane():
+    async def main():
+        recorder = Recorder()
+        queue = EventQueue(recorder, maxsize=1, overflow='drop_newest',
+                           workers=1, priorities=PRIORITIES)
+        await queue.put(message('m0'))
+        await asyncio.sleep(0)
+        assert await queue.put(message('m1'))
+        assert not await queue.put(message('m2'))
+        # the full message lane doesn't drop meta events
+        assert await queue.put(meta_event('e0'))
+        recorder.gate.set()
+        await queue.drain()
+        assert recorder.handled == ['m0', 'e0', 'm1']
+        queue.close()
+
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from nonebot.command import Command, CommandSession
+from nonebot.command.argfilter import extractors
+from nonebot.message import Message, ParsedMessage
+from nonebot.natural_language import NLPSession
+
+MESSAGES = [
+    '',
+    '今天  天气\t怎么样 ',
+    'a &#91;b&#93; &amp; c',
+    '看 [MT:image,url=http://x/a.png] 和 [MT:image,file=1] 吧',
+    '[MT:record,file=a.mp3]',
+    '[MT:unclosed',
+]
+
+
+@pytest.mark.parametrize('msg', MESSAGES)
+@pytest.mark.parametrize('as_message', [False, True])
+def test_same_as_message(msg, as_message):
+    parsed = ParsedMessage(Message(msg) if as_message else msg)
+    message = Message(msg)
+    assert parsed.raw == (str(message) if as_message else msg)
+    assert parsed.message == message
+    assert parsed.text == message.extract_plain_text()
+    assert parsed.text_length == len(parsed.text)
+    assert parsed.images == [
+        s.data['url'] for s in message
+        if s.type == 'image' and 'url' in s.data
+    ]
+    assert parsed.normalized == ' '.join(parsed.text.split())
+
+
+def test_plain_text_is_not_built_into_segments():
+    parsed = ParsedMessage('a &amp; b')
+    assert parsed.text == 'a & b' and parsed.images == []
+    assert parsed._message is None
+
+
+def test_of_event_is_cached_until_message_replaced(make_event):
+    event = make_event('hello')
+    parsed = ParsedMessage.of(event)
+    assert ParsedMessage.of(event) is parsed
+    assert '_parsed_message' not in event
+
+    event['message'] = Message('bye')
+    assert ParsedMessage.of(event) is not parsed
+    assert ParsedMessage.of(event).text == 'bye'
+
+
+def test_command_session_shares_parsed_message_of_event(bot, make_event):
+    event = make_event('继续 [MT:image,url=u]')
+    raw = ParsedMessage.of(event).raw
+    cmd = Command(name=('x', ), func=None, only_to_me=False,
+                  privileged=False)
+    session = CommandSession(bot, event, cmd, current_arg=raw)
+    assert session.current_arg_parsed is ParsedMessage.of(event)
+    assert session.current_arg_text == '继续 '
+    assert session.current_arg_images == ['u']
+
+    session.refresh(event, current_arg='其它')
+    assert session.current_arg_text == '其它'
+    # changed without refresh()
+    session.current_arg = '[MT:image,url=v]'
+    assert session.current_arg_images == ['v']
+
+
+def test_nlp_session_reads_parsed_message(bot, make_event):
+    event = make_event('打开 [MT:image,url=u]')
+    session = NLPSession(bot, event, ParsedMessage.of(event).raw)
+    assert session.parsed is ParsedMessage.of(event)
+    assert session.msg_text == '打开 ' and session.msg_images == ['u']
+
+    session = NLPSession(bot, event, '别的')
+    assert session.msg_text == '别的' and session.msg_images == []
+
+
+def test_extractors():
+    parsed = ParsedMessage('1 和 2.5 [MT:image,url=u]')
+    assert extractors.extract_text(parsed) == '1 和 2.5 '
+    assert extractors.extract_text(parsed.raw) == '1 和 2.5 '
+    assert extractors.extract_image_urls(parsed.raw) == ['u']
+    assert extractors.extract_numbers(parsed) == [1.0, 2.5]
+
+
+def test_arg_filters_reuse_parsed_argument(bot, make_event):
+    event = make_event('继续 [MT:image,url=u]')
+
+    async def func(session):
+        pass
+
+    cmd = Command(name=('x', ), func=func, only_to_me=False,
+                  privileged=False)
+    session = CommandSession(bot, event, cmd,
+                             current_arg=ParsedMessage.of(event).raw)
+    seen = []
+
+    def spy(arg):
+        seen.append(extractors._parsed(arg))
+        return arg
+
+    session.current_key = 'k'
+    session.current_arg_filters = [spy, extractors.extract_text, spy]
+    assert asyncio.run(cmd.run(session))
+    assert seen[0] is ParsedMessage.of(event)
+    # the text extracted isn't the argument any more
+    assert seen[1] is not seen[0] and seen[1].raw == '继续 '
+    assert session.state['k'] == '继续 '
+    # only while the filters of the session are running
+    assert extractors._parsed(session.current_arg) is not seen[0]
@@ -0,0 +1,42 @@
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from nonebot.routing import Routing
+
+
+def make_config():
+    return SimpleNamespace(NICKNAME=['小明'],
+                           COMMAND_START={'/', re.compile(r'>+')},
+                           COMMAND_SEP=['/', '.'])
+
+
+@pytest.mark.parametrize('modify', [
+    lambda config: config.COMMAND_START.add('!'),
+    lambda config: config.COMMAND_SEP.remove('.'),
+    lambda config: config.NICKNAME.append('小红'),
+    lambda config: setattr(config, 'NICKNAME', '小红'),
+])
+def test_changed_config_detected(modify):
+    config = make_config()
+    routing = Routing.from_config(config)
+    assert routing.is_built_from(config)
+    modify(config)
+    assert not routing.is_built_from(config)
+    assert Routing.from_config(config).is_built_from(config)
+
+
+def test_equal_config_is_not_a_change():
+    config = make_config()
+    routing = Routing.from_config(config)
+    config.COMMAND_SEP = ['/', '.']
+    assert routing.is_built_from(config)
+
+
+def test_new_command_start_takes_effect():
+    config = make_config()
+    config.COMMAND_START.add('!')
+    routing = Routing.from_config(config)
+    assert routing.match_command_start('!echo') == '!'
+    assert routing.match_command_start('>>echo') == '>>'
@@ -0,0 +1,101 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import nonebot.command as command
+from nonebot.command import handle_command, kill_current_session, on_command
+
+pytestmark = pytest.mark.usefixtures('command_registry')
+
+
+async def yield_to_others():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def register_slow(log, proceed):
+    """Register a command that runs until proceed is set, then pauses."""
+    @on_command('slow')
+    async def slow(session):
+        if 'reply' not in session.state:
+            await proceed.wait()
+            log.append('pause')
+            session.get('reply')
+        log.append(session.state['reply'])
+
+
+def test_follow_up_handled_when_session_pauses(make_bot, make_event):
+    bot = make_bot(running_wait=timedelta(minutes=1))
+
+    async def main():
+        log, proceed = [], asyncio.Event()
+        register_slow(log, proceed)
+        first = asyncio.ensure_future(handle_command(bot, make_event('slow')))
+        await yield_to_others()
+        session = command._sessions['/self/s1']
+        follow_up = asyncio.ensure_future(
+            handle_command(bot, make_event('好的')))
+        await yield_to_others()
+        # waiting for the running session, not rejected
+        assert not follow_up.done() and not session._released.is_set()
+
+        proceed.set()
+        assert await first
+        assert await follow_up
+        return log
+
+    assert asyncio.run(main()) == ['pause', '好的']
+    assert bot.spawned == []
+
+
+def test_busy_notice_after_max_wait(make_bot, make_event):
+    bot = make_bot(running_wait=timedelta(seconds=0.05))
+
+    async def main():
+        log, proceed = [], asyncio.Event()
+        register_slow(log, proceed)
+        first = asyncio.ensure_future(handle_command(bot, make_event('slow')))
+        await yield_to_others()
+        assert await handle_command(bot, make_event('好的'))
+        assert not first.done() and log == []
+        first.cancel()
+
+    asyncio.run(main())
+    assert bot.spawned == ['send']
+
+
+def test_no_wait_when_disabled(make_bot, make_event):
+    bot = make_bot(running_wait=None)
+
+    async def main():
+        register_slow([], asyncio.Event())
+        first = asyncio.ensure_future(handle_command(bot, make_event('slow')))
+        await yield_to_others()
+        # returns while the session is still running
+        assert await asyncio.wait_for(
+            handle_command(bot, make_event('好的')), 5)
+        assert not first.done()
+        first.cancel()
+
+    asyncio.run(main())
+    assert bot.spawned == ['send']
+
+
+def test_killed_session_wakes_waiters(make_bot, make_event):
+    bot = make_bot(running_wait=timedelta(minutes=1))
+
+    async def main():
+        register_slow([], asyncio.Event())
+        first = asyncio.ensure_future(handle_command(bot, make_event('slow')))
+        await yield_to_others()
+        waiter = asyncio.ensure_future(
+            command._wait_for_session_released('/self/s1', 60))
+        await yield_to_others()
+        assert not waiter.done()
+
+        kill_current_session(make_event(''))
+        await asyncio.wait_for(waiter, 5)
+        first.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import asyncio
+import selectors
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+import anybot.workers as workers
+import nonebot
+
+
+@pytest.fixture
+def startup_callbacks(monkeypatch):
+    callbacks = []
+    server_app = SimpleNamespace(before_serving=callbacks.append)
+    monkeypatch.setattr(nonebot, '_bot',
+                        SimpleNamespace(server_app=server_app))
+    return callbacks
+
+
+@pytest.mark.parametrize('index, called', [(None, True), (0, True),
+                                           (1, False)])
+def test_startup_callbacks_run_in_first_worker_only(startup_callbacks,
+                                                    monkeypatch, index,
+                                                    called):
+    calls = []
+
+    @nonebot.on_startup
+    async def startup():
+        calls.append(workers.worker_index())
+
+    monkeypatch.setattr(workers, '_worker_index', index)
+    for callback in startup_callbacks:
+        asyncio.run(callback())
+    assert calls == ([index] if called else [])
+
+
+def test_parse_self_id():
+    assert workers.parse_self_id(b'GET /ws HTTP/1.1\r\n'
+                                 b'X-Self-ID: abc\r\n') == 'abc'
+    assert workers.parse_self_id(b'GET /ws?self_id=x HTTP/1.1') == 'x'
+    assert workers.parse_self_id(b'GET /ws HTTP/1.1') == '*'
+
+
+def test_route_does_not_block_on_a_stuck_worker(monkeypatch):
+    monkeypatch.setattr(workers, '_check_hypercorn_version', lambda: None)
+    supervisor = workers.Supervisor(None, host='127.0.0.1', port=0,
+                                    workers=1)
+    supervisor._selector = selectors.DefaultSelector()
+    channel, worker_channel = socket.socketpair()
+    channel.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        # the worker doesn't receive anything
+        while True:
+            channel.send(b'\0' * 65536)
+    supervisor._workers[0] = (0, channel, 0.0)
+
+    conn, client = socket.socketpair()
+    client.sendall(b'GET /ws HTTP/1.1\r\nX-Self-ID: abc\r\n\r\n')
+    supervisor._pending[conn] = 0.0
+    supervisor._selector.register(conn, selectors.EVENT_READ)
+    supervisor._route(conn)
+    assert conn.fileno() == -1 and not supervisor._pending
+
+    for s in (channel, worker_channel, client):
+        s.close()
+    supervisor._selector.close()
+
+
+def test_refuse_untested_hypercorn(monkeypatch):
+    import hypercorn
+    monkeypatch.setattr(hypercorn, '__version__', '0.17.0', raising=False)
+    with pytest.raises(RuntimeError, match='requirements-workers.txt'):
+        workers.Supervisor(None, host='127.0.0.1', port=0, workers=2)